@@ -14,6 +14,10 @@ class CustomAuthenticator(LTIAuthenticator):
         else:
             username = ret['name']
         handler.set_cookie('username', username)
+        if 'ROUTING_TOKEN_SECRET' in os.environ:
+            # Lets request-sharder send this user straight back here next time
+            signer = RoutingTokenSigner(os.environ['ROUTING_TOKEN_SECRET'].split(','))
+            signer.set_cookie(handler, os.environ['HUB_NAME'], os.environ['CLUSTER_NAME'], username)
         return ret
 
 c.JupyterHub.authenticator_class = CustomAuthenticator
@@ -0,0 +1,87 @@
+import base64
+import binascii
+import hashlib
+import hmac
+import time
+
+
+class RoutingTokenSigner:
+    """
+    Issue and verify signed routing tokens, saying which hub (on which cluster) a user lives on.
+
+    Hubs hand these out as a cookie once someone logs in, so request-sharder
+    can send returning users straight to their hub without asking Sharder.
+    A token is the base64 encoded 'hub|cluster|expiry|user', a '.', and its
+    truncated HMAC-SHA256 signature with secret - which everyone issuing or
+    verifying tokens must share. Tokens expire after max_age seconds, so users
+    reassigned to another hub are only sent to the old one for so long.
+
+    secret can also be a list of secrets, to rotate them: tokens are issued
+    with the first, and accepted if signed with any of them.
+    """
+    COOKIE_NAME = 'routing'
+
+    def __init__(self, secret, max_age=24 * 60 * 60):
+        secrets = [secret] if isinstance(secret, (str, bytes)) else secret
+        self.max_age = max_age
+        # Copying a keyed hmac is cheaper than setting up a new one every time
+        self._hmacs = [
+            hmac.new(s.encode() if isinstance(s, str) else s, digestmod=hashlib.sha256)
+            for s in secrets
+        ]
+
+    def _signature(self, payload, key_hmac=None):
+        h = (key_hmac or self._hmacs[0]).copy()
+        h.update(payload)
+        return h.digest()[:16]
+
+    @staticmethod
+    def _encode(data):
+        return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+    @staticmethod
+    def _decode(text):
+        return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+    def issue(self, hub, cluster, user, now=None):
+        expiry = int((now or time.time()) + self.max_age)
+        # user goes last, since it is the only part that might contain a |
+        payload = f'{hub}|{cluster}|{expiry}|{user}'.encode()
+        return f'{self._encode(payload)}.{self._encode(self._signature(payload))}'
+
+    def cookie_header(self, token):
+        """
+        Set-Cookie header value for token.
+
+        edX launches are cross site POSTs, which browsers only send cookies
+        marked SameSite=None (and so Secure too) with. Python's cookie Morsel
+        only knows about SameSite from 3.8, so the header is built here.
+        """
+        return f'{self.COOKIE_NAME}={token}; Max-Age={int(self.max_age)}; Path=/; Secure; HttpOnly; SameSite=None'
+
+    def set_cookie(self, handler, hub, cluster, user):
+        """
+        Issue a token for user, and set it as a cookie on tornado RequestHandler handler.
+        """
+        handler.add_header('Set-Cookie', self.cookie_header(self.issue(hub, cluster, user)))
+
+    def verify(self, token, user=None, now=None):
+        """
+        Return (hub, cluster, user) from token, or None if it is invalid or has expired.
+
+        If user is given, tokens issued to anyone else are invalid too.
+        """
+        try:
+            encoded_payload, encoded_signature = token.split('.')
+            payload = self._decode(encoded_payload)
+            signature = self._decode(encoded_signature)
+        except (ValueError, binascii.Error):
+            return None
+        if not any(hmac.compare_digest(signature, self._signature(payload, h)) for h in self._hmacs):
+            return None
+        hub, cluster, expiry, token_user = payload.decode().split('|', 3)
+        if int(expiry) < (now or time.time()):
+            return None
+        if user is not None and token_user != user:
+            return None
+        return hub, cluster, token_user
@@ -1,4 +1,621 @@
-import psycopg2.pool
+import asyncio
+import bisect
+import hashlib
+import heapq
+import fcntl
+import json
+import logging
+import math
+import mmap
+import os
+import random
+import struct
+import threading
+import time
+import urllib.request
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.extensions
+
+try:
+    import aiopg
+except ImportError:
+    aiopg = None
+
+
+class AssignmentCache:
+    """
+    Bounded, thread-safe LRU cache of name -> bucket assignments.
+
+    Assignments only change when explicitly reassigned, which Sharder picks
+    up by putting the new bucket over the old one (see Sharder.refresh_cache).
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        with self._lock:
+            try:
+                bucket = self._entries[name]
+            except KeyError:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(name)
+            self.hits += 1
+            return bucket
+
+    def put(self, name, bucket):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[name] = bucket
+            self._entries.move_to_end(name)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def rendezvous_bucket(name, buckets, weights=None):
+    """
+    Pick a bucket for name with rendezvous (highest random weight) hashing.
+
+    Every (bucket, name) pair gets a pseudo random score, and the highest
+    scoring bucket wins. This is stable across processes, and adding or
+    removing a bucket only moves the names that it wins or loses - about
+    1/N of them.
+
+    weights is an optional dict of bucket -> relative weight (default 1),
+    and names are placed in proportion to them.
+    """
+    def score(bucket):
+        digest = hashlib.sha1(f'{bucket}\0{name}'.encode()).digest()
+        # Uniformly distributed in (0, 1)
+        point = (int.from_bytes(digest[:8], 'big') + 0.5) / 2**64
+        weight = weights.get(bucket, 1) if weights else 1
+        return -weight / math.log(point)
+    return max(buckets, key=score)
+
+
+class NoBucketAvailable(Exception):
+    def __init__(self, message):
+        self.message = message
+
+
+class LoadSignal:
+    """
+    Source of the current load on each bucket, used to place new entries.
+
+    Subclasses implement poll, returning a dict of bucket -> load (higher is
+    busier). Buckets missing from the dict are treated as unknown.
+
+    per_entry is roughly how much load each new entry adds, in the same units,
+    so entries placed since the last poll can be counted on top of it.
+    """
+    per_entry = 1
+
+    def poll(self):
+        raise NotImplementedError()
+
+
+class StaticLoadSignal(LoadSignal):
+    """
+    Load signal that reports whatever it has been told, for tests and manual overrides.
+    """
+    def __init__(self, loads=None, per_entry=1):
+        self.loads = dict(loads or {})
+        self.per_entry = per_entry
+
+    def poll(self):
+        return dict(self.loads)
+
+
+class FileserverUsageSignal(LoadSignal):
+    """
+    Bytes used on each fileserver, from the filesystem mounted for it.
+
+    Each new home directory is assumed to grow to about bytes_per_entry.
+    """
+    def __init__(self, buckets, path_template='/mnt/fileservers/{bucket}', bytes_per_entry=64 * 1024 * 1024):
+        self.buckets = buckets
+        self.path_template = path_template
+        self.per_entry = bytes_per_entry
+
+    def poll(self):
+        loads = {}
+        for bucket in self.buckets:
+            stat = os.statvfs(self.path_template.format(bucket=bucket))
+            loads[bucket] = (stat.f_blocks - stat.f_bfree) * stat.f_frsize
+        return loads
+
+
+class HubActiveServersSignal(LoadSignal):
+    """
+    Number of running user servers on each hub, from the JupyterHub REST API.
+
+    hub_api_urls is a dict of bucket -> hub API url (ending in /hub/api), and
+    token an API token with admin rights on all of them. headers is an
+    optional dict of bucket -> extra headers to send, such as the cookie
+    inner-edge routes on.
+    """
+    def __init__(self, hub_api_urls, token, timeout=5, headers=None):
+        self.hub_api_urls = hub_api_urls
+        self.token = token
+        self.timeout = timeout
+        self.headers = headers or {}
+
+    def poll(self):
+        loads = {}
+        for bucket, url in self.hub_api_urls.items():
+            headers = dict(self.headers.get(bucket, {}))
+            headers['Authorization'] = f'token {self.token}'
+            req = urllib.request.Request(url.rstrip('/') + '/users', headers=headers)
+            with urllib.request.urlopen(req, timeout=self.timeout) as resp:
+                users = json.loads(resp.read().decode())
+            loads[bucket] = sum(1 for u in users if u.get('server'))
+        return loads
+
+
+class SharedLoadSignal(LoadSignal):
+    """
+    Shares the polls of another LoadSignal between processes, through a file at path.
+
+    Whichever process finds the file more than interval seconds old polls
+    signal and rewrites it, and the others read what it wrote. So signal is
+    polled about once per interval, however many processes use it.
+    """
+    def __init__(self, signal, path, interval):
+        self.signal = signal
+        self.path = path
+        self.interval = interval
+        self.per_entry = signal.per_entry
+
+    def poll(self):
+        # Held while polling, so the others wait for the result rather than
+        # polling too
+        with open(self.path + '.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                if time.time() - os.stat(self.path).st_mtime < self.interval:
+                    with open(self.path) as f:
+                        return json.load(f)
+            except (FileNotFoundError, ValueError):
+                pass
+            loads = self.signal.poll()
+            with open(self.path + '.tmp', 'w') as f:
+                json.dump(loads, f)
+            os.replace(self.path + '.tmp', self.path)
+            return loads
+
+
+class PolledLoad:
+    """
+    Polls a LoadSignal every interval seconds in a background thread.
+
+    Sharding decisions read the last polled value, so they never wait on the
+    signal. Values older than max_age seconds are ignored.
+    """
+    def __init__(self, signal, log, interval=15, max_age=120):
+        self.signal = signal
+        self.log = log
+        self.interval = interval
+        self.max_age = max_age
+        self._loads = {}
+        self._polled_at = 0
+        self._thread = threading.Thread(target=self._poll_forever, daemon=True)
+        self._thread.start()
+
+    def _poll_forever(self):
+        while True:
+            try:
+                loads = self.signal.poll()
+                self._loads, self._polled_at = loads, time.monotonic()
+            except Exception:
+                self.log.exception(f'Polling {type(self.signal).__name__} failed')
+            time.sleep(self.interval)
+
+    @property
+    def polled_at(self):
+        return self._polled_at
+
+    @property
+    def loads(self):
+        if time.monotonic() - self._polled_at > self.max_age:
+            return {}
+        return self._loads
+
+
+def load_preference(buckets, loads, weights, assigned_since_poll, per_entry=1):
+    """
+    Order buckets from least to most loaded, relative to their weights.
+
+    Entries assigned since loads were last polled are counted on top (at
+    per_entry load each), so a burst of new entries does not all pile onto
+    whichever bucket was least loaded at the last poll. Buckets without a
+    known load go last.
+    """
+    known = [b for b in buckets if b in loads and weights.get(b, 1) > 0]
+    return sorted(
+        known,
+        key=lambda b: ((loads[b] + assigned_since_poll.get(b, 0) * per_entry) / weights.get(b, 1), b)
+    )
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent calls for the same key into one.
+
+    The first caller for a key runs the function; callers arriving while it is
+    still running wait for it and receive the same result (or exception).
+    """
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, *args):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = {'done': threading.Event()}
+
+        if not leader:
+            flight['done'].wait()
+            if 'error' in flight:
+                raise flight['error']
+            return flight['result']
+
+        try:
+            flight['result'] = func(*args)
+            return flight['result']
+        except Exception as e:
+            flight['error'] = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight['done'].set()
+
+
+class AssignmentSnapshot:
+    """
+    Read-only, memory mapped index of every assignment of one kind.
+
+    Processes on the same node that map the same file share one copy of it in
+    the page cache, rather than each building their own dict. The file holds
+    names sorted by their UTF-8 bytes, so lookups are a binary search:
+
+        header: magic, entry count, bucket count, watermark (see Sharder.watermark), kind length
+        kind
+        bucket table: (u16 length, bytes) for each bucket
+        offsets: (count + 1) u32 offsets of each name in the names blob
+        bucket ids: count u16 indexes into the bucket table
+        names blob
+    """
+    MAGIC = b'SHARDSS2'
+    HEADER = struct.Struct('<8sIIQI')
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.stat = os.fstat(f.fileno())
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.count, bucket_count, self.watermark, kind_length = self.HEADER.unpack_from(self._mmap, 0)
+        if magic != self.MAGIC:
+            raise ValueError(f'{path} is not an assignment snapshot')
+        pos = self.HEADER.size
+        self.kind = self._mmap[pos:pos + kind_length].decode()
+        pos += kind_length
+        self.buckets = []
+        for i in range(bucket_count):
+            length, = struct.unpack_from('<H', self._mmap, pos)
+            self.buckets.append(self._mmap[pos + 2:pos + 2 + length].decode())
+            pos += 2 + length
+        self._offsets = pos
+        self._bucket_ids = self._offsets + 4 * (self.count + 1)
+        self._names = self._bucket_ids + 2 * self.count
+
+    def _name(self, i):
+        start, end = struct.unpack_from('<II', self._mmap, self._offsets + 4 * i)
+        return self._mmap[self._names + start:self._names + end]
+
+    def _bucket(self, i):
+        bucket_id, = struct.unpack_from('<H', self._mmap, self._bucket_ids + 2 * i)
+        return self.buckets[bucket_id]
+
+    def get(self, name):
+        key = name.encode()
+        low, high = 0, self.count
+        while low < high:
+            mid = (low + high) // 2
+            if self._name(mid) < key:
+                low = mid + 1
+            else:
+                high = mid
+        if low < self.count and self._name(low) == key:
+            return self._bucket(low)
+        return None
+
+    def items(self):
+        for i in range(self.count):
+            yield self._name(i).decode(), self._bucket(i)
+
+    def close(self):
+        self._mmap.close()
+
+    @classmethod
+    def write(cls, path, kind, watermark, assignments):
+        """
+        Atomically write a snapshot of assignments (a dict of name -> bucket) to path.
+        """
+        buckets = sorted(set(assignments.values()))
+        bucket_ids = {bucket: i for i, bucket in enumerate(buckets)}
+        entries = sorted((name.encode(), bucket_ids[bucket]) for name, bucket in assignments.items())
+
+        offsets = [0]
+        for name, bucket_id in entries:
+            offsets.append(offsets[-1] + len(name))
+
+        tmp_path = f'{path}.tmp-{os.getpid()}'
+        with open(tmp_path, 'wb') as f:
+            kind_bytes = kind.encode()
+            f.write(cls.HEADER.pack(cls.MAGIC, len(entries), len(buckets), watermark, len(kind_bytes)))
+            f.write(kind_bytes)
+            for bucket in buckets:
+                bucket_bytes = bucket.encode()
+                f.write(struct.pack('<H', len(bucket_bytes)) + bucket_bytes)
+            f.write(struct.pack(f'<{len(offsets)}I', *offsets))
+            f.write(struct.pack(f'<{len(entries)}H', *(bucket_id for name, bucket_id in entries)))
+            for name, bucket_id in entries:
+                f.write(name)
+        os.replace(tmp_path, path)
+
+
+class Histogram:
+    """
+    Thread-safe cumulative histogram, in the style of prometheus.
+    """
+    DEFAULT_BOUNDS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, bounds=DEFAULT_BOUNDS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.counts[bisect.bisect_left(self.bounds, value)] += 1
+            self.sum += value
+
+    def snapshot(self):
+        """
+        Return a dict of upper bound -> cumulative count, plus the count and sum of observations.
+        """
+        with self._lock:
+            buckets = {}
+            total = 0
+            for bound, count in zip(self.bounds + (float('inf'), ), self.counts):
+                total += count
+                buckets[str(bound)] = total
+            return {'buckets': buckets, 'count': total, 'sum': self.sum}
+
+
+class PoolTimeout(Exception):
+    def __init__(self, message):
+        self.message = message
+
+
+class ConnectionPool:
+    """
+    Blocking, health checked pool of up to maxconn psycopg2 connections.
+
+    Unlike psycopg2's own pools, getconn waits (for up to timeout seconds) for a
+    connection to be returned when all of them are in use, rather than failing
+    immediately. Connections are checked before being handed out: ones that are
+    closed, older than max_age seconds, or that fail a ping after sitting idle for
+    more than ping_after seconds (such as after a Cloud SQL failover) are replaced.
+
+    prepare is a list of PREPARE statements run on every new connection, so hot
+    queries can be run as server side prepared statements with EXECUTE.
+
+    Has the same getconn / putconn interface as psycopg2's pools.
+    """
+    def __init__(self, maxconn, timeout=10, max_age=30 * 60, ping_after=10, prepare=(), **connect_kwargs):
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.max_age = max_age
+        self.ping_after = ping_after
+        self.prepare = list(prepare)
+        self.connect_kwargs = connect_kwargs
+
+        self.wait_time = Histogram()
+        self.timeouts = 0
+        self.discarded = 0
+
+        # Idle connections, each as (connection, created_at, returned_at)
+        self._idle = deque()
+        self._created_at = {}
+        self._size = 0
+        self._cond = threading.Condition()
+
+    def _connect(self):
+        conn = psycopg2.connect(**self.connect_kwargs)
+        if self.prepare:
+            with conn.cursor() as cur:
+                for statement in self.prepare:
+                    cur.execute(statement)
+            conn.commit()
+        self._created_at[id(conn)] = time.monotonic()
+        return conn
+
+    def _discard(self, conn):
+        self._created_at.pop(id(conn), None)
+        self.discarded += 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _healthy(self, conn, returned_at):
+        now = time.monotonic()
+        if conn.closed or now - self._created_at.get(id(conn), now) > self.max_age:
+            return False
+        if now - returned_at > self.ping_after:
+            try:
+                with conn.cursor() as cur:
+                    cur.execute('SELECT 1')
+                conn.rollback()
+            except psycopg2.Error:
+                return False
+        return True
+
+    def getconn(self):
+        start = time.monotonic()
+        deadline = start + self.timeout
+        with self._cond:
+            while not self._idle and self._size >= self.maxconn:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.timeouts += 1
+                    self.wait_time.observe(time.monotonic() - start)
+                    raise PoolTimeout(f'No database connection free after {self.timeout}s')
+                self._cond.wait(remaining)
+            if self._idle:
+                conn, returned_at = self._idle.pop()
+            else:
+                conn, returned_at = None, None
+            # Reserve our slot, so we can connect / check health without holding the lock
+            self._size += conn is None
+        self.wait_time.observe(time.monotonic() - start)
+
+        if conn is not None and not self._healthy(conn, returned_at):
+            self._discard(conn)
+            conn = None
+        if conn is None:
+            try:
+                conn = self._connect()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                raise
+        return conn
+
+    def putconn(self, conn, close=False):
+        if not conn.closed and conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                close = True
+        with self._cond:
+            if close or conn.closed:
+                self._size -= 1
+                self._discard(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def closeall(self):
+        with self._cond:
+            while self._idle:
+                conn, returned_at = self._idle.pop()
+                self._size -= 1
+                self._discard(conn)
+
+    def stats(self):
+        with self._cond:
+            size = self._size
+            idle = len(self._idle)
+        return {
+            'max_size': self.maxconn,
+            'size': size,
+            'in_use': size - idle,
+            'idle': idle,
+            'timeouts': self.timeouts,
+            'discarded': self.discarded,
+            'wait_seconds': self.wait_time.snapshot(),
+        }
+
+
+def prepared(name, sql, params):
+    """
+    Turn sql with pyformat %(name)s parameters into a server side prepared statement.
+
+    params is a list of (parameter name, postgres type) tuples. Returns the
+    PREPARE statement to run on each connection, and the matching EXECUTE
+    statement (which takes the same pyformat parameters as sql did).
+    """
+    for i, (param, type) in enumerate(params, 1):
+        sql = sql.replace(f'%({param})s', f'${i}')
+    types = ', '.join(type for param, type in params)
+    arguments = ', '.join(f'%({param})s' for param, type in params)
+    return f'PREPARE {name} ({types}) AS {sql}', f'EXECUTE {name} ({arguments})'
+
+
+class ShardObserver:
+    """
+    Instrumentation hook for Sharder.
+
+    phase is called with how long each phase of a shard call took:
+    'checkout' (waiting for a pooled connection), 'replica_lookup', 'lookup',
+    'assign' (the INSERT of a new entry) and 'commit'.
+
+    event is called once per shard call with how it was answered: 'cache_hit',
+    'snapshot_hit', 'hashed' (rendezvous placement), 'lookup' (found in the
+    database) or 'assign' (a new entry), and the bucket it was answered with.
+    """
+    def phase(self, kind, phase, seconds):
+        pass
+
+    def event(self, kind, event, bucket):
+        pass
+
+
+class StatsObserver(ShardObserver):
+    """
+    Keep phase timing histograms and event counts in memory, for a stats endpoint.
+    """
+    def __init__(self):
+        self.phases = {}
+        self.events = {}
+        self._lock = threading.Lock()
+
+    def phase(self, kind, phase, seconds):
+        histogram = self.phases.get((kind, phase))
+        if histogram is None:
+            with self._lock:
+                histogram = self.phases.setdefault((kind, phase), Histogram())
+        histogram.observe(seconds)
+
+    def event(self, kind, event, bucket):
+        with self._lock:
+            key = (kind, event, bucket)
+            self.events[key] = self.events.get(key, 0) + 1
+
+    def stats(self):
+        """
+        Return a JSON serializable dict of kind -> phase timings and event counts.
+        """
+        stats = {}
+        with self._lock:
+            phases = list(self.phases.items())
+            events = list(self.events.items())
+        for (kind, phase), histogram in phases:
+            stats.setdefault(kind, {'phases': {}, 'events': {}})['phases'][phase] = histogram.snapshot()
+        for (kind, event, bucket), count in events:
+            kind_events = stats.setdefault(kind, {'phases': {}, 'events': {}})['events']
+            kind_events.setdefault(event, {})[bucket] = count
+        return stats
+
 
 class Sharder:
     """
@@ -7,6 +624,20 @@ class Sharder:
     Does least-loaded balancing of a given kind of object (homedirectory, running user, etc)
     across multiple buckets, ensuring that once an object is assigned to a bucket it always
     is assigned to the same bucket.
+
+    Assignments are kept in an in-process cache of cache_size entries (all of
+    them, if preload is True), refreshed with changes made elsewhere every
+    cache_refresh_interval seconds. Concurrent calls for the same name are
+    coalesced. Buckets can be weighted or drained (bucket_settings, set_bucket)
+    and marked unhealthy (set_unhealthy), and new entries can follow a live
+    load_signal rather than populations.
+
+    With placement='rendezvous', names are hashed over buckets instead, and
+    entries_v1 only holds overrides (see reassign) and names pinned where they
+    were when buckets are drained or reweighted. Lookups can be served from a
+    read replica (replica_dsn) or a memory mapped AssignmentSnapshot
+    (snapshot_path) before the primary.
+    observers (ShardObservers) are told how each shard call went.
     """
     SCHEMA = """
     CREATE TABLE IF NOT EXISTS entries_v1 (
@@ -17,63 +648,1185 @@ class Sharder:
         UNIQUE (kind, name)
     );
     CREATE INDEX IF NOT EXISTS entries_v1_kind_name_index ON entries_v1 (kind, name);
+    ALTER TABLE entries_v1 ADD COLUMN IF NOT EXISTS txid BIGINT NOT NULL DEFAULT txid_current();
+    CREATE INDEX IF NOT EXISTS entries_v1_kind_txid_index ON entries_v1 (kind, txid);
+
+    CREATE TABLE IF NOT EXISTS bucket_populations_v1 (
+        kind        TEXT NOT NULL,
+        bucket      TEXT NOT NULL,
+        population  INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (kind, bucket)
+    );
+    ALTER TABLE bucket_populations_v1 ADD COLUMN IF NOT EXISTS weight REAL NOT NULL DEFAULT 1;
+    ALTER TABLE bucket_populations_v1 ADD COLUMN IF NOT EXISTS draining BOOLEAN NOT NULL DEFAULT FALSE;
+
+    CREATE TABLE IF NOT EXISTS rendezvous_placements_v1 (
+        kind    TEXT NOT NULL,
+        name    TEXT NOT NULL,
+        bucket  TEXT NOT NULL,
+        PRIMARY KEY (kind, name)
+    );
+    CREATE INDEX IF NOT EXISTS rendezvous_placements_v1_kind_bucket_index ON rendezvous_placements_v1 (kind, bucket);
+    """
+
+    # Rows that might have been committed since a reader's watermark. Ids are
+    # handed out when rows are written rather than when they are committed, so
+    # they can not tell readers what they have already seen - see watermark.
+    ENTRIES_SINCE_SQL = """
+    SELECT name, bucket FROM entries_v1
+    WHERE kind=%s AND txid >= %s
+    ORDER BY txid, id
+    """
+
+    LOOKUP_SQL = """
+    SELECT bucket FROM entries_v1
+    WHERE kind=%(kind)s AND name=%(name)s
+    LIMIT 1
+    """
+
+    # Picks the least populated bucket (relative to its weight, and skipping
+    # draining buckets), records name as belonging to it and bumps its
+    # population - all in one statement. If we have live load information,
+    # preference lists buckets least loaded first, and takes priority. FOR UPDATE SKIP LOCKED makes
+    # concurrent assignments spread over different buckets rather than piling
+    # onto (and waiting for) whichever bucket they all saw as least populated.
+    ASSIGN_SQL = """
+    WITH picked AS (
+        SELECT bucket FROM bucket_populations_v1
+        WHERE kind=%(kind)s AND bucket = ANY(%(buckets)s) AND NOT draining AND weight > 0
+        ORDER BY array_position(%(preference)s::text[], bucket), population / weight, bucket
+        LIMIT 1
+        {lock}
+    ), inserted AS (
+        INSERT INTO entries_v1 (name, kind, bucket)
+        SELECT %(name)s, %(kind)s, bucket FROM picked
+        ON CONFLICT (kind, name) DO NOTHING
+        RETURNING bucket
+    ), counted AS (
+        UPDATE bucket_populations_v1 SET population = bucket_populations_v1.population + 1
+        FROM inserted
+        WHERE bucket_populations_v1.kind=%(kind)s AND bucket_populations_v1.bucket = inserted.bucket
+    )
+    SELECT (SELECT bucket FROM picked), (SELECT bucket FROM inserted)
     """
-    def __init__(self, hostname, username, password, dbname, kind, buckets, log):
+
+    # Pins names hashed to bucket as overrides, so they stay put while it drains
+    PIN_PLACEMENTS_SQL = """
+    WITH inserted AS (
+        INSERT INTO entries_v1 (name, kind, bucket)
+        SELECT name, kind, bucket FROM rendezvous_placements_v1
+        WHERE kind=%(kind)s AND bucket=%(bucket)s
+        ON CONFLICT (kind, name) DO NOTHING
+        RETURNING bucket
+    )
+    UPDATE bucket_populations_v1 SET population = population + (SELECT count(*) FROM inserted)
+    WHERE kind=%(kind)s AND bucket=%(bucket)s
+    """
+
+    # Pins names to the given buckets as overrides, unless they already have one
+    PIN_NAMES_SQL = """
+    WITH inserted AS (
+        INSERT INTO entries_v1 (name, kind, bucket)
+        SELECT unnest(%(names)s::text[]), %(kind)s, unnest(%(buckets)s::text[])
+        ON CONFLICT (kind, name) DO NOTHING
+        RETURNING bucket
+    )
+    UPDATE bucket_populations_v1 SET population = bucket_populations_v1.population + added.count
+    FROM (SELECT bucket, count(*) AS count FROM inserted GROUP BY bucket) AS added
+    WHERE bucket_populations_v1.kind=%(kind)s AND bucket_populations_v1.bucket = added.bucket
+    """
+
+    # Server side prepared versions of the hot queries, for the synchronous pool
+    LOOKUP_PREPARE, LOOKUP_EXECUTE = prepared('sharder_lookup', LOOKUP_SQL, [
+        ('kind', 'text'), ('name', 'text')
+    ])
+    ASSIGN_PREPARE, ASSIGN_EXECUTE = prepared('sharder_assign_{lock_name}', ASSIGN_SQL, [
+        ('kind', 'text'), ('name', 'text'), ('buckets', 'text[]'), ('preference', 'text[]')
+    ])
+    ASSIGN_LOCKS = {
+        'skip_locked': 'FOR UPDATE SKIP LOCKED',
+        'wait': 'FOR UPDATE',
+    }
+
+    def __init__(
+            self, hostname, username, password, dbname, kind, buckets, log,
+            cache_size=100000, preload=False, placement='least-loaded', override_refresh_interval=60,
+            placement_flush_interval=5, cache_refresh_interval=60,
+            bucket_settings=None, load_signal=None, load_poll_interval=15,
+            pool_size=4, pool_timeout=10, connect_timeout=5, replica_dsn=None, replica_timeout=2,
+            snapshot_path=None, snapshot_refresh_interval=None, snapshot_check_interval=30,
+            observers=(), log_level=logging.INFO, log_sample_rate=1
+    ):
+        if placement not in ('least-loaded', 'rendezvous'):
+            raise ValueError(f'Unknown placement {placement}')
         self.buckets = buckets
         self.kind = kind
         self.log = log
+        self.observers = list(observers)
+        self.log_level = log_level
+        self.log_sample_rate = log_sample_rate
+        self.cache = AssignmentCache(cache_size)
+        self.cache_refresh_interval = cache_refresh_interval
+        self._cache_watermark = 0
+        self._cache_refreshed_at = time.monotonic()
+        self._cache_lock = threading.Lock()
+        self.inflight = SingleFlight()
+
+        self.placement = placement
+        self.override_refresh_interval = override_refresh_interval
+        self.overrides = {}
+        self._overrides_watermark = 0
+        self._overrides_refreshed_at = 0
+        self._overrides_lock = threading.Lock()
+        # Hashed placements already recorded, and ones waiting to be
+        self._placed = AssignmentCache(cache_size)
+        self._unrecorded = {}
+        self._unrecorded_lock = threading.Lock()
+
+        self.bucket_settings = bucket_settings or {}
+        self.weights = {}
+        self.draining = set()
+        self.unhealthy = frozenset()
+
+        self.load = None
+        self._assigned_since_poll = {}
+        self._assigned_polled_at = 0
+        if load_signal is not None:
+            self.load = PolledLoad(load_signal, log, load_poll_interval)
+
+        # The schema has to exist before any statements can be prepared, so set it
+        # up over a connection of its own
+        conn = psycopg2.connect(
+            user=username, host=hostname, password=password, dbname=dbname, connect_timeout=connect_timeout
+        )
+        try:
+            with conn.cursor() as cur:
+                cur.execute(self.SCHEMA)
+                conn.commit()
+                self.migrate(cur)
+                conn.commit()
+                # Anything assigned from here on is picked up by refresh_cache
+                self._cache_watermark = self.watermark(cur)
+                conn.commit()
+        finally:
+            conn.close()
+
+        prepare = [self.LOOKUP_PREPARE] + [
+            self.ASSIGN_PREPARE.format(lock_name=lock_name, lock=lock)
+            for lock_name, lock in self.ASSIGN_LOCKS.items()
+        ]
+        self.pool = ConnectionPool(
+            pool_size, pool_timeout, prepare=prepare,
+            user=username, host=hostname, password=password, dbname=dbname, connect_timeout=connect_timeout
+        )
+        self.replica_pool = None
+        self.replica_timeout = replica_timeout
+        if replica_dsn is not None:
+            self.replica_pool = ConnectionPool(
+                pool_size, replica_timeout, prepare=[self.LOOKUP_PREPARE],
+                dsn=replica_dsn, user=username, password=password, dbname=dbname,
+                **self.replica_connect_kwargs()
+            )
+
+        self.snapshot = None
+        self.snapshot_path = snapshot_path
+        self.snapshot_check_interval = snapshot_check_interval
+        self._snapshot_checked_at = 0
+        if snapshot_path is not None:
+            self._check_snapshot()
+            if snapshot_refresh_interval is not None:
+                threading.Thread(
+                    target=self._refresh_snapshot_forever,
+                    args=(snapshot_refresh_interval, ),
+                    daemon=True
+                ).start()
+
+        if self.placement == 'rendezvous':
+            self.refresh_overrides()
+            threading.Thread(
+                target=self._record_placements_forever,
+                args=(placement_flush_interval, ),
+                daemon=True
+            ).start()
+        elif preload:
+            self.preload()
+
+    def replica_connect_kwargs(self):
+        """
+        libpq connection parameters limiting how long the replica can hold us up.
+        """
+        # libpq only takes whole seconds, and treats anything under 2 as 2
+        return {
+            'connect_timeout': max(2, math.ceil(self.replica_timeout)),
+            'options': f'-c statement_timeout={int(self.replica_timeout * 1000)}',
+        }
+
+    def migrate(self, cur):
+        """
+        Make sure bucket_populations_v1 has a row for every bucket of our kind.
+
+        The first time a kind is seen, populations are seeded from the existing
+        rows in entries_v1. Older versions of the sharder kept a 'dummy-{bucket}'
+        row in entries_v1 for every bucket so that empty buckets showed up in
+        the GROUP BY - those are not counted, and are no longer created.
+        """
+        # Make sure multiple sharders starting at once do not double count
+        cur.execute('LOCK TABLE bucket_populations_v1 IN SHARE ROW EXCLUSIVE MODE')
+        cur.execute("""
+        SELECT 1 FROM bucket_populations_v1 WHERE kind=%s LIMIT 1
+        """, (self.kind, ))
+        if cur.fetchone() is None:
+            cur.execute("""
+            INSERT INTO bucket_populations_v1 (kind, bucket, population)
+            SELECT kind, bucket, count(*) FROM entries_v1
+            WHERE kind=%s AND name != 'dummy-' || bucket
+            GROUP BY kind, bucket
+            """, (self.kind, ))
+            self.log.info(f'Seeded {cur.rowcount} {self.kind} bucket populations from entries_v1')
+
+        for bucket in self.buckets:
+            cur.execute("""
+            INSERT INTO bucket_populations_v1 (kind, bucket, population)
+            VALUES (%s, %s, 0)
+            ON CONFLICT DO NOTHING
+            """, (self.kind, bucket))
+
+        for bucket, settings in self.bucket_settings.items():
+            self._set_bucket(cur, bucket, settings.get('weight'), settings.get('draining'))
+        self._load_bucket_settings(cur)
 
-        self.pool = psycopg2.pool.ThreadedConnectionPool(1, 4, user=username, host=hostname, password=password, dbname=dbname)
-        with self.pool.getconn() as conn:
+    def _set_bucket(self, cur, bucket, weight=None, draining=None):
+        if weight is not None:
+            self._pin_reweighted_placements(cur, bucket, weight)
+            cur.execute("""
+            UPDATE bucket_populations_v1 SET weight=%s
+            WHERE kind=%s AND bucket=%s
+            """, (weight, self.kind, bucket))
+        if draining is not None:
+            cur.execute("""
+            UPDATE bucket_populations_v1 SET draining=%s
+            WHERE kind=%s AND bucket=%s
+            """, (draining, self.kind, bucket))
+        if draining:
+            # Does nothing unless we have been using rendezvous placement
+            cur.execute(self.PIN_PLACEMENTS_SQL, {'kind': self.kind, 'bucket': bucket})
+
+    def _pin_reweighted_placements(self, cur, bucket, weight):
+        """
+        Pin names that rendezvous placement would move if bucket's weight changed to weight.
+
+        Their data is wherever they were hashed to before, so they stay there.
+        Does nothing unless we have been using rendezvous placement.
+        """
+        cur.execute("""
+        SELECT bucket, weight FROM bucket_populations_v1
+        WHERE kind=%s
+        """, (self.kind, ))
+        weights = dict(cur.fetchall())
+        if weights.get(bucket, 1) == weight:
+            return
+        buckets_before = [b for b in self.buckets if weights.get(b, 1) > 0]
+        weights[bucket] = weight
+        buckets_after = [b for b in self.buckets if weights.get(b, 1) > 0]
+
+        cur.execute("""
+        SELECT name, bucket FROM rendezvous_placements_v1
+        WHERE kind=%s
+        """, (self.kind, ))
+        moved = [
+            (name, placed) for name, placed in cur.fetchall()
+            if placed in buckets_before and rendezvous_bucket(name, buckets_after, weights) != placed
+        ] if buckets_after else []
+        if moved:
+            cur.execute(self.PIN_NAMES_SQL, {
+                'kind': self.kind,
+                'names': [name for name, placed in moved],
+                'buckets': [placed for name, placed in moved],
+            })
+            self.log.info(f'Pinned {len(moved)} {self.kind} names that changing the weight of {bucket} would move')
+
+    def _load_bucket_settings(self, cur):
+        cur.execute("""
+        SELECT bucket, weight, draining FROM bucket_populations_v1
+        WHERE kind=%s
+        """, (self.kind, ))
+        rows = cur.fetchall()
+        self.weights = {bucket: weight for bucket, weight, draining in rows}
+        self.draining = {bucket for bucket, weight, draining in rows if draining}
+
+    def set_bucket(self, bucket, weight=None, draining=None):
+        """
+        Set the capacity weight of bucket and / or whether it is draining.
+        """
+        conn = self.pool.getconn()
+        try:
+            with conn:
+                with conn.cursor() as cur:
+                    self._set_bucket(cur, bucket, weight, draining)
+                    self._load_bucket_settings(cur)
+                conn.commit()
+        finally:
+            self.pool.putconn(conn)
+
+    def recount(self):
+        """
+        Recompute bucket populations for our kind from entries_v1.
+
+        Populations are maintained in the same transaction as every assignment, so
+        this is only needed if entries_v1 was modified by something else (such as
+        an older sharder still running during a rollout).
+        """
+        conn = self.pool.getconn()
+        try:
+            with conn:
+                with conn.cursor() as cur:
+                    cur.execute("""
+                    SELECT bucket FROM bucket_populations_v1 WHERE kind=%s FOR UPDATE
+                    """, (self.kind, ))
+                    cur.execute("""
+                    UPDATE bucket_populations_v1 SET population = (
+                        SELECT count(*) FROM entries_v1
+                        WHERE entries_v1.kind=bucket_populations_v1.kind
+                        AND entries_v1.bucket=bucket_populations_v1.bucket
+                        AND entries_v1.name != 'dummy-' || entries_v1.bucket
+                    )
+                    WHERE kind=%s
+                    """, (self.kind, ))
+                conn.commit()
+        finally:
+            self.pool.putconn(conn)
+
+    def preload(self):
+        """
+        Stream all existing assignments for this kind into the cache.
+
+        Uses a server side cursor, so we never hold the full result set in memory
+        at once. Only the most recent cache_size rows will be retained.
+        """
+        count = 0
+        pool = self.replica_pool or self.pool
+        conn = pool.getconn()
+        try:
+            with conn:
+                with conn.cursor(name='sharder_preload') as cur:
+                    cur.itersize = 10000
+                    cur.execute("""
+                    SELECT name, bucket FROM entries_v1
+                    WHERE kind=%s
+                    ORDER BY id
+                    """, (self.kind, ))
+                    for name, bucket in cur:
+                        self.cache.put(name, bucket)
+                        count += 1
+        finally:
+            pool.putconn(conn)
+        self.log.info(f'Preloaded {count} {self.kind} assignments into cache')
+
+    def watermark(self, cur):
+        """
+        Oldest transaction still in progress, for reading entries_v1 incrementally.
+
+        Every row written before it is committed, and visible to statements run
+        after this one. So readers of ENTRIES_SINCE_SQL only need to look at rows
+        from it onwards next time - which includes rows written by transactions
+        in progress now, however much later they commit.
+        """
+        cur.execute('SELECT txid_snapshot_xmin(txid_current_snapshot())')
+        return cur.fetchone()[0]
+
+    def refresh_cache(self):
+        """
+        Fetch assignments made (or changed) since we last looked into the cache.
+        """
+        pool = self.replica_pool or self.pool
+        conn = pool.getconn()
+        try:
+            with conn:
+                with conn.cursor() as cur:
+                    watermark = self.watermark(cur)
+                    cur.execute(self.ENTRIES_SINCE_SQL, (self.kind, self._cache_watermark))
+                    rows = cur.fetchall()
+        finally:
+            pool.putconn(conn)
+
+        for name, bucket in rows:
+            self.cache.put(name, bucket)
+        self._cache_watermark = watermark
+        self._cache_refreshed_at = time.monotonic()
+
+    def _refresh_cache_in_background(self):
+        if time.monotonic() - self._cache_refreshed_at < self.cache_refresh_interval:
+            return
+        if not self._cache_lock.acquire(blocking=False):
+            # Already being refreshed
+            return
+
+        def refresh():
             try:
+                self.refresh_cache()
+            except Exception:
+                # Keep serving from what we have, and try again later
+                self._cache_refreshed_at = time.monotonic()
+                self.log.exception(f'Refreshing {self.kind} cache failed')
+            finally:
+                self._cache_lock.release()
+        threading.Thread(target=refresh, daemon=True).start()
+
+    def export_snapshot(self, path):
+        """
+        Write every assignment of our kind to an AssignmentSnapshot at path.
+
+        If path already holds a snapshot of our kind, only rows added (or
+        reassigned) since it was taken are fetched.
+        """
+        assignments = {}
+        since = 0
+        if os.path.exists(path):
+            try:
+                snapshot = AssignmentSnapshot(path)
+            except (OSError, ValueError, struct.error):
+                self.log.exception(f'Could not open snapshot {path}, writing a new one')
+            else:
+                if snapshot.kind == self.kind:
+                    assignments.update(snapshot.items())
+                    since = snapshot.watermark
+                snapshot.close()
+
+        count = 0
+        pool = self.replica_pool or self.pool
+        conn = pool.getconn()
+        try:
+            with conn:
                 with conn.cursor() as cur:
-                    cur.execute(self.SCHEMA)
-                    conn.commit()
+                    watermark = self.watermark(cur)
+                with conn.cursor(name='sharder_snapshot') as cur:
+                    cur.itersize = 10000
+                    cur.execute(self.ENTRIES_SINCE_SQL, (self.kind, since))
+                    for name, bucket in cur:
+                        assignments[name] = bucket
+                        count += 1
+        finally:
+            pool.putconn(conn)
 
-                    # Make sure that we have at least one dummy entry for each fileserver
-                    for bucket in buckets:
-                        cur.execute("""
-                        INSERT INTO entries_v1(kind, bucket, name)
-                        VALUES(%s, %s, %s)
-                        ON CONFLICT DO NOTHING
-                        """, (self.kind, bucket, f'dummy-{bucket}'))
-                        conn.commit()
+        AssignmentSnapshot.write(path, self.kind, watermark, assignments)
+        self.log.info(f'Wrote {len(assignments)} {self.kind} assignments ({count} new) to {path}')
+
+    def refresh_snapshot(self, interval):
+        """
+        Bring the snapshot up to date, unless it was written in the last interval seconds.
+
+        Every process sharing the snapshot calls this, so only whichever gets
+        there first in each interval rewrites it. Returns True if it did.
+        """
+        with open(self.snapshot_path + '.lock', 'w') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Someone else sharing the snapshot is refreshing it
+                return False
+            try:
+                age = time.time() - os.stat(self.snapshot_path).st_mtime
+            except FileNotFoundError:
+                age = None
+            if age is not None and age < interval:
+                return False
+            self.export_snapshot(self.snapshot_path)
+            return True
+
+    def _refresh_snapshot_forever(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.refresh_snapshot(interval)
+            except Exception:
+                self.log.exception(f'Refreshing snapshot {self.snapshot_path} failed')
+
+    def _check_snapshot(self):
+        """
+        Open the snapshot file, or re-open it if it has been replaced.
+        """
+        self._snapshot_checked_at = time.monotonic()
+        try:
+            stat = os.stat(self.snapshot_path)
+        except FileNotFoundError:
+            return
+        if self.snapshot is not None and (stat.st_ino, stat.st_mtime) == (self.snapshot.stat.st_ino, self.snapshot.stat.st_mtime):
+            return
+        try:
+            # Lookups in flight keep using the old mapping until they finish
+            self.snapshot = AssignmentSnapshot(self.snapshot_path)
+        except (OSError, ValueError, struct.error):
+            self.log.exception(f'Could not open snapshot {self.snapshot_path}')
+            return
+        if self.snapshot.kind != self.kind:
+            self.log.error(f'Snapshot {self.snapshot_path} is for {self.snapshot.kind}, not {self.kind}')
+            self.snapshot = None
+
+    def snapshot_lookup(self, name):
+        if self.snapshot_path is None:
+            return None
+        if time.monotonic() - self._snapshot_checked_at > self.snapshot_check_interval:
+            self._check_snapshot()
+        if self.snapshot is None:
+            return None
+        return self.snapshot.get(name)
+
+    def refresh_overrides(self):
+        """
+        Fetch overrides added since we last looked, when in rendezvous placement.
+
+        Bucket weights and draining state are refreshed too.
+        """
+        pool = self.replica_pool or self.pool
+        conn = pool.getconn()
+        try:
+            with conn:
+                with conn.cursor() as cur:
+                    watermark = self.watermark(cur)
+                    cur.execute(self.ENTRIES_SINCE_SQL, (self.kind, self._overrides_watermark))
+                    rows = cur.fetchall()
+                    self._load_bucket_settings(cur)
+                conn.commit()
+        finally:
+            pool.putconn(conn)
+
+        # Rows from transactions that were in progress last time are read again
+        new = [(name, bucket) for name, bucket in rows if self.overrides.get(name) != bucket]
+        for name, bucket in new:
+            self.overrides[name] = bucket
+        self._overrides_watermark = watermark
+        self._overrides_refreshed_at = time.monotonic()
+        if new:
+            self.log.info(f'Loaded {len(new)} new {self.kind} overrides')
+
+    def _refresh_overrides_in_background(self):
+        if time.monotonic() - self._overrides_refreshed_at < self.override_refresh_interval:
+            return
+        if not self._overrides_lock.acquire(blocking=False):
+            # Already being refreshed
+            return
+
+        def refresh():
+            try:
+                self.refresh_overrides()
+            except Exception:
+                # Keep serving from what we have, and try again later
+                self._overrides_refreshed_at = time.monotonic()
+                self.log.exception(f'Refreshing {self.kind} overrides failed')
             finally:
-                self.pool.putconn(conn)
+                self._overrides_lock.release()
+        threading.Thread(target=refresh, daemon=True).start()
 
-    def shard(self, name):
+    def hashed_shard(self, name):
         """
-        Return the bucket where name should be placed.
+        Return the bucket for name under rendezvous placement, without blocking on the database.
+        """
+        self._refresh_overrides_in_background()
+        bucket = self.overrides.get(name)
+        if bucket is not None:
+            return bucket
+        # Draining buckets are hashed over too, so draining one does not move
+        # anyone already there
+        buckets = [b for b in self.buckets if self.weights.get(b, 1) > 0]
+        if not buckets:
+            raise NoBucketAvailable(f'No {self.kind} buckets are accepting new entries')
+        bucket = rendezvous_bucket(name, buckets, self.weights)
+        placed = self._last_placement(name)
+        if placed in self.buckets and (placed != bucket or placed in self.draining):
+            # Placed by us before the buckets were reweighted or drained, but
+            # not recorded in time to be pinned then
+            self._record_placement(name, placed, pin=True)
+            return placed
+        if bucket not in self.draining:
+            self._record_placement(name, bucket)
+            return bucket
 
-        If it already isn't in the database, a new entry will be created in the database,
-        placing it in the currently least populated bucket.
+        # Everyone known to be placed here was pinned when it started draining,
+        # so this is someone new. Pin them wherever they go instead, so they
+        # stay there once it stops.
+        candidates = [b for b in buckets if b not in self.draining]
+        if not candidates:
+            raise NoBucketAvailable(f'All {self.kind} buckets are draining')
+        bucket = rendezvous_bucket(name, candidates, self.weights)
+        self._record_placement(name, bucket, pin=True)
+        return bucket
+
+    def _last_placement(self, name):
+        with self._unrecorded_lock:
+            pending = self._unrecorded.get(name)
+        if pending is not None:
+            return pending[0]
+        return self._placed.get(name)
+
+    def _record_placement(self, name, bucket, pin=False):
+        if not pin and self._placed.get(name) == bucket:
+            return
+        with self._unrecorded_lock:
+            self._unrecorded[name] = (bucket, pin)
+
+    def record_placements(self):
         """
-        with self.pool.getconn() as conn:
+        Write hashed placements made since we last did so, under rendezvous placement.
+        """
+        with self._unrecorded_lock:
+            pending, self._unrecorded = self._unrecorded, {}
+        if not pending:
+            return
+        placed = [(name, bucket) for name, (bucket, pin) in pending.items() if not pin]
+        pinned = [(name, bucket) for name, (bucket, pin) in pending.items() if pin]
+        try:
+            conn = self.pool.getconn()
+            try:
+                with conn:
+                    with conn.cursor() as cur:
+                        if placed:
+                            cur.execute("""
+                            INSERT INTO rendezvous_placements_v1 (kind, name, bucket)
+                            SELECT %(kind)s, unnest(%(names)s::text[]), unnest(%(buckets)s::text[])
+                            ON CONFLICT (kind, name) DO UPDATE SET bucket=EXCLUDED.bucket
+                            """, {
+                                'kind': self.kind,
+                                'names': [name for name, bucket in placed],
+                                'buckets': [bucket for name, bucket in placed],
+                            })
+                        if pinned:
+                            cur.execute(self.PIN_NAMES_SQL, {
+                                'kind': self.kind,
+                                'names': [name for name, bucket in pinned],
+                                'buckets': [bucket for name, bucket in pinned],
+                            })
+            finally:
+                self.pool.putconn(conn)
+        except Exception:
+            # Try again next time, unless they have been placed again since
+            with self._unrecorded_lock:
+                for name, record in pending.items():
+                    self._unrecorded.setdefault(name, record)
+            raise
+        for name, (bucket, pin) in pending.items():
+            self._placed.put(name, bucket)
+
+    def _record_placements_forever(self, interval):
+        while True:
+            time.sleep(interval)
             try:
+                self.record_placements()
+            except Exception:
+                self.log.exception(f'Recording {self.kind} placements failed')
+
+    def reassign(self, name, bucket):
+        """
+        Explicitly place name in bucket, overriding any existing assignment.
+
+        The row is marked with our transaction, so incremental readers of
+        entries_v1 (cache and override refreshes, snapshots) see the change.
+        Other processes keep using the old assignment until they next refresh,
+        up to cache_refresh_interval (or override_refresh_interval) seconds later.
+        """
+        conn = self.pool.getconn()
+        try:
+            with conn:
                 with conn.cursor() as cur:
                     cur.execute("""
                     SELECT bucket FROM entries_v1
                     WHERE kind=%s AND name=%s
-                    LIMIT 1
+                    FOR UPDATE
                     """, (self.kind, name))
                     row = cur.fetchone()
+                    cur.execute("""
+                    INSERT INTO entries_v1 (name, kind, bucket)
+                    VALUES (%s, %s, %s)
+                    ON CONFLICT (kind, name) DO UPDATE SET bucket=EXCLUDED.bucket, id=EXCLUDED.id, txid=txid_current()
+                    """, (name, self.kind, bucket))
+                    cur.execute("""
+                    UPDATE bucket_populations_v1 SET population = population + 1
+                    WHERE kind=%s AND bucket=%s
+                    """, (self.kind, bucket))
+                    if row:
+                        cur.execute("""
+                        UPDATE bucket_populations_v1 SET population = population - 1
+                        WHERE kind=%s AND bucket=%s
+                        """, (self.kind, row[0]))
+                conn.commit()
+        finally:
+            self.pool.putconn(conn)
+        self.cache.put(name, bucket)
+        self.overrides[name] = bucket
+        self.log.info(f'Reassigned {name} to bucket {bucket}')
+
+    def set_unhealthy(self, buckets):
+        """
+        Stop assigning new entries to buckets, and go back to assigning to any others.
+        """
+        unhealthy = frozenset(buckets)
+        if unhealthy != self.unhealthy:
+            self.log.warning(f'Unhealthy {self.kind} buckets are now {sorted(unhealthy)}')
+        self.unhealthy = unhealthy
+
+    def assign_params(self, name):
+        """
+        Parameters for ASSIGN_SQL when assigning name.
+        """
+        buckets = self.buckets
+        if self.unhealthy:
+            buckets = [b for b in self.buckets if b not in self.unhealthy] or self.buckets
+        preference = []
+        if self.load is not None:
+            loads = self.load.loads
+            if loads:
+                preference = load_preference(
+                    buckets, loads, self.weights, self.assigned_since_poll(), self.load.signal.per_entry
+                )
+        return {
+            'kind': self.kind,
+            'name': name,
+            'buckets': buckets,
+            'preference': preference,
+        }
+
+    def assigned_since_poll(self):
+        """
+        Count of new entries per bucket since load was last polled.
+        """
+        if self._assigned_polled_at != self.load.polled_at:
+            self._assigned_since_poll = {}
+            self._assigned_polled_at = self.load.polled_at
+        return self._assigned_since_poll
+
+    def assigned(self, bucket):
+        """
+        Account for a new entry in bucket, until the next time load is polled.
+        """
+        if self.load is None:
+            return
+        assigned = self.assigned_since_poll()
+        assigned[bucket] = assigned.get(bucket, 0) + 1
+
+    def observe(self, phase, seconds):
+        """
+        Report that phase of a shard call took seconds to our observers.
+        """
+        for observer in self.observers:
+            observer.phase(self.kind, phase, seconds)
+
+    @contextmanager
+    def timed(self, phase):
+        """
+        Report how long the body of the with statement took to our observers, as phase.
+        """
+        if not self.observers:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(phase, time.perf_counter() - start)
+
+    def answered(self, event, name, bucket):
+        """
+        Report how a shard call for name was answered to our observers, and maybe log it.
+        """
+        for observer in self.observers:
+            observer.event(self.kind, event, bucket)
+        if event not in ('lookup', 'assign') or not self.log.isEnabledFor(self.log_level):
+            return
+        if self.log_sample_rate < 1 and random.random() >= self.log_sample_rate:
+            return
+        if event == 'assign':
+            self.log.log(self.log_level, f'Sharded {name} to bucket {bucket}')
+        else:
+            self.log.log(self.log_level, f'Found {name} sharded to bucket {bucket}')
+
+    def shard(self, name):
+        """
+        Return the bucket where name should be placed.
+
+        If it already isn't in the database, a new entry will be created in the database,
+        placing it in the currently least populated bucket.
+        """
+        if self.placement == 'rendezvous':
+            bucket = self.hashed_shard(name)
+            self.answered('hashed', name, bucket)
+            return bucket
+        self._refresh_cache_in_background()
+        bucket = self.cache.get(name)
+        if bucket is not None:
+            self.answered('cache_hit', name, bucket)
+            return bucket
+        bucket = self.snapshot_lookup(name)
+        if bucket is not None:
+            self.answered('snapshot_hit', name, bucket)
+            return bucket
+        return self.inflight.do(name, self._shard, name)
+
+    def _lookup_replica(self, name):
+        try:
+            with self.timed('checkout'):
+                conn = self.replica_pool.getconn()
+        except (psycopg2.Error, PoolTimeout):
+            self.log.warning(f'Could not reach read replica to look up {name}', exc_info=True)
+            return None
+        try:
+            with conn:
+                with conn.cursor() as cur, self.timed('replica_lookup'):
+                    cur.execute(self.LOOKUP_EXECUTE, {'kind': self.kind, 'name': name})
+                    row = cur.fetchone()
+                    return row[0] if row else None
+        except psycopg2.Error:
+            self.log.warning(f'Could not reach read replica to look up {name}', exc_info=True)
+            return None
+        finally:
+            self.replica_pool.putconn(conn)
+
+    def _shard(self, name):
+        if self.replica_pool is not None:
+            bucket = self._lookup_replica(name)
+            if bucket is not None:
+                self.cache.put(name, bucket)
+                self.answered('lookup', name, bucket)
+                return bucket
+
+        with self.timed('checkout'):
+            conn = self.pool.getconn()
+        try:
+            with conn:
+                with conn.cursor() as cur:
+                    with self.timed('lookup'):
+                        cur.execute(self.LOOKUP_EXECUTE, {'kind': self.kind, 'name': name})
+                        row = cur.fetchone()
                     if row:
                         bucket = row[0]
-                        self.log.info(f'Found {name} sharded to bucket {bucket}')
+                        self.cache.put(name, bucket)
+                        self.answered('lookup', name, bucket)
+                        return bucket
+
+                    # Insert the data! If every candidate bucket is locked by other
+                    # concurrent assignments, wait for one instead of skipping.
+                    with self.timed('assign'):
+                        for lock_name in ('skip_locked', 'wait'):
+                            cur.execute(self.ASSIGN_EXECUTE.format(lock_name=lock_name), self.assign_params(name))
+                            picked, bucket = cur.fetchone()
+                            if picked is not None:
+                                break
+                    with self.timed('commit'):
+                        conn.commit()
+
+                    if picked is None:
+                        raise NoBucketAvailable(f'No {self.kind} buckets are accepting new entries')
+
+                    if bucket is None:
+                        # Someone else assigned name between our SELECT and INSERT
+                        with self.timed('lookup'):
+                            cur.execute(self.LOOKUP_EXECUTE, {'kind': self.kind, 'name': name})
+                            bucket = cur.fetchone()[0]
+                        conn.commit()
+                        self.cache.put(name, bucket)
+                        self.answered('lookup', name, bucket)
                         return bucket
 
-                    # Insert the data!
+                    self.assigned(bucket)
+                    self.cache.put(name, bucket)
+                    self.answered('assign', name, bucket)
+                    return bucket
+        finally:
+            self.pool.putconn(conn)
+
+    def shard_many(self, names):
+        """
+        Return a dict of name -> bucket for every name in names.
+
+        Names already in the database keep their bucket. New names are spread across
+        the least populated buckets, exactly as calling shard on each of them in turn
+        would. Unlike calling shard in a loop, this takes a constant number of
+        round trips to the database no matter how many names there are.
+        """
+        # Preserve order so new names are assigned deterministically
+        names = list(OrderedDict.fromkeys(names))
+        if self.placement == 'rendezvous':
+            return {name: self.hashed_shard(name) for name in names}
+        assignments = {}
+        conn = self.pool.getconn()
+        try:
+            with conn:
+                with conn.cursor() as cur:
                     cur.execute("""
-                    INSERT INTO entries_v1 (name, kind, bucket)
-                    VALUES(
-                        %s,
-                        %s,
-                        (SELECT bucket FROM entries_v1 WHERE kind=%s GROUP BY bucket ORDER BY count(bucket) LIMIT 1)
-                    ) RETURNING bucket;
-                    """, (name, self.kind, self.kind))
-                    conn.commit()
-                    bucket = cur.fetchone()[0]
-                    self.log.info(f'Sharded {name} to bucket {bucket}')
+                    SELECT name, bucket FROM entries_v1
+                    WHERE kind=%s AND name = ANY(%s)
+                    """, (self.kind, names))
+                    assignments.update(cur.fetchall())
+
+                    new_names = [n for n in names if n not in assignments]
+                    if new_names:
+                        # Lock every bucket for the duration, so concurrent single
+                        # assignments do not throw our balancing off
+                        cur.execute("""
+                        SELECT bucket, population, weight FROM bucket_populations_v1
+                        WHERE kind=%s AND bucket = ANY(%s) AND NOT draining AND weight > 0
+                        FOR UPDATE
+                        """, (self.kind, self.buckets))
+                        rows = cur.fetchall()
+                        if not rows:
+                            raise NoBucketAvailable(f'No {self.kind} buckets are accepting new entries')
+                        weights = {bucket: weight for bucket, population, weight in rows}
+                        loads = [(population / weight, bucket, population) for bucket, population, weight in rows]
+                        heapq.heapify(loads)
+
+                        new_buckets = []
+                        for name in new_names:
+                            load, bucket, population = heapq.heappop(loads)
+                            new_buckets.append(bucket)
+                            heapq.heappush(loads, ((population + 1) / weights[bucket], bucket, population + 1))
+
+                        cur.execute("""
+                        WITH inserted AS (
+                            INSERT INTO entries_v1 (name, kind, bucket)
+                            SELECT unnest(%(names)s::text[]), %(kind)s, unnest(%(buckets)s::text[])
+                            ON CONFLICT (kind, name) DO NOTHING
+                            RETURNING name, bucket
+                        ), counted AS (
+                            UPDATE bucket_populations_v1 SET population = bucket_populations_v1.population + added.count
+                            FROM (SELECT bucket, count(*) AS count FROM inserted GROUP BY bucket) AS added
+                            WHERE bucket_populations_v1.kind=%(kind)s AND bucket_populations_v1.bucket = added.bucket
+                        )
+                        SELECT name, bucket FROM inserted
+                        """, {'names': new_names, 'kind': self.kind, 'buckets': new_buckets})
+                        inserted = dict(cur.fetchall())
+                        assignments.update(inserted)
+
+                        # Someone else assigned these between our SELECT and INSERT
+                        raced = [n for n in new_names if n not in inserted]
+                        if raced:
+                            cur.execute("""
+                            SELECT name, bucket FROM entries_v1
+                            WHERE kind=%s AND name = ANY(%s)
+                            """, (self.kind, raced))
+                            assignments.update(cur.fetchall())
+                        self.log.info(f'Sharded {len(inserted)} new {self.kind} entries')
+                conn.commit()
+        finally:
+            self.pool.putconn(conn)
+
+        for name, bucket in assignments.items():
+            self.cache.put(name, bucket)
+        return assignments
+
+
+class _AsyncCheckout:
+    """
+    Async context manager holding a connection from one of AsyncSharder's aiopg pools.
+    """
+    def __init__(self, sharder, pool_future):
+        self.sharder = sharder
+        self.pool_future = pool_future
+
+    async def __aenter__(self):
+        self.pool = await self.pool_future
+        start = time.perf_counter()
+        try:
+            # aiopg bounds this (including connecting, if the pool has room to
+            # grow) by the pool's timeout
+            self.conn = await self.pool.acquire()
+        except asyncio.TimeoutError:
+            self.sharder.async_timeouts += 1
+            self.sharder.async_wait_time.observe(time.perf_counter() - start)
+            raise PoolTimeout(f'No database connection free after {self.pool.timeout}s')
+        self.sharder.async_wait_time.observe(time.perf_counter() - start)
+        return self.conn
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.pool.release(self.conn)
+
+
+class AsyncSharder(Sharder):
+    """
+    Sharder with a native coroutine shard(), backed by aiopg.
+
+    Concurrent calls to shard() each get their own connection from an async
+    pool of up to async_pool_size connections, so their database round trips
+    overlap on the event loop rather than queueing behind a single thread.
+    Like the synchronous pool, it waits at most pool_timeout seconds for a
+    connection, replaces connections older than its max_age, and prepares the
+    hot queries on every new connection.
+
+    Setup, preloading and bulk operations (shard_many, recount) are inherited
+    from Sharder and remain synchronous, since they are only used at startup
+    and from scripts.
+    """
+    def __init__(self, hostname, username, password, dbname, kind, buckets, log, async_pool_size=10, **kwargs):
+        if aiopg is None:
+            raise RuntimeError('aiopg must be installed to use AsyncSharder')
+        super().__init__(hostname, username, password, dbname, kind, buckets, log, **kwargs)
+        self.async_pool_size = async_pool_size
+        self._dsn = psycopg2.extensions.make_dsn(
+            user=username, host=hostname, password=password, dbname=dbname,
+            connect_timeout=kwargs.get('connect_timeout', 5)
+        )
+        self._async_pool = None
+        self._replica_dsn = None
+        self._async_replica_pool = None
+        if kwargs.get('replica_dsn') is not None:
+            self._replica_dsn = psycopg2.extensions.make_dsn(
+                kwargs['replica_dsn'], user=username, password=password, dbname=dbname,
+                **self.replica_connect_kwargs()
+            )
+        self._async_inflight = {}
+        self.async_wait_time = Histogram()
+        self.async_timeouts = 0
+
+    def _create_async_pool(self, dsn, prepare, timeout):
+        async def on_connect(conn):
+            async with conn.cursor() as cur:
+                for statement in prepare:
+                    await cur.execute(statement)
+
+        return aiopg.create_pool(
+            dsn, minsize=1, maxsize=self.async_pool_size,
+            timeout=timeout, pool_recycle=self.pool.max_age, on_connect=on_connect
+        )
+
+    async def get_async_pool(self):
+        # Created lazily, since it must be created on the running event loop.
+        # Concurrent callers all await the same future.
+        if self._async_pool is None:
+            self._async_pool = asyncio.ensure_future(self._create_async_pool(self._dsn, [self.LOOKUP_PREPARE] + [
+                self.ASSIGN_PREPARE.format(lock_name=lock_name, lock=lock)
+                for lock_name, lock in self.ASSIGN_LOCKS.items()
+            ], self.pool.timeout))
+        return await self._async_pool
+
+    async def get_async_replica_pool(self):
+        if self._async_replica_pool is None:
+            self._async_replica_pool = asyncio.ensure_future(
+                self._create_async_pool(self._replica_dsn, [self.LOOKUP_PREPARE], self.replica_timeout)
+            )
+        return await self._async_replica_pool
+
+    def acquire(self):
+        """
+        Check out a connection from the async pool, as an async context manager.
+
+        Raises PoolTimeout if none is free within pool_timeout seconds.
+        """
+        return _AsyncCheckout(self, self.get_async_pool())
+
+    def async_pool_stats(self):
+        """
+        Stats for the async pool, in the same shape as ConnectionPool.stats.
+        """
+        pool = None
+        if self._async_pool is not None and self._async_pool.done() and not self._async_pool.exception():
+            pool = self._async_pool.result()
+        size = pool.size if pool else 0
+        idle = pool.freesize if pool else 0
+        return {
+            'max_size': self.async_pool_size,
+            'size': size,
+            'in_use': size - idle,
+            'idle': idle,
+            'timeouts': self.async_timeouts,
+            'wait_seconds': self.async_wait_time.snapshot(),
+        }
+
+    async def close_async_pools(self):
+        """
+        Close the async connection pools, waiting for connections in use to be returned.
+        """
+        for pool in (self._async_pool, self._async_replica_pool):
+            if pool is not None and pool.done() and not pool.exception():
+                pool.result().close()
+                await pool.result().wait_closed()
+
+    async def _lookup_replica_async(self, name):
+        try:
+            checkout_started = time.perf_counter()
+            async with _AsyncCheckout(self, self.get_async_replica_pool()) as conn:
+                self.observe('checkout', time.perf_counter() - checkout_started)
+                async with conn.cursor() as cur:
+                    with self.timed('replica_lookup'):
+                        await cur.execute(self.LOOKUP_EXECUTE, {'kind': self.kind, 'name': name})
+                        row = await cur.fetchone()
+                    return row[0] if row else None
+        except (psycopg2.Error, PoolTimeout, asyncio.TimeoutError, OSError):
+            # Forget a pool that failed to come up, so we try again next time
+            if self._async_replica_pool.done() and self._async_replica_pool.exception():
+                self._async_replica_pool = None
+            self.log.warning(f'Could not reach read replica to look up {name}', exc_info=True)
+            return None
+
+    async def shard(self, name):
+        """
+        Return the bucket where name should be placed.
+
+        If it already isn't in the database, a new entry will be created in the database,
+        placing it in the currently least populated bucket.
+        """
+        if self.placement == 'rendezvous':
+            bucket = self.hashed_shard(name)
+            self.answered('hashed', name, bucket)
+            return bucket
+        self._refresh_cache_in_background()
+        bucket = self.cache.get(name)
+        if bucket is not None:
+            self.answered('cache_hit', name, bucket)
+            return bucket
+        bucket = self.snapshot_lookup(name)
+        if bucket is not None:
+            self.answered('snapshot_hit', name, bucket)
+            return bucket
+
+        future = self._async_inflight.get(name)
+        if future is None:
+            future = asyncio.ensure_future(self._shard_async(name))
+            self._async_inflight[name] = future
+            future.add_done_callback(lambda f: self._async_inflight.pop(name, None))
+        # Shield, so one caller going away does not cancel the lookup for everyone else
+        return await asyncio.shield(future)
+
+    async def _shard_async(self, name):
+        if self._replica_dsn is not None:
+            bucket = await self._lookup_replica_async(name)
+            if bucket is not None:
+                self.cache.put(name, bucket)
+                self.answered('lookup', name, bucket)
+                return bucket
+
+        # aiopg connections are always in autocommit mode. Every statement here is
+        # self contained, so that is exactly what we want - and there is no
+        # separate commit phase to time.
+        checkout_started = time.perf_counter()
+        async with self.acquire() as conn:
+            self.observe('checkout', time.perf_counter() - checkout_started)
+            async with conn.cursor() as cur:
+                with self.timed('lookup'):
+                    await cur.execute(self.LOOKUP_EXECUTE, {'kind': self.kind, 'name': name})
+                    row = await cur.fetchone()
+                if row:
+                    bucket = row[0]
+                    self.cache.put(name, bucket)
+                    self.answered('lookup', name, bucket)
                     return bucket
-            finally:
-                self.pool.putconn(conn)
\ No newline at end of file
+
+                with self.timed('assign'):
+                    for lock_name in ('skip_locked', 'wait'):
+                        await cur.execute(self.ASSIGN_EXECUTE.format(lock_name=lock_name), self.assign_params(name))
+                        picked, bucket = await cur.fetchone()
+                        if picked is not None:
+                            break
+
+                if picked is None:
+                    raise NoBucketAvailable(f'No {self.kind} buckets are accepting new entries')
+
+                if bucket is None:
+                    # Someone else assigned name between our SELECT and INSERT
+                    with self.timed('lookup'):
+                        await cur.execute(self.LOOKUP_EXECUTE, {'kind': self.kind, 'name': name})
+                        bucket = (await cur.fetchone())[0]
+                    self.cache.put(name, bucket)
+                    self.answered('lookup', name, bucket)
+                    return bucket
+
+                self.assigned(bucket)
+                self.cache.put(name, bucket)
+                self.answered('assign', name, bucket)
+                return bucket
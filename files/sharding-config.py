@@ -16,25 +16,56 @@ def setup_homedir_sharding():
 
     deployment = z2jh.get_config('custom.deployment')
     nfs_server_template = '{deployment}-{name}'
-    fileservers = [
-        nfs_server_template.format(deployment=deployment, name=name)
-        for name in yaml.safe_load(z2jh.get_config('custom.fileservers'))
-    ]
-    sharder = Sharder('localhost', username, password, dbname, 'homedir', fileservers, log.app_log)
+    fileserver_config = yaml.safe_load(z2jh.get_config('custom.fileservers'))
+    # Older configs are just a list of fileserver names, newer ones map each
+    # name to its sharding settings (weight, draining)
+    if isinstance(fileserver_config, list):
+        fileserver_config = {name: {} for name in fileserver_config}
+    bucket_settings = {
+        nfs_server_template.format(deployment=deployment, name=name): settings or {}
+        for name, settings in fileserver_config.items()
+    }
+    fileservers = list(bucket_settings)
+    # New home directories go to the emptiest fileserver, if the hub can see them
+    load_signal = None
+    if z2jh.get_config('custom.fileserver-load-signal'):
+        load_signal = FileserverUsageSignal(fileservers)
+    # Hubs on the same node share one memory mapped copy of every assignment,
+    # and take turns keeping it up to date
+    snapshot_path = None
+    snapshot_refresh_interval = None
+    if z2jh.get_config('custom.sharder-snapshot'):
+        snapshot_path = '/srv/sharder-snapshot/homedir.snapshot'
+        snapshot_refresh_interval = 300
+    # Prefer the asyncio native sharder when aiopg is available in the hub image,
+    # so concurrent spawns do not queue behind a single database thread.
+    sharder_class = Sharder if aiopg is None else AsyncSharder
+    sharder = sharder_class(
+        'localhost', username, password, dbname, 'homedir', fileservers, log.app_log,
+        bucket_settings=bucket_settings, load_signal=load_signal,
+        snapshot_path=snapshot_path, snapshot_refresh_interval=snapshot_refresh_interval
+    )
 
     allowed_external_hosts = z2jh.get_config('custom.allowed-external-hosts')
 
 
     class CustomSpawner(KubeSpawner):
-        _sharder_thread_pool = ThreadPoolExecutor(max_workers=1)
+        # One thread per pooled connection, so concurrent spawns do not queue
+        # up behind each other while connections sit idle. The stock hub image
+        # has no aiopg, so this is what is normally used.
+        _sharder_thread_pool = ThreadPoolExecutor(max_workers=sharder.pool.maxconn)
 
         @concurrent.run_on_executor(executor='_sharder_thread_pool')
-        def shard(self, username):
-            if hasattr(self, '_fileserver_shard'):
-                return self._fileserver_shard
+        def _shard_on_executor(self, username):
+            return sharder.shard(username)
 
-            self._fileserver_shard = sharder.shard(username)
-            return self._fileserver_shard
+        @gen.coroutine
+        def shard(self, username):
+            # Not kept on the spawner, so home directories moved by rebalance.py
+            # are picked up once the sharder's cache refreshes
+            if isinstance(sharder, AsyncSharder):
+                return (yield sharder.shard(username))
+            return (yield self._shard_on_executor(username))
 
         @gen.coroutine
         def start(self):
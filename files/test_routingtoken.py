@@ -0,0 +1,74 @@
+import base64
+
+from routingtoken import RoutingTokenSigner
+
+
+def test_issue_and_verify():
+    signer = RoutingTokenSigner('secret')
+    token = signer.issue('hub-alpha-01', 'cluster-alpha', 'yuvi|panda')
+    assert signer.verify(token) == ('hub-alpha-01', 'cluster-alpha', 'yuvi|panda')
+    assert signer.verify(token, user='yuvi|panda') == ('hub-alpha-01', 'cluster-alpha', 'yuvi|panda')
+    # Tokens are only good for the user they were issued to
+    assert signer.verify(token, user='someone-else') is None
+
+
+def test_expiry():
+    signer = RoutingTokenSigner('secret', max_age=60)
+    token = signer.issue('hub-alpha-01', 'cluster-alpha', 'yuvipanda', now=1000)
+    assert signer.verify(token, now=1060) is not None
+    assert signer.verify(token, now=1061) is None
+
+
+def test_tampering():
+    signer = RoutingTokenSigner('secret')
+    token = signer.issue('hub-alpha-01', 'cluster-alpha', 'yuvipanda')
+    payload, signature = token.split('.')
+
+    # Someone else's hub, with the original signature
+    forged_payload = base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)).replace(b'alpha-01', b'alpha-02')
+    forged = base64.urlsafe_b64encode(forged_payload).rstrip(b'=').decode()
+    assert signer.verify(f'{forged}.{signature}') is None
+
+    # Not the last character, whose low bits are only padding
+    flipped = ('A' if signature[0] != 'A' else 'B') + signature[1:]
+    assert signer.verify(f'{payload}.{flipped}') is None
+    assert RoutingTokenSigner('other-secret').verify(token) is None
+    for garbage in ('', 'abc', 'a.b.c', '!!!.???', 'ünï.cöde', payload):
+        assert signer.verify(garbage) is None
+
+
+def test_key_rotation():
+    old = RoutingTokenSigner('old-secret')
+    rotated = RoutingTokenSigner(['new-secret', 'old-secret'])
+    new = RoutingTokenSigner('new-secret')
+
+    old_token = old.issue('hub-alpha-01', 'cluster-alpha', 'yuvipanda')
+    # Tokens issued before the rotation keep working while the old secret is kept
+    assert rotated.verify(old_token) == ('hub-alpha-01', 'cluster-alpha', 'yuvipanda')
+    # New tokens are signed with the new secret, and work once the old one is dropped
+    new_token = rotated.issue('hub-alpha-01', 'cluster-alpha', 'yuvipanda')
+    assert new.verify(new_token) == ('hub-alpha-01', 'cluster-alpha', 'yuvipanda')
+    assert old.verify(new_token) is None
+    assert new.verify(old_token) is None
+
+
+class RecordingHandler:
+    def __init__(self):
+        self.headers = []
+
+    def add_header(self, name, value):
+        self.headers.append((name, value))
+
+
+def test_cookie_sent_on_cross_site_launches():
+    signer = RoutingTokenSigner('secret', max_age=3600)
+    handler = RecordingHandler()
+    signer.set_cookie(handler, 'hub-alpha-01', 'cluster-alpha', 'yuvipanda')
+
+    [(name, value)] = handler.headers
+    assert name == 'Set-Cookie'
+    cookie, *attributes = value.split('; ')
+    cookie_name, token = cookie.split('=', 1)
+    assert cookie_name == RoutingTokenSigner.COOKIE_NAME
+    assert signer.verify(token, user='yuvipanda') == ('hub-alpha-01', 'cluster-alpha', 'yuvipanda')
+    assert {'Secure', 'HttpOnly', 'SameSite=None', 'Path=/', 'Max-Age=3600'} == set(attributes)
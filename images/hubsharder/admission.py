@@ -0,0 +1,126 @@
+"""
+Admission control for launches, so bursts of them do not overwhelm a hub.
+"""
+import asyncio
+import heapq
+import itertools
+import time
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, message, position):
+        self.message = message
+        self.position = position
+
+
+class _Gate:
+    def __init__(self, burst):
+        self.in_flight = 0
+        self.tokens = burst
+        self.refilled_at = time.monotonic()
+        # heap of (ticket, sequence, future)
+        self.waiters = []
+        self.timer = None
+
+
+class AdmissionController:
+    """
+    Limit the launches sent to each hub.
+
+    At most max_concurrent launches are in flight per hub, and new ones start
+    at no more than rate per second (token bucket, allowing bursts of up to
+    burst). A max_concurrent or rate of 0 means no limit of that kind.
+
+    Launches that cannot start right away wait in a queue of at most max_queue
+    per hub, and are let through in order of their ticket rather than when they
+    joined the queue. Tickets are normally the time a launch first arrived, so
+    someone who gave up waiting and came back keeps their place in line.
+
+    Limits are per process, so divide a hub's sustainable rate between all
+    processes sharding to it.
+    """
+    def __init__(self, max_concurrent=10, rate=0, burst=10, max_queue=500):
+        self.max_concurrent = max_concurrent
+        self.rate = rate
+        self.burst = burst
+        self.max_queue = max_queue
+        self.gates = {}
+        self._sequence = itertools.count()
+
+    def gate(self, key):
+        gate = self.gates.get(key)
+        if gate is None:
+            gate = self.gates[key] = _Gate(self.burst)
+        return gate
+
+    def _can_start(self, gate):
+        if self.max_concurrent and gate.in_flight >= self.max_concurrent:
+            return False
+        if self.rate:
+            now = time.monotonic()
+            gate.tokens = min(self.burst, gate.tokens + (now - gate.refilled_at) * self.rate)
+            gate.refilled_at = now
+            return gate.tokens >= 1
+        return True
+
+    def _start(self, gate):
+        gate.in_flight += 1
+        if self.rate:
+            gate.tokens -= 1
+
+    def _dispatch(self, gate):
+        while gate.waiters and self._can_start(gate):
+            ticket, sequence, future = heapq.heappop(gate.waiters)
+            self._start(gate)
+            future.set_result(None)
+        if gate.waiters and gate.timer is None and self.rate and gate.tokens < 1:
+            # Nothing else will wake the queue up when the next token arrives
+            gate.timer = asyncio.get_event_loop().call_later(
+                (1 - gate.tokens) / self.rate, self._on_timer, gate
+            )
+
+    def _on_timer(self, gate):
+        gate.timer = None
+        self._dispatch(gate)
+
+    async def admit(self, key, ticket, timeout):
+        """
+        Wait up to timeout seconds for a launch to key to be let through.
+
+        Every successful admit must be followed by a release once the launch
+        is done. Raises AdmissionRejected if the queue is full or timeout
+        passes first, with the number of launches known to be ahead.
+        """
+        gate = self.gate(key)
+        if not gate.waiters and self._can_start(gate):
+            self._start(gate)
+            return
+        if len(gate.waiters) >= self.max_queue:
+            raise AdmissionRejected(f'Launch queue for {key} is full', self._position(gate, ticket))
+
+        entry = (ticket, next(self._sequence), asyncio.get_event_loop().create_future())
+        heapq.heappush(gate.waiters, entry)
+        future = entry[2]
+        self._dispatch(gate)
+        if not future.done():
+            await asyncio.wait([future], timeout=timeout)
+        if future.done():
+            return
+        gate.waiters.remove(entry)
+        heapq.heapify(gate.waiters)
+        raise AdmissionRejected(f'Timed out waiting for a launch slot on {key}', self._position(gate, ticket))
+
+    def _position(self, gate, ticket):
+        # Launches that would be let through before one with ticket
+        return sum(1 for t, s, f in gate.waiters if t < ticket)
+
+    def release(self, key):
+        gate = self.gates[key]
+        gate.in_flight -= 1
+        self._dispatch(gate)
+
+    def stats(self):
+        return {
+            key: {'in_flight': gate.in_flight, 'queued': len(gate.waiters), 'tokens': gate.tokens}
+            for key, gate in self.gates.items()
+        }
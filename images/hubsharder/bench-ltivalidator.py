@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+Benchmark the CPU cost of validating LTI launches.
+
+Signs a number of launches (with as many custom parameters as edX sends),
+then validates all of them twice: once the way we used to, running oauthlib's
+signing pipeline for each, and once with
+LTILaunchValidator.validate_body_arguments. Both include tornado parsing the
+form, and record nonces in a fresh in-process NonceStore, so neither touches
+the network.
+"""
+import argparse
+import json
+import time
+import urllib.parse
+
+from oauthlib.oauth1 import Client, SIGNATURE_TYPE_BODY
+from oauthlib.oauth1.rfc5849 import signature
+from tornado.httputil import HTTPHeaders, parse_body_arguments
+
+from ltivalidator import LTILaunchValidator, LTILaunchValidationError, NonceStore
+
+LAUNCH_URL = 'https://data8x.berkeley.edu/hub/lti/launch'
+
+
+def make_launches(count, params, secret):
+    client = Client('bench-key', client_secret=secret, signature_type=SIGNATURE_TYPE_BODY)
+    launches = []
+    for i in range(count):
+        args = [
+            ('user_id', f'{i:032x}'),
+            ('resource_link_id', 'edx.org-1234567890abcdef'),
+            ('lti_message_type', 'basic-lti-launch-request'),
+            ('roles', 'Student'),
+        ] + [(f'custom_param_{j}', f'value {j} with / some & punctuation') for j in range(params)]
+        uri, headers, body = client.sign(
+            LAUNCH_URL, 'POST', urllib.parse.urlencode(args),
+            {'Content-Type': 'application/x-www-form-urlencoded'}
+        )
+        launches.append((HTTPHeaders(headers), body.encode()))
+    return launches
+
+
+def oauthlib_validate(consumers, nonces, headers, body):
+    """
+    Validation as it was done before validate_body_arguments: everything through oauthlib, each time.
+    """
+    body_arguments = parse(headers, body)
+    args = {}
+    for k, values in body_arguments.items():
+        args[k] = values[0].decode() if len(values) == 1 else [v.decode() for v in values]
+
+    args_list = []
+    for key, values in args.items():
+        if type(values) is list:
+            args_list += [(key, value) for value in values]
+        else:
+            args_list.append((key, values))
+    base_string = signature.construct_base_string(
+        'POST',
+        signature.normalize_base_string_uri(LAUNCH_URL),
+        signature.normalize_parameters(signature.collect_parameters(body=args_list, headers=headers))
+    )
+    sign = signature.sign_hmac_sha1(base_string, consumers[args['oauth_consumer_key']], None)
+    if not signature.safe_string_equals(sign, args['oauth_signature']):
+        raise LTILaunchValidationError('Invalid oauth_signature')
+    if not nonces.add(args['oauth_consumer_key'], int(args['oauth_timestamp']), args['oauth_nonce']):
+        raise LTILaunchValidationError('oauth_nonce + oauth_timestamp already used')
+
+    # Parsed a second time, for the launch info
+    launch_args = {}
+    for k, values in body_arguments.items():
+        launch_args[k] = values[0].decode() if len(values) == 1 else [v.decode() for v in values]
+    return launch_args
+
+
+def parse(headers, body):
+    body_arguments = {}
+    parse_body_arguments(headers['Content-Type'], body, body_arguments, {})
+    return body_arguments
+
+
+def cpu_per_launch(validate, launches):
+    start = time.process_time()
+    for headers, body in launches:
+        validate(headers, body)
+    return (time.process_time() - start) / len(launches)
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    argparser.add_argument('--launches', type=int, default=5000)
+    argparser.add_argument('--params', type=int, default=20, help='Custom parameters per launch')
+    argparser.add_argument('--secrets', type=int, default=1, help='Secrets per consumer, with the right one last')
+    argparser.add_argument('--json', action='store_true', help='Print results as JSON')
+    args = argparser.parse_args()
+
+    secret = 'bench-secret'
+    consumers = {'bench-key': secret}
+    # Launches signed with the newest secret are checked against every older one first
+    secrets = [f'old-secret-{i}' for i in range(args.secrets - 1)] + [secret]
+    # Nonce stores refuse launches from before they were created, so create them first
+    nonces = NonceStore()
+    validator = LTILaunchValidator({'bench-key': secrets}, nonces=NonceStore())
+    launches = make_launches(args.launches, args.params, secret)
+
+    baseline = cpu_per_launch(lambda h, b: oauthlib_validate(consumers, nonces, h, b), launches)
+    fast = cpu_per_launch(lambda h, b: validator.validate_body_arguments(LAUNCH_URL, h, parse(h, b)), launches)
+
+    report = {
+        'launches': args.launches,
+        'params': args.params,
+        'secrets': args.secrets,
+        'oauthlib_us': baseline * 1e6,
+        'validate_body_arguments_us': fast * 1e6,
+        'speedup': baseline / fast,
+    }
+    if args.json:
+        print(json.dumps(report))
+    else:
+        for key, value in report.items():
+            print(f'{key:28}{value:.3f}' if isinstance(value, float) else f'{key:28}{value}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,17 @@
+import base64
+import functools
+import hashlib
+import hmac
+import heapq
+import json
+import queue
+import re
+import threading
 import time
+import urllib.parse
+from concurrent.futures import Future, TimeoutError
 
-from oauthlib.oauth1.rfc5849 import signature
-from collections import OrderedDict
+from oauthlib.oauth1.rfc5849 import signature, utils
 
 
 class LTILaunchValidationError(Exception):
@@ -9,17 +19,302 @@ class LTILaunchValidationError(Exception):
         self.message = message
 
 
+class NonceStoreUnavailable(Exception):
+    def __init__(self, message):
+        self.message = message
+
+
+class NonceStore:
+    """
+    Thread-safe, in-process record of the nonces seen in the last window seconds.
+
+    Nonces are kept in one set per timestamp, and whole timestamps are dropped
+    once they fall out of the window - requests that old are rejected anyway.
+    At most max_size nonces are kept. If there are more than that within the
+    window, the oldest timestamps are dropped early, and any timestamp at or
+    before them is refused from then on, since we can no longer tell whether
+    it is a replay.
+
+    Nothing from before the store was created is known, so timestamps from
+    before valid_since should be refused too.
+    """
+    def __init__(self, window=30, max_size=1000000):
+        self.window = window
+        self.max_size = max_size
+        self.valid_since = int(time.time())
+        # Timestamps at or before this are always refused
+        self.floor = 0
+        self._nonces = {}
+        self._timestamps = []
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._size
+
+    def _evict(self, cutoff):
+        while self._timestamps and (self._timestamps[0] < cutoff or self._size >= self.max_size):
+            timestamp = heapq.heappop(self._timestamps)
+            self._size -= len(self._nonces.pop(timestamp))
+            if timestamp >= cutoff:
+                # Still inside the window, so we are forgetting nonces that could be replayed
+                self.floor = max(self.floor, timestamp)
+
+    def seen(self, consumer_key, timestamp, nonce):
+        """
+        Return True if nonce is known to have been used by consumer_key at timestamp.
+        """
+        with self._lock:
+            nonces = self._nonces.get(timestamp)
+            return nonces is not None and (consumer_key, nonce) in nonces
+
+    def add(self, consumer_key, timestamp, nonce):
+        """
+        Record nonce as used by consumer_key at timestamp.
+
+        Returns False if it has been used before, or if we can not tell because
+        timestamp is outside the window.
+        """
+        with self._lock:
+            cutoff = int(time.time()) - self.window
+            self._evict(cutoff)
+            if timestamp < cutoff or timestamp <= self.floor:
+                return False
+            nonces = self._nonces.get(timestamp)
+            if nonces is None:
+                nonces = self._nonces[timestamp] = set()
+                heapq.heappush(self._timestamps, timestamp)
+            key = (consumer_key, nonce)
+            if key in nonces:
+                return False
+            nonces.add(key)
+            self._size += 1
+            return True
+
+
+class PostgresNonceStore:
+    """
+    Record of used nonces shared by every process using the same database.
+
+    pool is a connection pool with getconn / putconn (such as sharder's
+    ConnectionPool). Nonces are inserted into lti_nonces_v1, whose primary key
+    rejects reuse. Concurrent adds are sent to the database together, by a
+    single writer thread, in one INSERT ... ON CONFLICT DO NOTHING - so under
+    load a whole batch of launches costs one round trip. Nonces that fell out
+    of the window are deleted every cleanup_interval seconds.
+
+    Nonces this process has already seen are rejected without asking the
+    database, from a local NonceStore of up to local_size nonces. Adds that
+    are not answered within timeout seconds raise NonceStoreUnavailable.
+
+    The database outlives any one process, so unlike NonceStore this knows
+    about launches from before it was created.
+    """
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS lti_nonces_v1 (
+        consumer_key        TEXT NOT NULL,
+        oauth_timestamp     BIGINT NOT NULL,
+        nonce               TEXT NOT NULL,
+        PRIMARY KEY (consumer_key, oauth_timestamp, nonce)
+    );
+    CREATE INDEX IF NOT EXISTS lti_nonces_v1_oauth_timestamp_index ON lti_nonces_v1 (oauth_timestamp);
+    """
+
+    def __init__(
+        self, pool, log, window=30, max_batch_size=500, cleanup_interval=60, local_size=100000, timeout=5
+    ):
+        self.pool = pool
+        self.timeout = timeout
+        self.log = log
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.cleanup_interval = cleanup_interval
+        self.valid_since = 0
+        self.local = NonceStore(window, local_size)
+        self._pending = queue.Queue()
+
+        conn = self.pool.getconn()
+        try:
+            with conn:
+                with conn.cursor() as cur:
+                    cur.execute(self.SCHEMA)
+                conn.commit()
+        finally:
+            self.pool.putconn(conn)
+
+        threading.Thread(target=self._write_forever, daemon=True).start()
+
+    def add(self, consumer_key, timestamp, nonce):
+        """
+        Record nonce as used by consumer_key at timestamp.
+
+        Returns False if it has been used before, by any process. Raises
+        NonceStoreUnavailable if the database could not be reached in time,
+        since we can not tell.
+        """
+        if timestamp < int(time.time()) - self.window:
+            return False
+        if self.local.seen(consumer_key, timestamp, nonce):
+            return False
+        future = Future()
+        self._pending.put(((consumer_key, timestamp, nonce), future))
+        try:
+            recorded = future.result(timeout=self.timeout)
+        except TimeoutError:
+            raise NonceStoreUnavailable(f'Nonce store did not answer within {self.timeout}s')
+        except Exception as e:
+            raise NonceStoreUnavailable(f'Nonce store failed: {e}')
+        if not recorded:
+            return False
+        self.local.add(consumer_key, timestamp, nonce)
+        return True
+
+    def _write_forever(self):
+        cleaned_at = time.monotonic()
+        while True:
+            try:
+                batch = [self._pending.get(timeout=self.cleanup_interval)]
+            except queue.Empty:
+                batch = []
+            # Take everything else that queued up while we were busy, without waiting for more
+            while batch and len(batch) < self.max_batch_size:
+                try:
+                    batch.append(self._pending.get_nowait())
+                except queue.Empty:
+                    break
+
+            cleanup = time.monotonic() - cleaned_at > self.cleanup_interval
+            try:
+                self._write(batch, cleanup)
+                if cleanup:
+                    cleaned_at = time.monotonic()
+            except Exception as e:
+                self.log.exception('Recording LTI nonces failed')
+                for key, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def _write(self, batch, cleanup):
+        # The same nonce twice in one batch is a replay of itself
+        futures = {}
+        for key, future in batch:
+            if key in futures:
+                future.set_result(False)
+            else:
+                futures[key] = future
+
+        conn = self.pool.getconn()
+        try:
+            with conn:
+                with conn.cursor() as cur:
+                    if futures:
+                        keys = list(futures)
+                        cur.execute("""
+                        INSERT INTO lti_nonces_v1 (consumer_key, oauth_timestamp, nonce)
+                        SELECT * FROM unnest(%s::text[], %s::bigint[], %s::text[])
+                        ON CONFLICT DO NOTHING
+                        RETURNING consumer_key, oauth_timestamp, nonce
+                        """, ([k[0] for k in keys], [k[1] for k in keys], [k[2] for k in keys]))
+                        inserted = set(cur.fetchall())
+                    if cleanup:
+                        # Leave some slack for clock differences between processes
+                        cur.execute("""
+                        DELETE FROM lti_nonces_v1 WHERE oauth_timestamp < %s
+                        """, (int(time.time()) - 2 * self.window, ))
+                conn.commit()
+        finally:
+            self.pool.putconn(conn)
+
+        for key, future in futures.items():
+            future.set_result(key in inserted)
+
+
+def consumers_from_env(environ):
+    """
+    LTI consumers configured in environ, as a dict of consumer key -> list of secrets.
+
+    LTI_KEY and LTI_SECRET give one consumer. LTI_CONSUMERS, a JSON object of
+    consumer key -> secret (or list of secrets, to rotate them), adds more.
+    """
+    consumers = {}
+    if 'LTI_KEY' in environ:
+        consumers[environ['LTI_KEY']] = [environ['LTI_SECRET']]
+    for key, secrets in json.loads(environ.get('LTI_CONSUMERS', '{}')).items():
+        consumers.setdefault(key, []).extend([secrets] if isinstance(secrets, str) else secrets)
+    return consumers
+
+
+_UNRESERVED = re.compile(r'[A-Za-z0-9\-._~]*')
+
+
+@functools.lru_cache(maxsize=10000)
+def _quote(value):
+    return urllib.parse.quote(value, safe='~')
+
+
+def _escape(value):
+    # RFC 5849 percent encoding, same as oauthlib's utils.escape. Most names
+    # and values either need no escaping at all, or are the same every launch.
+    if _UNRESERVED.fullmatch(value):
+        return value
+    return _quote(value)
+
+
+def _escape_escaped(value):
+    # _escape of something already escaped, which can only contain these
+    return value.replace('%', '%25').replace('=', '%3D').replace('&', '%26')
+
+
+@functools.lru_cache(maxsize=64)
+def _base_string_uri(launch_url):
+    # There are only ever a handful of launch urls
+    return _escape(signature.normalize_base_string_uri(launch_url))
+
+
 class LTILaunchValidator:
-    # Record time when process starts, so we can reject requests made
-    # before this
-    PROCESS_START_TIME = int(time.time())
+    """
+    Validate LTI launches, signed with OAuth 1 HMAC-SHA1.
 
-    # Keep a class-wide, global list of nonces so we can detect & reject
-    # replay attacks. This possibly makes this non-threadsafe, however.
-    nonces = OrderedDict()
+    consumers is a dict of consumer key -> secret, or -> list of secrets, any of
+    which is accepted (so a secret can be rotated without rejecting launches
+    signed with the old one). Keyed HMACs are set up once per secret and
+    copied for each launch.
+    """
+    # Keep a class-wide, global record of nonces so we can detect & reject
+    # replay attacks. Pass nonces to share them with other processes instead.
+    nonces = NonceStore()
 
-    def __init__(self, consumers):
+    def __init__(self, consumers, nonces=None):
         self.consumers = consumers
+        if nonces is not None:
+            self.nonces = nonces
+        # There is never a token secret, so the key is just the escaped consumer secret and a &
+        self._hmacs = {
+            key: [
+                hmac.new(f'{_escape(secret)}&'.encode(), digestmod=hashlib.sha1)
+                for secret in ([secrets] if isinstance(secrets, str) else secrets)
+            ]
+            for key, secrets in consumers.items()
+        }
+
+    def validate_body_arguments(self, launch_url, headers, body_arguments):
+        """
+        Validate a launch request from tornado's body_arguments, and return its arguments.
+
+        body_arguments is a dict of name -> list of bytes values, as parsed by
+        tornado. The returned arguments are decoded, with arguments given more
+        than once as lists - like validate_launch_request's args.
+        """
+        args = {}
+        args_list = []
+        for key, values in body_arguments.items():
+            # tornado decodes names as latin1
+            key = key.encode('latin1').decode()
+            values = [v.decode() for v in values]
+            args[key] = values[0] if len(values) == 1 else values
+            args_list += [(key, value) for value in values]
+        self._validate(launch_url, headers, args, args_list)
+        return args
 
     def validate_launch_request(
             self,
@@ -37,7 +332,32 @@ class LTILaunchValidator:
                 oauth_consumer_key, oauth_timestamp, oauth_nonce,
                 oauth_signature
         """
+        args_list = []
+        for key, values in args.items():
+            if type(values) is list:
+                args_list += [(key, value) for value in values]
+            else:
+                args_list.append((key, values))
+        return self._validate(launch_url, headers, args, args_list)
 
+    def base_string(self, launch_url, headers, args_list):
+        """
+        OAuth 1 signature base string of a POST to launch_url, built in one go.
+        """
+        params = list(args_list)
+        authorization = headers.get('Authorization', '')
+        if authorization[:6].lower() == 'oauth ':
+            params += [(k, v) for k, v in utils.parse_authorization_header(authorization) if k != 'realm']
+        # Same as oauthlib's collect_parameters and normalize_parameters, which
+        # also unescape oauth_ parameters a second time
+        escaped = sorted(
+            (_escape(k), _escape(urllib.parse.unquote(v) if '%' in v and k.startswith('oauth_') else v))
+            for k, v in params if k != 'oauth_signature'
+        )
+        normalized = '&'.join(f'{k}={v}' for k, v in escaped)
+        return f'POST&{_base_string_uri(launch_url)}&{_escape_escaped(normalized)}'
+
+    def _validate(self, launch_url, headers, args, args_list):
         # Validate args!
         if 'oauth_consumer_key' not in args:
             raise LTILaunchValidationError("oauth_consumer_key missing")
@@ -50,47 +370,34 @@ class LTILaunchValidator:
             raise LTILaunchValidationError('oauth_timestamp missing')
 
         # Allow 30s clock skew between LTI Consumer and Provider
-        # Also don't accept timestamps from before our process started, since that could be
+        # Also don't accept timestamps from before our nonce store started, since that could be
         # a replay attack - we won't have nonce lists from back then. This would allow users
         # who can control / know when our process restarts to trivially do replay attacks.
         oauth_timestamp = int(float(args['oauth_timestamp']))
         if (
                 int(time.time()) - oauth_timestamp > 30
-                or oauth_timestamp < LTILaunchValidator.PROCESS_START_TIME
+                or oauth_timestamp < self.nonces.valid_since
         ):
             raise LTILaunchValidationError("oauth_timestamp too old")
 
         if 'oauth_nonce' not in args:
             raise LTILaunchValidationError('oauth_nonce missing')
-        if (
-                oauth_timestamp in LTILaunchValidator.nonces
-                and args['oauth_nonce'] in LTILaunchValidator.nonces[oauth_timestamp]
-        ):
-            raise LTILaunchValidationError("oauth_nonce + oauth_timestamp already used")
-        LTILaunchValidator.nonces.setdefault(oauth_timestamp, set()).add(args['oauth_nonce'])
-
-
-        args_list = []
-        for key, values in args.items():
-            if type(values) is list:
-                args_list += [(key, value) for value in values]
-            else:
-                args_list.append((key, values))
-
-        base_string = signature.construct_base_string(
-            'POST',
-            signature.normalize_base_string_uri(launch_url),
-            signature.normalize_parameters(
-                signature.collect_parameters(body=args_list, headers=headers)
-            )
-        )
 
-        consumer_secret = self.consumers[args['oauth_consumer_key']]
-
-        sign = signature.sign_hmac_sha1(base_string, consumer_secret, None)
-        is_valid = signature.safe_string_equals(sign, args['oauth_signature'])
-
-        if not is_valid:
+        base_string = self.base_string(launch_url, headers, args_list).encode()
+        given = args['oauth_signature']
+        if not isinstance(given, str):
+            raise LTILaunchValidationError("Invalid oauth_signature")
+        for key_hmac in self._hmacs[args['oauth_consumer_key']]:
+            h = key_hmac.copy()
+            h.update(base_string)
+            if hmac.compare_digest(base64.b64encode(h.digest()), given.encode()):
+                break
+        else:
             raise LTILaunchValidationError("Invalid oauth_signature")
 
+        # Only record nonces of correctly signed requests, so nobody else can
+        # fill up the store and push out the nonces of real launches
+        if not self.nonces.add(args['oauth_consumer_key'], oauth_timestamp, args['oauth_nonce']):
+            raise LTILaunchValidationError("oauth_nonce + oauth_timestamp already used")
+
         return True
\ No newline at end of file
@@ -0,0 +1,86 @@
+"""
+Prometheus metrics for request-sharder.
+
+With more than one worker process, each keeps its own metrics, and a scrape
+only sees whichever worker it happens to reach. Set PROMETHEUS_MULTIPROC_DIR
+(to an empty directory, before starting) so workers write their metrics
+there instead, and every scrape adds up all of them.
+"""
+import os
+import shutil
+
+from sharder import Histogram, ShardObserver
+
+try:
+    import prometheus_client
+    from prometheus_client import multiprocess
+except ImportError:
+    prometheus_client = None
+
+MULTIPROC_DIR = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+
+
+def reset_multiprocess_dir():
+    """
+    Remove metrics left behind by earlier runs, before any workers are started.
+    """
+    if MULTIPROC_DIR is None:
+        return
+    for name in os.listdir(MULTIPROC_DIR):
+        path = os.path.join(MULTIPROC_DIR, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
+
+def mark_process_dead(pid):
+    """
+    Clean up after a worker that has exited. Its counters and histograms are kept.
+    """
+    if prometheus_client is not None and MULTIPROC_DIR is not None:
+        multiprocess.mark_process_dead(pid, MULTIPROC_DIR)
+
+
+def generate_latest():
+    """
+    Metrics in the prometheus text format, from every worker if they are shared.
+    """
+    if MULTIPROC_DIR is None:
+        return prometheus_client.generate_latest()
+    registry = prometheus_client.CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry, MULTIPROC_DIR)
+    return prometheus_client.generate_latest(registry)
+
+
+class PrometheusObserver(ShardObserver):
+    """
+    Export phase timings and event counts as prometheus metrics.
+
+    Metrics are registered once per registry, so any number of sharders in a
+    process can share them (they are labelled by kind).
+    """
+    _metrics = {}
+
+    def __init__(self, registry=None):
+        if prometheus_client is None:
+            raise RuntimeError('prometheus_client must be installed to use PrometheusObserver')
+        registry = registry or prometheus_client.REGISTRY
+        if id(registry) not in self._metrics:
+            self._metrics[id(registry)] = (
+                prometheus_client.Histogram(
+                    'sharder_phase_seconds', 'Time spent in each phase of a shard call',
+                    ['kind', 'phase'], buckets=Histogram.DEFAULT_BOUNDS, registry=registry
+                ),
+                prometheus_client.Counter(
+                    'sharder_shards_total', 'Shard calls, by how they were answered',
+                    ['kind', 'event', 'bucket'], registry=registry
+                ),
+            )
+        self.phase_seconds, self.shards = self._metrics[id(registry)]
+
+    def phase(self, kind, phase, seconds):
+        self.phase_seconds.labels(kind, phase).observe(seconds)
+
+    def event(self, kind, event, bucket):
+        self.shards.labels(kind, event, bucket).inc()
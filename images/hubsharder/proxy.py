@@ -0,0 +1,252 @@
+"""
+Reverse proxy from request-sharder to the inner edges.
+"""
+import asyncio
+import math
+import time
+
+from tornado import httpclient, httputil, log
+
+
+class UpstreamUnavailable(Exception):
+    def __init__(self, message):
+        self.message = message
+
+
+class CircuitBreaker:
+    """
+    Track the health of one upstream, and stop sending it requests while it is failing.
+
+    failure_threshold consecutive failures (errors, 5xx responses, or responses
+    slower than slow_threshold seconds) open the breaker, and requests fail
+    fast for cooldown seconds. After that a single trial request is let
+    through: if it succeeds the breaker closes, otherwise it stays open for
+    another cooldown.
+    """
+    def __init__(self, failure_threshold=5, slow_threshold=10, cooldown=30):
+        self.failure_threshold = failure_threshold
+        self.slow_threshold = slow_threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        self.latency = None
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow(self):
+        """
+        Return True if a request may be sent to the upstream now.
+        """
+        if self.opened_at is None:
+            return True
+        if time.monotonic() - self.opened_at < self.cooldown or self.trial_in_flight:
+            return False
+        self.trial_in_flight = True
+        return True
+
+    def retry_after(self):
+        if self.opened_at is None:
+            return 0
+        return max(1, math.ceil(self.cooldown - (time.monotonic() - self.opened_at)))
+
+    def record(self, ok, seconds=0):
+        """
+        Record the outcome of a request. Returns True if the breaker opened or closed.
+        """
+        was_open = self.is_open
+        self.trial_in_flight = False
+        self.latency = seconds if self.latency is None else 0.8 * self.latency + 0.2 * seconds
+        if ok and seconds < self.slow_threshold:
+            self.failures = 0
+            self.opened_at = None
+        else:
+            self.failures += 1
+            if was_open or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+        return was_open != self.is_open
+
+    def stats(self):
+        return {
+            'open': self.is_open,
+            'consecutive_failures': self.failures,
+            'retry_after': self.retry_after(),
+            'latency_seconds': self.latency,
+        }
+
+
+class UpstreamProxy:
+    """
+    Proxy requests to upstreams (inner edges), streaming responses back.
+
+    Every upstream gets its own HTTP client, with up to max_clients requests in
+    flight and connections kept alive between them - so a slow upstream only
+    queues launches headed to itself, not everyone else's.
+
+    Requests are tracked by a CircuitBreaker per key (an upstream, or
+    something finer such as a hub behind it). While a key's breaker is open,
+    requests for it fail fast with a 503 instead of waiting on a doomed
+    upstream. on_health_change, if given, is called with the set of keys whose
+    breakers are open whenever that changes.
+    """
+    # Only meaningful for a single hop, so never passed on in either direction
+    HOP_BY_HOP_HEADERS = {
+        'Connection', 'Keep-Alive', 'Proxy-Authenticate', 'Proxy-Authorization',
+        'Te', 'Trailer', 'Transfer-Encoding', 'Upgrade',
+    }
+    # Recomputed by whoever sends the body on
+    REWRITTEN_HEADERS = {'Content-Length', 'Content-Encoding'}
+
+    def __init__(
+            self, max_clients=20, connect_timeout=5, request_timeout=30,
+            failure_threshold=5, slow_threshold=10, cooldown=30, on_health_change=None
+    ):
+        self.max_clients = max_clients
+        self.connect_timeout = connect_timeout
+        self.request_timeout = request_timeout
+        self.failure_threshold = failure_threshold
+        self.slow_threshold = slow_threshold
+        self.cooldown = cooldown
+        self.on_health_change = on_health_change
+        self.clients = {}
+        self.breakers = {}
+
+    def breaker(self, key):
+        breaker = self.breakers.get(key)
+        if breaker is None:
+            breaker = self.breakers[key] = CircuitBreaker(self.failure_threshold, self.slow_threshold, self.cooldown)
+        return breaker
+
+    def unhealthy(self):
+        return {key for key, breaker in self.breakers.items() if breaker.is_open}
+
+    def record(self, key, ok, seconds=0):
+        if self.breaker(key).record(ok, seconds):
+            state = 'open' if self.breakers[key].is_open else 'closed'
+            log.app_log.warning(f'Circuit breaker for {key} is now {state}')
+            if self.on_health_change is not None:
+                self.on_health_change(self.unhealthy())
+
+    def health(self):
+        return {key: breaker.stats() for key, breaker in self.breakers.items()}
+
+    def client(self, upstream):
+        client = self.clients.get(upstream)
+        if client is None:
+            client = self.clients[upstream] = httpclient.AsyncHTTPClient(
+                force_instance=True, max_clients=self.max_clients
+            )
+        return client
+
+    def upstream_headers(self, request):
+        headers = httputil.HTTPHeaders()
+        for header, value in request.headers.get_all():
+            if header not in self.HOP_BY_HOP_HEADERS and header not in self.REWRITTEN_HEADERS:
+                headers.add(header, value)
+        return headers
+
+    async def proxy(self, handler, upstream, path, headers, key=None, body=None):
+        """
+        POST handler's request body to path on upstream, and stream the response back through handler.
+
+        headers (and body, if given) are sent to upstream instead of the ones
+        handler's request came with. key is what health is tracked by, defaulting to upstream.
+        Returns the error if the upstream could not be reached, failed part way
+        through or is known to be failing, or None (even for error statuses,
+        which are passed through).
+        """
+        key = key or upstream
+        breaker = self.breaker(key)
+        if not breaker.allow():
+            retry_after = breaker.retry_after()
+            handler.set_status(503)
+            handler.set_header('Retry-After', str(retry_after))
+            handler.write(f'Temporarily unavailable, please try again in {retry_after} seconds')
+            log.app_log.warning(f'Not proxying to {upstream}, circuit breaker for {key} is open')
+            return UpstreamUnavailable(f'Circuit breaker for {key} is open')
+
+        response = _StreamedResponse(handler, self.HOP_BY_HOP_HEADERS | self.REWRITTEN_HEADERS)
+        req = httpclient.HTTPRequest(
+            f'http://{upstream}{path}', method='POST', body=handler.request.body if body is None else body,
+            headers=headers, follow_redirects=False,
+            connect_timeout=self.connect_timeout, request_timeout=self.request_timeout,
+            header_callback=response.on_header_line, streaming_callback=response.on_chunk,
+        )
+        start = time.monotonic()
+        try:
+            # Error statuses are passed through like any other response, but
+            # connection errors and timeouts are still raised
+            result = await self.client(upstream).fetch(req, raise_error=False)
+        except Exception as e:
+            self.record(key, False, time.monotonic() - start)
+            if response.started:
+                # Too late to send an error status, so just cut the response short
+                log.app_log.error(f'Proxying to {upstream} failed part way through with error {e}')
+                handler.request.connection.close()
+            else:
+                handler.set_status(500)
+                handler.write(str(e))
+                log.app_log.error(f'Proxying to {upstream} failed with error {e}')
+            return e
+        self.record(key, result.code < 500, time.monotonic() - start)
+        return None
+
+    async def probe_forever(self, targets, path, interval):
+        """
+        Actively check upstreams every interval seconds, in addition to watching requests.
+
+        targets is a dict of key -> (upstream, headers). A GET of path that
+        does not fail with a 5xx counts as healthy.
+        """
+        while True:
+            await asyncio.sleep(interval)
+            for key, (upstream, headers) in targets.items():
+                req = httpclient.HTTPRequest(
+                    f'http://{upstream}{path}', headers=headers, follow_redirects=False,
+                    connect_timeout=self.connect_timeout, request_timeout=self.slow_threshold,
+                )
+                start = time.monotonic()
+                try:
+                    result = await self.client(upstream).fetch(req, raise_error=False)
+                    self.record(key, result.code < 500, time.monotonic() - start)
+                except Exception:
+                    self.record(key, False, time.monotonic() - start)
+
+
+class _StreamedResponse:
+    """
+    Pass an upstream response through to handler as curl hands it to us.
+    """
+    def __init__(self, handler, skip_headers):
+        self.handler = handler
+        self.skip_headers = skip_headers
+        self.start_line = None
+        self.headers = None
+        self.started = False
+
+    def on_header_line(self, line):
+        line = line.strip()
+        if line.startswith('HTTP/'):
+            # A new response - possibly after a 100 Continue
+            self.start_line = httputil.parse_response_start_line(line)
+            self.headers = httputil.HTTPHeaders()
+        elif line:
+            self.headers.parse_line(line)
+        elif self.start_line.code != 100:
+            self.start()
+
+    def start(self):
+        self.handler.set_status(self.start_line.code, self.start_line.reason)
+        # clear tornado default header
+        self.handler._headers = httputil.HTTPHeaders()
+        for header, v in self.headers.get_all():
+            if header not in self.skip_headers:
+                # some header appear multiple times, eg 'Set-Cookie'
+                self.handler.add_header(header, v)
+        self.started = True
+
+    def on_chunk(self, chunk):
+        self.handler.write(chunk)
+        self.handler.flush()
@@ -1,15 +1,34 @@
 #!/usr/bin/env python3
+import asyncio
+from collections import OrderedDict
 from concurrent.futures import ThreadPoolExecutor
+import hashlib
 import json
+import math
+import sys
+import tempfile
+import time
+import urllib.parse
 from ruamel.yaml import YAML
 
 import os
-from tornado import httpserver, ioloop, web, gen, log, concurrent, httpclient, httputil
+from tornado import web, gen, log, concurrent, ioloop
+from tornado.escape import xhtml_escape
 import psycopg2
 import psycopg2.extras
 
-from ltivalidator import LTILaunchValidator, LTILaunchValidationError
-from sharder import Sharder
+from admission import AdmissionController, AdmissionRejected
+from ltivalidator import (
+    LTILaunchValidator, LTILaunchValidationError, NonceStoreUnavailable, PostgresNonceStore, consumers_from_env
+)
+import metrics
+from metrics import PrometheusObserver, prometheus_client
+from proxy import UpstreamProxy
+from routingtoken import RoutingTokenSigner
+from serving import DrainableApplication, serve
+from sharder import (
+    AsyncSharder, AssignmentCache, ConnectionPool, HubActiveServersSignal, SharedLoadSignal, StatsObserver
+)
 from tornado.httpclient import AsyncHTTPClient
 
 # Configure JupyterHub to use the curl backend for making HTTP requests,
@@ -28,85 +47,314 @@ CREATE TABLE IF NOT EXISTS lti_launch_info_v1 (
 );
 CREATE INDEX IF NOT EXISTS user_id_resource_link_id_lti_launch_info_v1 ON lti_launch_info_v1 (
     user_id, resource_link_id
-)
+);
+ALTER TABLE lti_launch_info_v1 ADD COLUMN IF NOT EXISTS launch_info_hash TEXT;
 """
 
-class ShardHandler(web.RequestHandler):
-    _sharder_thread_pool = ThreadPoolExecutor(max_workers=1)
+# Shown while a launch waits for its turn. Resubmits itself with a token
+# standing in for the (already validated) original launch.
+INTERSTITIAL_HTML = """<!DOCTYPE html>
+<html>
+<head><title>You are in line</title></head>
+<body>
+<p>Lots of people are starting their servers right now, so you are in line.
+There are about {position} people ahead of you. This page will try again in
+{retry} seconds - please do not close it.</p>
+<form method="post" action="{action}">
+<input type="hidden" name="admission_retry" value="{token}">
+<noscript><input type="submit" value="Try again"></noscript>
+</form>
+<script>setTimeout(function() {{ document.forms[0].submit(); }}, {retry} * 1000);</script>
+</body>
+</html>
+"""
 
-    @concurrent.run_on_executor(executor='_sharder_thread_pool')
-    def shard(self, username):
-        return self.settings['sharder'].shard(username)
+# Rows whose launch info has not changed are left alone, rather than rewritten
+# with an identical copy (leaving a dead tuple behind for vacuum)
+SAVE_LTI_INFO_SQL = """
+INSERT INTO lti_launch_info_v1 (user_id, resource_link_id, launch_info, launch_info_hash)
+VALUES (%(user_id)s, %(resource_link_id)s, %(launch_info)s, %(launch_info_hash)s)
+ON CONFLICT (user_id, resource_link_id)
+DO
+    UPDATE SET launch_info=EXCLUDED.launch_info, launch_info_hash=EXCLUDED.launch_info_hash
+    WHERE lti_launch_info_v1.launch_info_hash IS DISTINCT FROM EXCLUDED.launch_info_hash
+"""
 
-    _lti_saver_thread_pool = ThreadPoolExecutor(max_workers=1)
+SAVE_LTI_INFO_BATCH_SQL = """
+INSERT INTO lti_launch_info_v1 (user_id, resource_link_id, launch_info, launch_info_hash)
+SELECT * FROM unnest(
+    %(user_ids)s::text[], %(resource_link_ids)s::text[], %(launch_infos)s::text[]::jsonb[], %(launch_info_hashes)s::text[]
+)
+ON CONFLICT (user_id, resource_link_id)
+DO
+    UPDATE SET launch_info=EXCLUDED.launch_info, launch_info_hash=EXCLUDED.launch_info_hash
+    WHERE lti_launch_info_v1.launch_info_hash IS DISTINCT FROM EXCLUDED.launch_info_hash
+"""
 
-    @concurrent.run_on_executor(executor='_lti_saver_thread_pool')
-    def save_lti_info(self, lti_info):
-        user_id = lti_info['user_id']
-        resource_link_id = lti_info['resource_link_id']
 
-        with self.settings['dbpool'].getconn() as conn:
+def launch_info_hash(lti_info):
+    """
+    Stable hash of lti_info, ignoring the oauth fields that change on every launch.
+    """
+    launch_info = {k: v for k, v in lti_info.items() if not k.startswith('oauth_')}
+    return hashlib.sha256(json.dumps(launch_info, sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+
+
+class LaunchInfoWriter:
+    """
+    Write-behind queue of launch info, saved in batches.
+
+    Launch info is written every flush_interval seconds, or as soon as
+    max_batch_size records are waiting, with one multi-row upsert per batch.
+    Only the latest launch info for each (user_id, resource_link_id) is kept,
+    so repeated launches are written once. If more than max_pending records
+    are waiting (because the database is slow or down), put waits up to
+    max_wait seconds for room, then writes its launch info itself - raising
+    if that fails too, so the launch can be turned away. Failed batches are
+    retried on the next flush.
+
+    Launch info with the same hash as what was last saved for its key (in
+    saved_hashes, an AssignmentCache) is not queued at all.
+    """
+    def __init__(
+        self, sharder, saved_hashes, flush_interval=0.25, max_batch_size=500, max_pending=10000, max_wait=5
+    ):
+        self.sharder = sharder
+        self.saved_hashes = saved_hashes
+        self.flush_interval = flush_interval
+        self.max_batch_size = max_batch_size
+        self.max_pending = max_pending
+        self.max_wait = max_wait
+        self.pending = OrderedDict()
+        self.flushed = 0
+        self.batches = 0
+        self.failures = 0
+        self.direct_writes = 0
+        self.dropped = 0
+        self._closing = False
+        self._task = None
+        self._wakeup = None
+        self._room = None
+
+    def stats(self):
+        return {
+            'pending': len(self.pending),
+            'flushed': self.flushed,
+            'batches': self.batches,
+            'failures': self.failures,
+            'direct_writes': self.direct_writes,
+            'dropped': self.dropped,
+        }
+
+    async def put(self, lti_info):
+        if self._task is None:
+            # Created lazily, since these must be created on the running event loop
+            self._wakeup = asyncio.Event()
+            self._room = asyncio.Event()
+            self._task = asyncio.ensure_future(self._flush_forever())
+        key = (lti_info['user_id'], lti_info['resource_link_id'])
+        info_hash = launch_info_hash(lti_info)
+        if key not in self.pending and self.saved_hashes.get(key) == info_hash:
+            return
+        deadline = time.monotonic() + self.max_wait
+        while key not in self.pending and len(self.pending) >= self.max_pending:
+            self._room.clear()
             try:
-                with conn.cursor() as cur:
-                    # Make sure that we have at least one dummy entry for each fileserver
-                    cur.execute("""
-                    INSERT INTO lti_launch_info_v1 (user_id, resource_link_id, launch_info)
-                    VALUES (%s, %s, %s)
-                    ON CONFLICT (user_id, resource_link_id)
-                    DO
-                        UPDATE SET launch_info=%s
-                    """, (user_id, resource_link_id, psycopg2.extras.Json(lti_info), psycopg2.extras.Json(lti_info)))
-                    conn.commit()
-                    log.app_log.info(f'Saved lti launch info for user:{user_id} resource_link_id:{resource_link_id}')
-            finally:
-                self.settings['dbpool'].putconn(conn)
+                await asyncio.wait_for(self._room.wait(), max(0, deadline - time.monotonic()))
+            except asyncio.TimeoutError:
+                # The queue has not drained in time, so do not add to it
+                log.app_log.warning(f'{len(self.pending)} lti launch infos pending, saving {key} directly')
+                self.direct_writes += 1
+                try:
+                    await self._write([(key, (lti_info, info_hash))])
+                except Exception:
+                    self.dropped += 1
+                    log.app_log.exception(f'Saving lti launch info for {key} failed, dropping it')
+                    raise
+                return
+        self.pending[key] = (lti_info, info_hash)
+        if len(self.pending) >= self.max_batch_size:
+            self._wakeup.set()
+
+    async def _flush_forever(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception:
+                log.app_log.exception('Saving lti launch info failed, will retry')
+
+    async def flush(self):
+        """
+        Write one batch of pending launch info.
+        """
+        if not self.pending:
+            return
+        batch = []
+        while self.pending and len(batch) < self.max_batch_size:
+            batch.append(self.pending.popitem(last=False))
+        try:
+            await self._write(batch)
+        except Exception:
+            self.failures += 1
+            # Put the batch back, unless there is newer launch info for the same key
+            for key, record in reversed(batch):
+                if key not in self.pending:
+                    self.pending[key] = record
+                    self.pending.move_to_end(key, last=False)
+            raise
+        self.flushed += len(batch)
+        self.batches += 1
+        self._room.set()
+        log.app_log.info(f'Saved {len(batch)} lti launch infos')
+
+    async def _write(self, batch):
+        async with self.sharder.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(SAVE_LTI_INFO_BATCH_SQL, {
+                    'user_ids': [user_id for (user_id, resource_link_id), record in batch],
+                    'resource_link_ids': [resource_link_id for (user_id, resource_link_id), record in batch],
+                    'launch_infos': [json.dumps(info) for key, (info, info_hash) in batch],
+                    'launch_info_hashes': [info_hash for key, (info, info_hash) in batch],
+                })
+        for key, (info, info_hash) in batch:
+            self.saved_hashes.put(key, info_hash)
+
+    async def close(self):
+        """
+        Stop flushing in the background, and write everything still pending.
+        """
+        if self._task is None:
+            return
+        self._closing = True
+        self._wakeup.set()
+        await self._task
+        while self.pending:
+            try:
+                await self.flush()
+            except Exception:
+                self.dropped += len(self.pending)
+                log.app_log.exception(f'Could not save {len(self.pending)} lti launch infos before exiting, dropping them')
+                return
 
 
-    @gen.coroutine
-    def proxy_post(self, path, cluster_ip, hub):
-        body = self.request.body
-        client_url = f'http://{cluster_ip}{path}'
+class ShardHandler(web.RequestHandler):
+    # Checking nonces with a shared store waits on the database, so keep it off
+    # the event loop. Concurrent launches are checked together.
+    _validator_thread_pool = ThreadPoolExecutor(max_workers=16)
 
-        client = httpclient.AsyncHTTPClient()
+    @concurrent.run_on_executor(executor='_validator_thread_pool')
+    def validate_launch_request(self, launch_url, headers, body_arguments):
+        return self.settings['validator'].validate_body_arguments(launch_url, headers, body_arguments)
 
-        headers = self.request.headers.copy()
+    async def save_lti_info(self, lti_info):
+        user_id = lti_info['user_id']
+        resource_link_id = lti_info['resource_link_id']
+        key = (user_id, resource_link_id)
+        info_hash = launch_info_hash(lti_info)
+        saved_hashes = self.settings['launch_info_hashes']
+        if saved_hashes.get(key) == info_hash:
+            # Relaunch of something we have already saved
+            return
+
+        # Use the sharder's aiopg pool, so this does not hop through a thread.
+        # aiopg connections are in autocommit mode, so the upsert and its commit
+        # are a single round trip.
+        async with self.settings['sharder'].acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(SAVE_LTI_INFO_SQL, {
+                    'user_id': user_id,
+                    'resource_link_id': resource_link_id,
+                    'launch_info': psycopg2.extras.Json(lti_info),
+                    'launch_info_hash': info_hash,
+                })
+        saved_hashes.put(key, info_hash)
+        log.app_log.info(f'Saved lti launch info for user:{user_id} resource_link_id:{resource_link_id}')
+
+
+    async def proxy_post(self, path, cluster_ip, hub, bucket, body):
+        proxy = self.settings['proxy']
+        headers = proxy.upstream_headers(self.request)
         headers['Cookie'] = f'hub={hub}'
-        req = httpclient.HTTPRequest(
-            client_url, method='POST', body=body,
-            headers=headers, follow_redirects=False
-        )
-
-        log.app_log.info(f'Attempting to proxy request to {hub} with url {client_url}')
-        response = yield client.fetch(req, raise_error=False)
 
-        if response.error and type(response.error) is not httpclient.HTTPError:
-            self.set_status(500)
-            self.write(str(response.error))
-            log.app_log.error('Proxying to {hub} failed with error {error}'.format(hub=hub, error=response.error))
-        else:
-            self.set_status(response.code, response.reason)
-
-            # clear tornado default header
-            self._headers = httputil.HTTPHeaders()
-
-            for header, v in response.headers.get_all():
-                if header not in ('Content-Length', 'Transfer-Encoding',
-                    'Content-Encoding', 'Connection'):
-                    # some header appear multiple times, eg 'Set-Cookie'
-                    self.add_header(header, v)
-
-
-            if response.body:
-                self.write(response.body)
+        log.app_log.info(f'Attempting to proxy request to {hub} via {cluster_ip}')
+        # Health is tracked per bucket, so the sharder can be told which ones to avoid
+        error = await proxy.proxy(self, cluster_ip, path, headers, key=bucket, body=body)
+        if error is None:
             log.app_log.info(f'Proxying to {hub} succeeded')
 
 
+    def routed_bucket(self, username):
+        """
+        Bucket username was sent to last time, from their routing token - or None.
+        """
+        signer = self.settings['routing_token_signer']
+        token = self.get_cookie(RoutingTokenSigner.COOKIE_NAME)
+        if signer is None or token is None:
+            return None
+        stats = self.settings['routing_token_stats']
+        routed = signer.verify(token, user=username)
+        # Hubs that have since been removed are not in the map
+        bucket = self.settings['routing_token_buckets'].get(routed[:2]) if routed else None
+        if bucket is None:
+            stats['rejected'] += 1
+            return None
+        stats['used'] += 1
+        return bucket
+
+    def retry_token(self, ticket, body):
+        return self.create_signed_value('admission-retry', json.dumps({
+            'ticket': ticket,
+            'body': body.decode(),
+        })).decode('utf-8')
+
+    def decode_retry_token(self, token):
+        """
+        Return the ticket and original body of a launch resubmitted from the interstitial.
+        """
+        value = web.decode_signed_value(self.settings['cookie_secret'], 'admission-retry', token)
+        if value is None:
+            raise web.HTTPError(401, 'Invalid launch retry token')
+        value = json.loads(value)
+        if time.time() - value['ticket'] > self.settings['admission_retry_window']:
+            raise web.HTTPError(401, 'Launch has expired, please launch again from your course')
+        return value['ticket'], value['body'].encode()
+
+    def reject_launch(self, error, ticket, body):
+        """
+        Send someone who could not be let through right now back to the interstitial, if possible.
+        """
+        log.app_log.warning(f'{error.message}, with {error.position} launches ahead')
+        retry = self.settings['admission_retry_interval']
+        # The hub rejects launches that are too old, so only let people wait
+        # while theirs is still fresh
+        if not self.settings['admission_interstitial'] or \
+                time.time() + retry - ticket > self.settings['admission_retry_window']:
+            self.set_status(503)
+            self.set_header('Retry-After', str(retry))
+            self.write('Too many people are launching right now, please launch again from your course in a minute')
+            return
+        self.write(INTERSTITIAL_HTML.format(
+            position=error.position,
+            retry=retry,
+            action=xhtml_escape(self.request.uri),
+            token=xhtml_escape(self.retry_token(ticket, body)),
+        ))
+
     @gen.coroutine
     def post(self):
-        validator = LTILaunchValidator(self.settings['consumers'])
-        args = {}
-        for k, values in self.request.body_arguments.items():
-            args[k] = values[0].decode() if len(values) == 1 else [v.decode() for v in values]
+        retry_token = self.get_body_argument('admission_retry', None)
+        if retry_token is not None:
+            # Validated (and saved) when it first arrived, before it was sent to the interstitial
+            ticket, body = self.decode_retry_token(retry_token)
+            username = urllib.parse.parse_qs(body.decode())['user_id'][0]
+            bucket = self.routed_bucket(username) or (yield self.settings['sharder'].shard(username))
+            yield self.admit_and_proxy(bucket, ticket, body)
+            return
 
         username = self.get_body_argument('user_id')
 
@@ -122,52 +370,239 @@ class ShardHandler(web.RequestHandler):
         launch_url = protocol + "://" + self.request.host + self.request.uri
 
         try:
-            if validator.validate_launch_request(
-                    launch_url,
-                    self.request.headers,
-                    args
-            ):
-                log.app_log.info(f'Validated LTI request for user {username}')
-                # Should be pushed into a db later
-                auth_state = {k: v for k, v in args.items() if not k.startswith('oauth_')}
+            args = yield self.validate_launch_request(launch_url, self.request.headers, self.request.body_arguments)
+            log.app_log.info(f'Validated LTI request for user {username}')
+            # Should be pushed into a db later
+            auth_state = {k: v for k, v in args.items() if not k.startswith('oauth_')}
         except LTILaunchValidationError as e:
             log.app_log.error(f'LTI Validation failed for user {username}')
             raise web.HTTPError(401, e.message + self.request.full_url() + self.request.body.decode())
-
-        shard_info = json.loads((yield self.shard(username)))
-
-        yield self.save_lti_info(auth_state)
-
-        yield self.proxy_post(self.request.path, shard_info['cluster'], shard_info['hub'])
-
-
-def main():
-    log.enable_pretty_logging()
-
+        except NonceStoreUnavailable as e:
+            log.app_log.error(f'Could not check LTI nonce for user {username}: {e.message}')
+            raise web.HTTPError(503, 'Could not validate launch, try again shortly')
+
+        # Returning users with a valid routing token do not need sharding at all
+        bucket = self.routed_bucket(username)
+        writer = self.settings['launch_info_writer']
+        if writer is not None:
+            # Only waits if too many writes are already queued up
+            try:
+                yield writer.put(auth_state)
+            except Exception:
+                raise web.HTTPError(503, 'Could not save launch info, try again shortly')
+            if bucket is None:
+                bucket = yield self.settings['sharder'].shard(username)
+        elif bucket is not None:
+            yield self.save_lti_info(auth_state)
+        else:
+            # Neither depends on the other, so wait for both at once
+            bucket, _ = yield [self.settings['sharder'].shard(username), self.save_lti_info(auth_state)]
+        yield self.admit_and_proxy(bucket, time.time(), self.request.body)
+
+    async def admit_and_proxy(self, bucket, ticket, body):
+        shard_info = json.loads(bucket)
+        admission = self.settings['admission']
+        if admission is None:
+            await self.proxy_post(self.request.path, shard_info['cluster'], shard_info['hub'], bucket, body)
+            return
+        try:
+            await admission.admit(bucket, ticket, self.settings['admission_wait'])
+        except AdmissionRejected as e:
+            self.reject_launch(e, ticket, body)
+            return
+        try:
+            await self.proxy_post(self.request.path, shard_info['cluster'], shard_info['hub'], bucket, body)
+        finally:
+            admission.release(bucket)
+
+
+class StatsHandler(web.RequestHandler):
+    def get(self):
+        sharder = self.settings['sharder']
+        writer = self.settings['launch_info_writer']
+        # With more than one worker process, these are for whichever one answered
+        self.write({
+            'pid': os.getpid(),
+            'sharder_pool': sharder.pool.stats(),
+            'sharder_async_pool': sharder.async_pool_stats(),
+            'sharder_replica_pool': sharder.replica_pool.stats() if sharder.replica_pool else None,
+            'sharder': self.settings['sharder_stats'].stats(),
+            'lti_launch_info_pool': self.settings['dbpool'].stats(),
+            'launch_info_writer': writer.stats() if writer else None,
+            'upstreams': self.settings['proxy'].health(),
+            'admission': self.settings['admission'].stats() if self.settings['admission'] else None,
+            'routing_token': self.settings['routing_token_stats'],
+            'snapshot_watermark': sharder.snapshot.watermark if sharder.snapshot else None,
+            'cache': {
+                'size': len(sharder.cache),
+                'hits': sharder.cache.hits,
+                'misses': sharder.cache.misses,
+            },
+        })
+
+
+class MetricsHandler(web.RequestHandler):
+    def get(self):
+        self.set_header('Content-Type', prometheus_client.CONTENT_TYPE_LATEST)
+        self.write(metrics.generate_latest())
+
+
+def make_app():
     username = os.environ['SHARDER_DB_USERNAME']
     password = os.environ['SHARDER_DB_PASSWORD']
     dbname = os.environ['SHARDER_DB_NAME']
-    consumers = {os.environ['LTI_KEY']: os.environ['LTI_SECRET']}
     # Stringify each line so we can use it as keys
     sharder_buckets = [l for l in json.loads(os.environ['SHARDER_BUCKETS']).split('\n') if l.strip()]
-    sharder = Sharder('localhost', username, password, dbname, 'hub', sharder_buckets, log.app_log)
-    dbpool = psycopg2.pool.ThreadedConnectionPool(1, 4, user=username, host='localhost', password=password, dbname=dbname)
-
-    with dbpool.getconn() as conn:
-        try:
+    # With a snapshot shared by every process on the node, there is no need
+    # for each of them to preload its own copy of all the assignments
+    snapshot_path = os.environ.get('SHARDER_SNAPSHOT_PATH')
+    sharder_stats = StatsObserver()
+    observers = [sharder_stats]
+    if prometheus_client is not None:
+        observers.append(PrometheusObserver())
+    # With an admin token for the hubs, new users go to whichever hub is running
+    # the fewest servers. Hubs are asked through their cluster's inner-edge, the
+    # same way launches reach them. Listing every user is not cheap for a hub,
+    # so our worker processes take turns asking and share the answer.
+    load_signal = None
+    load_poll_interval = float(os.environ.get('SHARDER_LOAD_POLL_INTERVAL', 15))
+    if os.environ.get('HUB_API_TOKEN'):
+        hubs = {bucket: json.loads(bucket) for bucket in sharder_buckets}
+        load_signal = SharedLoadSignal(
+            HubActiveServersSignal(
+                {bucket: f'http://{hub["cluster"]}/hub/api' for bucket, hub in hubs.items()},
+                os.environ['HUB_API_TOKEN'],
+                headers={bucket: {'Cookie': f'hub={hub["hub"]}'} for bucket, hub in hubs.items()}
+            ),
+            os.path.join(tempfile.gettempdir(), 'sharder-hub-loads.json'),
+            load_poll_interval
+        )
+    sharder = AsyncSharder(
+        'localhost', username, password, dbname, 'hub', sharder_buckets, log.app_log,
+        load_signal=load_signal, load_poll_interval=load_poll_interval,
+        preload=snapshot_path is None, placement=os.environ.get('SHARDER_PLACEMENT', 'least-loaded'),
+        replica_dsn=os.environ.get('SHARDER_DB_REPLICA_DSN'),
+        snapshot_path=snapshot_path, snapshot_refresh_interval=300 if snapshot_path else None,
+        observers=observers, log_sample_rate=float(os.environ.get('SHARDER_LOG_SAMPLE_RATE', 1))
+    )
+    # Launches wait on nonce checks, so a hung database must not hang them too
+    db_timeout = float(os.environ.get('LTI_DB_TIMEOUT', 5))
+    dbpool = ConnectionPool(
+        4, db_timeout, user=username, host='localhost', password=password, dbname=dbname,
+        connect_timeout=max(2, math.ceil(db_timeout)), options=f'-c statement_timeout={int(db_timeout * 1000)}'
+    )
+
+    conn = dbpool.getconn()
+    try:
+        with conn:
             with conn.cursor() as cur:
                 cur.execute(SCHEMA)
                 conn.commit()
             log.app_log.info('Finished running schema creation SQL')
-        finally:
-            dbpool.putconn(conn)
+    finally:
+        dbpool.putconn(conn)
+
+    # Nonces must be shared to safely run more than one replica
+    nonces = None
+    if os.environ.get('LTI_NONCE_STORE', 'local') == 'postgres':
+        nonces = PostgresNonceStore(dbpool, log.app_log, timeout=db_timeout)
+    validator = LTILaunchValidator(consumers_from_env(os.environ), nonces)
+
+    # Hash of the launch info last saved for each (user_id, resource_link_id).
+    # AssignmentCache is just a bounded LRU.
+    launch_info_hashes = AssignmentCache(100000)
+
+    # Save launch info in the background, rather than before proxying each launch
+    launch_info_writer = None
+    if os.environ.get('LTI_INFO_WRITE_BEHIND', 'false') == 'true':
+        launch_info_writer = LaunchInfoWriter(
+            sharder, launch_info_hashes, float(os.environ.get('LTI_INFO_FLUSH_INTERVAL', 0.25)),
+            max_wait=float(os.environ.get('LTI_INFO_MAX_WAIT', 5)),
+        )
 
-    application = web.Application([
+    proxy = UpstreamProxy(
+        max_clients=int(os.environ.get('PROXY_MAX_CLIENTS', 20)),
+        connect_timeout=float(os.environ.get('PROXY_CONNECT_TIMEOUT', 5)),
+        request_timeout=float(os.environ.get('PROXY_REQUEST_TIMEOUT', 30)),
+        failure_threshold=int(os.environ.get('PROXY_FAILURE_THRESHOLD', 5)),
+        slow_threshold=float(os.environ.get('PROXY_SLOW_THRESHOLD', 10)),
+        cooldown=float(os.environ.get('PROXY_COOLDOWN', 30)),
+        # New users are kept off hubs that are failing
+        on_health_change=sharder.set_unhealthy,
+    )
+    probe_interval = float(os.environ.get('PROXY_PROBE_INTERVAL', 0))
+    if probe_interval > 0:
+        targets = {}
+        for bucket in sharder_buckets:
+            shard_info = json.loads(bucket)
+            targets[bucket] = (shard_info['cluster'], {'Cookie': f'hub={shard_info["hub"]}'})
+        ioloop.IOLoop.current().spawn_callback(
+            proxy.probe_forever, targets, os.environ.get('PROXY_PROBE_PATH', '/hub/api'), probe_interval
+        )
+
+    # Hold back launch bursts, so each hub gets them at a rate it can keep up with
+    admission = None
+    admission_max_concurrent = int(os.environ.get('ADMISSION_MAX_CONCURRENT', 0))
+    admission_rate = float(os.environ.get('ADMISSION_RATE', 0))
+    if admission_max_concurrent or admission_rate:
+        admission = AdmissionController(
+            max_concurrent=admission_max_concurrent,
+            rate=admission_rate,
+            burst=int(os.environ.get('ADMISSION_BURST', 10)),
+            max_queue=int(os.environ.get('ADMISSION_MAX_QUEUE', 500)),
+        )
+    # Resubmitting a launch from the interstitial needs a secret to sign it with
+    admission_interstitial = 'COOKIE_SECRET' in os.environ and \
+        os.environ.get('ADMISSION_INTERSTITIAL', 'false') == 'true'
+
+    # Verifies the routing tokens hubs hand out, see routingtoken.py. Takes
+    # comma separated secrets, newest first, to rotate them.
+    routing_token_signer = None
+    if 'ROUTING_TOKEN_SECRET' in os.environ:
+        routing_token_signer = RoutingTokenSigner(os.environ['ROUTING_TOKEN_SECRET'].split(','))
+    routing_token_buckets = {}
+    for bucket in sharder_buckets:
+        shard_info = json.loads(bucket)
+        routing_token_buckets[(shard_info['hub'], shard_info['cluster'])] = bucket
+
+    handlers = [
         (r"/hub/lti/launch", ShardHandler),
-    ], sharder=sharder, consumers=consumers, debug=True, dbpool=dbpool)
-    http_server = httpserver.HTTPServer(application)
-    http_server.listen(8888)
-    ioloop.IOLoop.current().start()
+        (r"/sharder/stats", StatsHandler),
+    ]
+    if prometheus_client is not None:
+        handlers.append((r"/sharder/metrics", MetricsHandler))
+    application = DrainableApplication(
+        handlers, sharder=sharder, sharder_stats=sharder_stats, validator=validator,
+        dbpool=dbpool, launch_info_writer=launch_info_writer, launch_info_hashes=launch_info_hashes,
+        proxy=proxy, admission=admission,
+        admission_wait=float(os.environ.get('ADMISSION_WAIT', 5)),
+        admission_interstitial=admission_interstitial,
+        admission_retry_interval=int(os.environ.get('ADMISSION_RETRY_INTERVAL', 3)),
+        # Has to be less than how old the hub lets launches be (30s)
+        admission_retry_window=float(os.environ.get('ADMISSION_RETRY_WINDOW', 25)),
+        cookie_secret=os.environ.get('COOKIE_SECRET'),
+        routing_token_signer=routing_token_signer, routing_token_buckets=routing_token_buckets,
+        routing_token_stats={'used': 0, 'rejected': 0},
+    )
+    if launch_info_writer is not None:
+        application.shutdown_callbacks.append(launch_info_writer.close)
+    application.shutdown_callbacks.append(sharder.close_async_pools)
+    return application
+
+
+def main():
+    log.enable_pretty_logging()
+
+    processes = int(os.environ.get('WORKER_PROCESSES', 1))
+    if processes > 1 and os.environ.get('LTI_NONCE_STORE', 'local') != 'postgres':
+        # Each worker would have its own nonces, letting launches be replayed against the others
+        log.app_log.error('Set LTI_NONCE_STORE=postgres to run more than one worker process')
+        sys.exit(1)
+    if processes > 1 and prometheus_client is not None and metrics.MULTIPROC_DIR is None:
+        log.app_log.warning('Set PROMETHEUS_MULTIPROC_DIR, or /sharder/metrics only has one worker\'s metrics')
+    metrics.reset_multiprocess_dir()
+
+    serve(make_app, 8888, processes, on_worker_exit=metrics.mark_process_dead)
 
 
 if __name__ == "__main__":
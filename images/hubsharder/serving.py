@@ -0,0 +1,168 @@
+"""
+Production serving for our tornado apps.
+
+Runs one or more worker processes, each listening on the same port with
+SO_REUSEPORT so the kernel spreads connections across them. Everything that
+talks to the database is created inside each worker (by make_app), so every
+worker gets its own pools. On SIGTERM, workers stop accepting connections and
+finish the requests they are in the middle of before exiting.
+"""
+import asyncio
+import os
+import signal
+import time
+
+from tornado import httpserver, ioloop, log, netutil, web
+
+STOP_SIGNALS = {signal.SIGTERM, signal.SIGINT}
+
+
+def _connection_closed(request):
+    stream = getattr(request.connection, 'stream', None)
+    return stream is None or stream.closed()
+
+
+class DrainableApplication(web.Application):
+    """
+    Application that keeps track of requests in flight, so they can be drained.
+
+    Requests whose connection has closed are not counted, even if they never
+    finished (such as when finish() raised on the closed connection), since
+    nothing more can be sent on them.
+
+    Callables in shutdown_callbacks are called (and awaited, if they return
+    an awaitable) once draining is done, before the worker exits.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.shutdown_callbacks = []
+        self._requests = set()
+        self._prune_at = 100
+
+    @property
+    def in_flight(self):
+        self._requests = {r for r in self._requests if not _connection_closed(r)}
+        return len(self._requests)
+
+    def find_handler(self, request, **kwargs):
+        # Called once the headers of a request have arrived, unlike
+        # start_request, which is also called for idle keep-alive connections
+        self._requests.add(request)
+        if len(self._requests) >= self._prune_at:
+            # Do not hold on to requests that never finished for ever
+            self._prune_at = 2 * self.in_flight + 100
+        return super().find_handler(request, **kwargs)
+
+    def log_request(self, handler):
+        self._requests.discard(handler.request)
+        super().log_request(handler)
+
+
+async def drain(server, application, timeout):
+    server.stop()
+    deadline = time.monotonic() + timeout
+    while application.in_flight > 0 and time.monotonic() < deadline:
+        await asyncio.sleep(0.1)
+    if application.in_flight > 0:
+        log.app_log.warning(f'Exiting with {application.in_flight} requests still in flight')
+    for callback in application.shutdown_callbacks:
+        try:
+            result = callback()
+            if result is not None:
+                await result
+        except Exception:
+            log.app_log.exception('Shutdown callback failed')
+
+
+def run_worker(make_app, port, drain_timeout):
+    application = make_app()
+    server = httpserver.HTTPServer(application)
+    server.add_sockets(netutil.bind_sockets(port, reuse_port=True))
+    loop = ioloop.IOLoop.current()
+
+    async def shutdown():
+        log.app_log.info(f'Draining worker {os.getpid()}')
+        await drain(server, application, drain_timeout)
+        loop.stop()
+
+    def handle_signal(signum, frame):
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        loop.add_callback_from_signal(shutdown)
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+    # Forked workers start with these blocked, so none are lost before here
+    signal.pthread_sigmask(signal.SIG_UNBLOCK, STOP_SIGNALS)
+    loop.start()
+
+
+def serve(make_app, port, processes=1, drain_timeout=25, on_worker_exit=None):
+    """
+    Serve the DrainableApplication returned by make_app on port.
+
+    With more than one process, make_app is called separately in each forked
+    worker. Workers that die are restarted, and SIGTERM is passed on to all of
+    them. drain_timeout should be a little less than the pod's termination
+    grace period. on_worker_exit, if given, is called with the pid of every
+    worker that exits.
+    """
+    if processes <= 1:
+        run_worker(make_app, port, drain_timeout)
+        return
+
+    children = {}
+    stopping = False
+
+    def start_child():
+        # Signals are held back until the worker has its own handlers, and
+        # until we have recorded the worker, so that no worker is started
+        # after a SIGTERM or misses one
+        signal.pthread_sigmask(signal.SIG_BLOCK, STOP_SIGNALS)
+        try:
+            if stopping:
+                return
+            pid = os.fork()
+            if pid == 0:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                try:
+                    run_worker(make_app, port, drain_timeout)
+                except Exception:
+                    log.app_log.exception('Worker failed')
+                    os._exit(1)
+                os._exit(0)
+            children[pid] = time.monotonic()
+        finally:
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, STOP_SIGNALS)
+
+    def handle_signal(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+
+    for i in range(processes):
+        start_child()
+    log.app_log.info(f'Started {processes} workers on port {port}')
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        started = children.pop(pid, None)
+        if started is not None and on_worker_exit is not None:
+            on_worker_exit(pid)
+        if started is None or stopping:
+            continue
+        log.app_log.error(f'Worker {pid} exited with status {status}, restarting it')
+        # Don't spin if workers die as soon as they start
+        if time.monotonic() - started < 1:
+            time.sleep(1)
+        start_child()
@@ -0,0 +1,93 @@
+import asyncio
+
+import pytest
+
+from admission import AdmissionController, AdmissionRejected
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+def test_admits_in_ticket_order():
+    admission = AdmissionController(max_concurrent=1)
+    admitted = []
+
+    async def launch(ticket):
+        await admission.admit('hub-a', ticket, timeout=5)
+        admitted.append(ticket)
+
+    async def main():
+        await admission.admit('hub-a', 0, timeout=5)
+        # Queued in the order they arrive, let through in the order of their tickets
+        launches = [asyncio.ensure_future(launch(ticket)) for ticket in (3, 1, 2)]
+        await asyncio.sleep(0)
+        assert admission.stats()['hub-a'] == {'in_flight': 1, 'queued': 3, 'tokens': 10}
+        for i in range(3):
+            admission.release('hub-a')
+            await asyncio.sleep(0)
+        await asyncio.gather(*launches)
+        # Other hubs are not held up by this one
+        await admission.admit('hub-b', 4, timeout=0)
+
+    run(main())
+    assert admitted == [1, 2, 3]
+
+
+def test_timeout():
+    admission = AdmissionController(max_concurrent=1)
+
+    async def main():
+        await admission.admit('hub-a', 0, timeout=5)
+        ahead = asyncio.ensure_future(admission.admit('hub-a', 1, timeout=5))
+        behind = asyncio.ensure_future(admission.admit('hub-a', 3, timeout=5))
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejected, match='Timed out') as e:
+            await admission.admit('hub-a', 2, timeout=0.01)
+        # Only launches with earlier tickets are ahead
+        assert e.value.position == 1
+        assert admission.stats()['hub-a']['queued'] == 2
+        admission.release('hub-a')
+        await ahead
+        admission.release('hub-a')
+        await behind
+
+    run(main())
+
+
+def test_rejected_when_queue_is_full():
+    admission = AdmissionController(max_concurrent=1, max_queue=2)
+
+    async def main():
+        await admission.admit('hub-a', 0, timeout=5)
+        queued = [asyncio.ensure_future(admission.admit('hub-a', ticket, timeout=5)) for ticket in (1, 5)]
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejected, match='is full') as e:
+            await admission.admit('hub-a', 3, timeout=5)
+        assert e.value.position == 1
+        with pytest.raises(AdmissionRejected, match='is full') as e:
+            await admission.admit('hub-a', 0.5, timeout=5)
+        assert e.value.position == 0
+        for future in queued:
+            admission.release('hub-a')
+            await future
+
+    run(main())
+
+
+def test_rate_limit():
+    admission = AdmissionController(max_concurrent=0, rate=100, burst=1)
+
+    async def main():
+        await admission.admit('hub-a', 0, timeout=5)
+        # Out of tokens, so this waits for the next one about 10ms later
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        await admission.admit('hub-a', 1, timeout=5)
+        assert loop.time() - start >= 0.005
+
+    run(main())
@@ -0,0 +1,233 @@
+import logging
+import os
+import threading
+import time
+import urllib.parse
+import uuid
+from concurrent.futures import Future
+
+import psycopg2
+import psycopg2.pool
+import pytest
+from oauthlib.oauth1 import Client, SIGNATURE_TYPE_BODY
+from oauthlib.oauth1.rfc5849 import signature
+from tornado.httputil import HTTPHeaders, parse_body_arguments
+
+from ltivalidator import (
+    LTILaunchValidator, LTILaunchValidationError, NonceStore, NonceStoreUnavailable, PostgresNonceStore
+)
+
+LAUNCH_URL = 'https://data8x.berkeley.edu/hub/lti/launch'
+
+# Same database as the sharder tests. Tests that need one are skipped if it
+# can not be reached.
+DB_ARGS = {
+    'host': os.environ.get('SHARDER_TEST_DB_HOST', 'localhost'),
+    'user': os.environ.get('SHARDER_TEST_DB_USERNAME', 'postgres'),
+    'password': os.environ.get('SHARDER_TEST_DB_PASSWORD', ''),
+    'dbname': os.environ.get('SHARDER_TEST_DB_NAME', 'sharder_test'),
+}
+
+@pytest.fixture
+def pool():
+    try:
+        psycopg2.connect(**DB_ARGS).close()
+    except psycopg2.OperationalError as e:
+        pytest.skip(f'No postgres database available: {e}')
+    pool = psycopg2.pool.ThreadedConnectionPool(1, 4, **DB_ARGS)
+    yield pool
+    pool.closeall()
+
+@pytest.fixture
+def consumer_key():
+    # Every test gets its own consumer, so they do not see each other's nonces
+    return f'key-{uuid.uuid4().hex}'
+
+
+def sign(args, key='key', secret='secret', timestamp=None, nonce=None):
+    """
+    Sign a launch with args like edX would, returning (headers, tornado body_arguments).
+    """
+    client = Client(
+        key, client_secret=secret, signature_type=SIGNATURE_TYPE_BODY,
+        timestamp=None if timestamp is None else str(timestamp), nonce=nonce
+    )
+    uri, headers, body = client.sign(
+        LAUNCH_URL, 'POST', urllib.parse.urlencode(args),
+        {'Content-Type': 'application/x-www-form-urlencoded'}
+    )
+    body_arguments = {}
+    parse_body_arguments(headers['Content-Type'], body.encode(), body_arguments, {})
+    return HTTPHeaders(headers), body_arguments
+
+
+def oauthlib_base_string(headers, args_list):
+    # Renamed in oauthlib 3
+    construct = getattr(signature, 'signature_base_string', None) or signature.construct_base_string
+    return construct(
+        'POST',
+        signature.normalize_base_string_uri(LAUNCH_URL),
+        signature.normalize_parameters(signature.collect_parameters(body=args_list, headers=headers))
+    )
+
+
+def test_nonce_store_rejects_replay():
+    nonces = NonceStore()
+    now = int(time.time())
+    assert nonces.add('key', now, 'abc')
+    assert not nonces.add('key', now, 'abc')
+    assert nonces.seen('key', now, 'abc')
+    # Nonces are per consumer and timestamp
+    assert nonces.add('other-key', now, 'abc')
+    assert nonces.add('key', now - 1, 'abc')
+    assert len(nonces) == 3
+
+
+def test_nonce_store_window():
+    nonces = NonceStore(window=30)
+    now = int(time.time())
+    assert not nonces.add('key', now - 31, 'abc')
+    assert nonces.add('key', now - 29, 'abc')
+
+
+def test_nonce_store_size_floor():
+    nonces = NonceStore(window=30, max_size=2)
+    now = int(time.time())
+    assert nonces.add('key', now - 10, 'a')
+    assert nonces.add('key', now - 5, 'b')
+    # Pushes out now - 10 while it is still inside the window
+    assert nonces.add('key', now, 'c')
+    assert len(nonces) == 2
+    assert nonces.floor == now - 10
+    # Everything at or before it is refused, since we can not tell replays apart
+    assert not nonces.add('key', now - 10, 'a')
+    assert not nonces.add('key', now - 10, 'new')
+    assert nonces.add('key', now - 1, 'new')
+
+
+def test_validator_rejects_replay():
+    validator = LTILaunchValidator({'key': 'secret'}, nonces=NonceStore())
+    headers, body_arguments = sign({'user_id': 'yuvipanda'})
+    assert validator.validate_body_arguments(LAUNCH_URL, headers, body_arguments)['user_id'] == 'yuvipanda'
+    with pytest.raises(LTILaunchValidationError, match='already used'):
+        validator.validate_body_arguments(LAUNCH_URL, headers, body_arguments)
+
+
+def test_validator_rejects_launches_from_before_the_store():
+    validator = LTILaunchValidator({'key': 'secret'}, nonces=NonceStore())
+    # Inside the allowed clock skew, but the store can not know if it is a replay
+    headers, body_arguments = sign({'user_id': 'yuvipanda'}, timestamp=validator.nonces.valid_since - 1)
+    with pytest.raises(LTILaunchValidationError, match='too old'):
+        validator.validate_body_arguments(LAUNCH_URL, headers, body_arguments)
+
+
+def test_postgres_nonce_store_shared(pool, consumer_key):
+    log = logging.getLogger('test')
+    first = PostgresNonceStore(pool, log)
+    second = PostgresNonceStore(pool, log)
+    now = int(time.time())
+    assert first.add(consumer_key, now, 'abc')
+    # Replays are caught by other processes, who have never seen the nonce
+    assert not second.add(consumer_key, now, 'abc')
+    assert second.add(consumer_key, now, 'def')
+    assert not first.add(consumer_key, now - 31, 'old')
+
+
+def test_postgres_nonce_store_local_filter(pool, consumer_key):
+    nonces = PostgresNonceStore(pool, logging.getLogger('test'))
+    now = int(time.time())
+    assert nonces.add(consumer_key, now, 'abc')
+
+    # Replays this process has seen are rejected without asking the database
+    def unreachable():
+        raise psycopg2.OperationalError('database is down')
+    pool.getconn = unreachable
+    assert not nonces.add(consumer_key, now, 'abc')
+
+
+def test_postgres_nonce_store_timeout(pool, consumer_key):
+    nonces = PostgresNonceStore(pool, logging.getLogger('test'), timeout=0.2)
+    hung = threading.Event()
+    getconn = pool.getconn
+
+    def hanging_getconn():
+        hung.wait()
+        return getconn()
+    pool.getconn = hanging_getconn
+    try:
+        start = time.monotonic()
+        with pytest.raises(NonceStoreUnavailable):
+            nonces.add(consumer_key, int(time.time()), 'abc')
+        assert time.monotonic() - start < 1
+    finally:
+        hung.set()
+
+
+def test_postgres_nonce_store_batch(pool, consumer_key):
+    nonces = PostgresNonceStore(pool, logging.getLogger('test'))
+    now = int(time.time())
+    nonces.add(consumer_key, now, 'used')
+    batch = [((consumer_key, now, nonce), Future()) for nonce in ('abc', 'abc', 'used', 'def')]
+    nonces._write(batch, cleanup=True)
+    # The same nonce twice in one batch is a replay of itself
+    assert [future.result() for key, future in batch] == [True, False, False, True]
+
+
+@pytest.mark.parametrize('args_list', [
+    [('user_id', 'yuvipanda'), ('oauth_nonce', '123'), ('oauth_signature', 'ignored')],
+    # Percent encoded, and characters that need to be
+    [('custom_path', 'a%20b/100%'), ('custom_q', 'x=1&y=2 +~*'), ('a%2Fb', '%'), ('oauth_callback', 'about%3Ablank')],
+    # Repeated names, sorted by value
+    [('roles', 'Student'), ('roles', 'Instructor'), ('roles', 'Student'), ('roles', '')],
+    # Unicode names and values
+    [('custom_name', 'ünïcode 名前 🎉'), ('ключ', 'значение'), ('e\u0301', 'é')],
+    # Names that sort differently escaped and unescaped
+    [('a b', '1'), ('a', '2'), ('a-b', '3'), ('a_b', '4'), ('A', '5'), ('a~', '6')],
+])
+@pytest.mark.parametrize('authorization', [
+    None,
+    'OAuth realm="edx", oauth_consumer_key="key", oauth_nonce="ab%20c", oauth_signature="sig"',
+])
+def test_base_string_matches_oauthlib(args_list, authorization):
+    headers = HTTPHeaders({'Content-Type': 'application/x-www-form-urlencoded'})
+    if authorization:
+        headers['Authorization'] = authorization
+    validator = LTILaunchValidator({'key': 'secret'})
+    assert validator.base_string(LAUNCH_URL, headers, args_list) == oauthlib_base_string(headers, args_list)
+
+
+def test_validator_fast_path():
+    validator = LTILaunchValidator({'key': 'secret'}, nonces=NonceStore())
+    args = [
+        ('user_id', 'yuvipanda'), ('roles', 'Student'), ('roles', 'Instructor'),
+        ('custom_name', 'ünïcode & 100%'), ('ключ', 'значение'),
+    ]
+    headers, body_arguments = sign(args)
+    launch_args = validator.validate_body_arguments(LAUNCH_URL, headers, body_arguments)
+    assert launch_args['user_id'] == 'yuvipanda'
+    assert launch_args['roles'] == ['Student', 'Instructor']
+    assert launch_args['custom_name'] == 'ünïcode & 100%'
+    assert launch_args['ключ'] == 'значение'
+
+
+def test_validator_rejects_tampering():
+    validator = LTILaunchValidator({'key': 'secret'}, nonces=NonceStore())
+    headers, body_arguments = sign({'user_id': 'yuvipanda'})
+    body_arguments['user_id'] = [b'someone-else']
+    with pytest.raises(LTILaunchValidationError, match='Invalid oauth_signature'):
+        validator.validate_body_arguments(LAUNCH_URL, headers, body_arguments)
+
+    headers, body_arguments = sign({'user_id': 'yuvipanda'}, secret='wrong')
+    with pytest.raises(LTILaunchValidationError, match='Invalid oauth_signature'):
+        validator.validate_body_arguments(LAUNCH_URL, headers, body_arguments)
+
+    headers, body_arguments = sign({'user_id': 'yuvipanda'}, key='unknown')
+    with pytest.raises(LTILaunchValidationError, match='not known'):
+        validator.validate_body_arguments(LAUNCH_URL, headers, body_arguments)
+
+
+def test_validator_rotated_secrets():
+    validator = LTILaunchValidator({'key': ['old-secret', 'new-secret']}, nonces=NonceStore())
+    for secret in ('old-secret', 'new-secret'):
+        headers, body_arguments = sign({'user_id': 'yuvipanda'}, secret=secret)
+        validator.validate_body_arguments(LAUNCH_URL, headers, body_arguments)
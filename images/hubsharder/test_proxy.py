@@ -0,0 +1,75 @@
+import pytest
+
+import proxy
+from proxy import CircuitBreaker
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(proxy.time, 'monotonic', clock)
+    return clock
+
+
+def test_breaker_trips(clock):
+    breaker = CircuitBreaker(failure_threshold=3, slow_threshold=10, cooldown=30)
+    assert not breaker.record(False)
+    # Successes reset the count, so only consecutive failures trip it
+    assert not breaker.record(True, 0.1)
+    assert not breaker.record(False)
+    assert not breaker.record(False)
+    assert breaker.allow()
+    assert breaker.record(False)
+    assert breaker.is_open
+    assert not breaker.allow()
+    assert breaker.retry_after() == 30
+    clock.now += 29.5
+    assert not breaker.allow()
+    assert breaker.retry_after() == 1
+
+
+def test_slow_responses_count_as_failures(clock):
+    breaker = CircuitBreaker(failure_threshold=2, slow_threshold=10)
+    breaker.record(True, 11)
+    assert breaker.record(True, 12)
+    assert breaker.is_open
+
+
+def test_breaker_half_open(clock):
+    breaker = CircuitBreaker(failure_threshold=1, cooldown=30)
+    breaker.record(False)
+    clock.now += 30
+    # Only a single trial request is let through after the cooldown
+    assert breaker.allow()
+    assert not breaker.allow()
+    # A failed trial keeps it open for another cooldown
+    assert not breaker.record(False)
+    assert breaker.is_open
+    assert not breaker.allow()
+    clock.now += 29
+    assert not breaker.allow()
+    clock.now += 1
+    assert breaker.allow()
+
+
+def test_breaker_recovers(clock):
+    breaker = CircuitBreaker(failure_threshold=2, cooldown=30)
+    breaker.record(False)
+    breaker.record(False)
+    clock.now += 30
+    assert breaker.allow()
+    assert breaker.record(True, 0.1)
+    assert not breaker.is_open
+    assert breaker.retry_after() == 0
+    assert breaker.allow() and breaker.allow()
+    # Closing resets the failure count too
+    assert not breaker.record(False)
+    assert breaker.stats()['consecutive_failures'] == 1
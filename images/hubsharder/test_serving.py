@@ -0,0 +1,142 @@
+import asyncio
+import os
+import signal
+import socket
+import subprocess
+import sys
+import textwrap
+import time
+
+from tornado import httpclient, httpserver, netutil, web
+
+from serving import DrainableApplication, drain
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+class SlowHandler(web.RequestHandler):
+    async def get(self):
+        await asyncio.sleep(float(self.get_argument('seconds')))
+        self.write('done')
+
+
+def start_server(application):
+    [sock] = netutil.bind_sockets(0, '127.0.0.1')
+    server = httpserver.HTTPServer(application)
+    server.add_sockets([sock])
+    return server, sock.getsockname()[1]
+
+
+def test_drain_waits_for_requests():
+    application = DrainableApplication([(r'/slow', SlowHandler)])
+    closed = []
+    application.shutdown_callbacks.append(lambda: closed.append(True))
+
+    async def main():
+        server, port = start_server(application)
+        client = httpclient.AsyncHTTPClient()
+        response = asyncio.ensure_future(client.fetch(f'http://127.0.0.1:{port}/slow?seconds=0.5'))
+        while application.in_flight == 0:
+            await asyncio.sleep(0.01)
+        start = time.monotonic()
+        await drain(server, application, timeout=5)
+        assert 0.3 < time.monotonic() - start < 2
+        assert (await response).body == b'done'
+        assert application.in_flight == 0
+        # No new connections once draining has started
+        try:
+            await client.fetch(f'http://127.0.0.1:{port}/slow?seconds=0', request_timeout=1)
+            assert False, 'Still accepting requests'
+        except (ConnectionError, OSError, httpclient.HTTPClientError):
+            pass
+
+    run(main())
+    assert closed == [True]
+
+
+def test_drain_skips_closed_connections():
+    application = DrainableApplication([(r'/slow', SlowHandler)])
+
+    async def main():
+        server, port = start_server(application)
+        conn = socket.create_connection(('127.0.0.1', port))
+        conn.sendall(b'GET /slow?seconds=60 HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        while application.in_flight == 0:
+            await asyncio.sleep(0.01)
+        # Gone before the response, which will never be logged
+        conn.close()
+        await asyncio.sleep(0.1)
+        start = time.monotonic()
+        await drain(server, application, timeout=5)
+        assert time.monotonic() - start < 1
+
+    run(main())
+
+
+SERVE_SCRIPT = textwrap.dedent('''
+    import os, sys
+    sys.path.insert(0, {path!r})
+    from tornado import web
+    from serving import DrainableApplication, serve
+
+    class PidHandler(web.RequestHandler):
+        def get(self):
+            self.write(str(os.getpid()))
+
+    def on_worker_exit(pid):
+        print(f'exited {{pid}}', flush=True)
+
+    serve(lambda: DrainableApplication([(r'/pid', PidHandler)]), {port}, 2, drain_timeout=1, on_worker_exit=on_worker_exit)
+''')
+
+
+def get_pid(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1) as conn:
+                conn.sendall(b'GET /pid HTTP/1.0\r\n\r\n')
+                response = b''
+                while True:
+                    chunk = conn.recv(4096)
+                    if not chunk:
+                        break
+                    response += chunk
+            return int(response.split(b'\r\n\r\n', 1)[1])
+        except (OSError, ValueError, IndexError):
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def test_serve_forks_restarts_and_shuts_down(tmpdir):
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    script = tmpdir.join('serve.py')
+    script.write(SERVE_SCRIPT.format(path=os.path.dirname(os.path.abspath(__file__)), port=port))
+    parent = subprocess.Popen([sys.executable, str(script)], stdout=subprocess.PIPE, universal_newlines=True)
+    try:
+        pid = get_pid(port)
+        assert pid != parent.pid
+
+        # Workers that die are replaced, and reported
+        os.kill(pid, signal.SIGKILL)
+        assert parent.stdout.readline().strip() == f'exited {pid}'
+        deadline = time.monotonic() + 10
+        while get_pid(port) == pid and time.monotonic() < deadline:
+            pass
+        assert get_pid(port) != pid
+
+        parent.send_signal(signal.SIGTERM)
+        assert parent.wait(timeout=10) == 0
+    finally:
+        if parent.poll() is None:
+            parent.kill()
+            parent.wait()
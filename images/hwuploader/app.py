@@ -4,8 +4,9 @@ import sys
 import base64
 import json
 from jinja2 import Environment, FileSystemLoader
-from tornado import httpserver, ioloop, web, log
-from ltivalidator import LTILaunchValidator, LTILaunchValidationError
+from tornado import web, log
+from ltivalidator import LTILaunchValidator, LTILaunchValidationError, consumers_from_env
+from serving import DrainableApplication, serve
 
 
 class HomeWorkHandler(web.RequestHandler):
@@ -64,14 +65,7 @@ class HomeWorkHandler(web.RequestHandler):
         if self.request.files:
             return self.finish_upload(hw)
         else:
-            consumers = self.settings['consumers']
-            validator = LTILaunchValidator(consumers)
-
-            args = {}
-            for k, values in self.request.body_arguments.items():
-                # Convert everything to strings rather than bytes
-                args[k] = values[0].decode() if len(values) == 1 else [v.decode() for v in values]
-
+            validator = self.settings['validator']
 
             # handle multiple layers of proxied protocol (comma separated) and take the outermost
             if 'x-forwarded-proto' in self.request.headers:
@@ -85,20 +79,15 @@ class HomeWorkHandler(web.RequestHandler):
             launch_url = protocol + "://" + self.request.host + self.request.uri
 
             try:
-                if validator.validate_launch_request(
-                        launch_url,
-                        self.request.headers,
-                        args
-                ):
-                    user_id = self.get_body_argument('user_id')
-                    log.app_log.info(f'{user_id} successfully logged in')
+                launch_args = validator.validate_body_arguments(
+                    launch_url,
+                    self.request.headers,
+                    self.request.body_arguments
+                )
+                log.app_log.info(f'{launch_args.get("user_id")} successfully logged in')
             except LTILaunchValidationError as e:
                 raise web.HTTPError(401, e.message)
 
-            launch_args = {}
-            for k, values in self.request.body_arguments.items():
-                launch_args[k] = values[0].decode() if len(values) == 1 else [v.decode() for v in values]
-
             signed_launch_args = self.create_signed_value('launch-args', json.dumps(launch_args)).decode('utf-8')
             self.render_template('main.html', signed_launch_args=signed_launch_args)
 
@@ -116,24 +105,20 @@ def main():
         log.app_log.error('UPLOAD_BASE_DIR must end with a trailing /')
         sys.exit(1)
 
-    consumers = {os.environ['LTI_KEY']: os.environ['LTI_SECRET']}
-
     jinja2_env = Environment(loader=FileSystemLoader([os.path.dirname(__file__)]), autoescape=True)
 
     settings = {
         'jinja2_env': jinja2_env,
         'cookie_secret': os.environ['COOKIE_SECRET'],
-        'consumers': consumers,
+        'validator': LTILaunchValidator(consumers_from_env(os.environ)),
         'upload_base_dir': os.environ['UPLOAD_BASE_DIR']
     }
 
-    application = web.Application([
+    # Nonces are kept in memory, so this runs a single worker process - more
+    # would each let launches be replayed against the others
+    serve(lambda: DrainableApplication([
         (r"/hwuploader/(\w+)", HomeWorkHandler),
-    ], **settings)
-
-    http_server = httpserver.HTTPServer(application)
-    http_server.listen(8888)
-    ioloop.IOLoop.current().start()
+    ], **settings), 8888)
 
 
 if __name__ == "__main__":
@@ -3,3 +3,4 @@
 # Run by build.sh before docker image is built
 # Primarily here to make sure we do not have to duplicate sharder.py
 cp ../hubsharder/ltivalidator.py .
+cp ../hubsharder/serving.py .
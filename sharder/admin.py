@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Administer shard assignments.
+
+Assigns names in bulk, recounts bucket populations, sets bucket weights and
+draining, explicitly reassigns names, writes assignment snapshots and reports
+how rendezvous placement would change with a different set of buckets.
+"""
+import argparse
+import json
+import logging
+import os
+
+from sharder import Sharder, rendezvous_bucket
+
+
+def rehash_report(sharder, new_buckets):
+    """
+    Compare every stored assignment of sharder's kind against rendezvous placement.
+
+    Returns counts of how many stored assignments differ from their hashed
+    placement over the current buckets and over new_buckets, and how many hashed
+    placements would move going from one to the other.
+    """
+    report = {
+        'assignments': 0,
+        'differ_from_current': 0,
+        'differ_from_new': 0,
+        'hashed_moves': 0,
+    }
+    conn = sharder.pool.getconn()
+    try:
+        with conn:
+            with conn.cursor(name='sharder_rehash_report') as cur:
+                cur.itersize = 10000
+                cur.execute("""
+                SELECT name, bucket FROM entries_v1
+                WHERE kind=%s AND name != 'dummy-' || bucket
+                """, (sharder.kind, ))
+                for name, bucket in cur:
+                    current = rendezvous_bucket(name, sharder.buckets, sharder.weights)
+                    new = rendezvous_bucket(name, new_buckets, sharder.weights)
+                    report['assignments'] += 1
+                    report['differ_from_current'] += current != bucket
+                    report['differ_from_new'] += new != bucket
+                    report['hashed_moves'] += current != new
+    finally:
+        sharder.pool.putconn(conn)
+    return report
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    argparser.add_argument('--host', default='localhost')
+    argparser.add_argument('kind', help='Kind of object being sharded (hub, homedir, etc)')
+    argparser.add_argument(
+        '--bucket',
+        action='append',
+        dest='buckets',
+        help='Bucket to shard across. Defaults to the lines in $SHARDER_BUCKETS'
+    )
+    subparsers = argparser.add_subparsers(dest='action')
+    subparsers.required = True
+
+    shard_many_parser = subparsers.add_parser(
+        'shard-many',
+        help='Assign every name in a file (one per line) to a bucket, printing name<TAB>bucket'
+    )
+    shard_many_parser.add_argument('names_file', type=argparse.FileType('r'))
+
+    subparsers.add_parser(
+        'recount',
+        help='Recompute bucket populations from entries_v1'
+    )
+
+    set_bucket_parser = subparsers.add_parser(
+        'set-bucket',
+        help='Set the capacity weight or draining state of a bucket'
+    )
+    set_bucket_parser.add_argument('bucket')
+    set_bucket_parser.add_argument('--weight', type=float)
+    set_bucket_parser.add_argument('--drain', dest='draining', action='store_true', default=None)
+    set_bucket_parser.add_argument('--undrain', dest='draining', action='store_false')
+
+    reassign_parser = subparsers.add_parser(
+        'reassign',
+        help='Explicitly place a name in a bucket'
+    )
+    reassign_parser.add_argument('name')
+    reassign_parser.add_argument('bucket')
+
+    snapshot_parser = subparsers.add_parser(
+        'snapshot',
+        help='Write (or incrementally refresh) a memory mappable snapshot of all assignments'
+    )
+    snapshot_parser.add_argument('path')
+
+    rehash_report_parser = subparsers.add_parser(
+        'rehash-report',
+        help='Report how many assignments differ from rendezvous placement after a bucket change'
+    )
+    rehash_report_parser.add_argument('--add', action='append', default=[], help='Bucket to be added')
+    rehash_report_parser.add_argument('--remove', action='append', default=[], help='Bucket to be removed')
+
+    args = argparser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    log = logging.getLogger('sharder')
+
+    buckets = args.buckets
+    if not buckets:
+        buckets = [l for l in json.loads(os.environ['SHARDER_BUCKETS']).split('\n') if l.strip()]
+
+    sharder = Sharder(
+        args.host,
+        os.environ['SHARDER_DB_USERNAME'],
+        os.environ['SHARDER_DB_PASSWORD'],
+        os.environ['SHARDER_DB_NAME'],
+        args.kind, buckets, log
+    )
+
+    if args.action == 'shard-many':
+        names = [l.strip() for l in args.names_file if l.strip()]
+        assignments = sharder.shard_many(names)
+        for name in names:
+            print(f'{name}\t{assignments[name]}')
+    elif args.action == 'recount':
+        sharder.recount()
+    elif args.action == 'set-bucket':
+        sharder.set_bucket(args.bucket, args.weight, args.draining)
+    elif args.action == 'reassign':
+        sharder.reassign(args.name, args.bucket)
+    elif args.action == 'snapshot':
+        sharder.export_snapshot(args.path)
+    elif args.action == 'rehash-report':
+        new_buckets = [b for b in buckets if b not in args.remove] + args.add
+        report = rehash_report(sharder, new_buckets)
+        for key, value in report.items():
+            print(f'{key}\t{value}')
+
+
+if __name__ == '__main__':
+    main()
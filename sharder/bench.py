@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""
+Benchmark Sharder under a simulated launch storm.
+
+Runs a number of shard calls against a postgres database at a given
+concurrency, with a mix of new and returning users, and reports latency
+percentiles, throughput, how much time queries spent waiting on locks, and
+how long shard calls waited for a connection from a pool of --pool-size.
+
+Use this to size the database and the sharder's connection pool before a
+semester, and to catch regressions when the sharding SQL changes. Every run
+uses a fresh kind, so it is safe to point at a shared (non production!)
+database. The in-process cache is off by default, so every call hits the
+database - pass --cache-size to measure what launches actually see.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import psycopg2
+
+from sharder import Sharder, AsyncSharder, StatsObserver
+
+
+def percentile_ms(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[index] * 1000
+
+
+class LockWaitSampler:
+    """
+    Periodically count queries waiting on a lock in our database.
+    """
+    def __init__(self, db_args, interval=0.05):
+        host, username, password, dbname = db_args
+        self.conn = psycopg2.connect(host=host, user=username, password=password, dbname=dbname)
+        self.conn.autocommit = True
+        self.interval = interval
+        self.samples = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        with self.conn.cursor() as cur:
+            while not self._stop.wait(self.interval):
+                cur.execute("""
+                SELECT count(*) FROM pg_stat_activity
+                WHERE datname = current_database() AND wait_event_type = 'Lock'
+                """)
+                self.samples.append(cur.fetchone()[0])
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._thread.join()
+        self.conn.close()
+
+
+def make_workload(args):
+    """
+    List of names to shard, and the returning users that need to exist beforehand.
+    """
+    existing = [f'existing-{i}' for i in range(args.existing_users)]
+    names = []
+    for i in range(args.requests):
+        if not existing or random.random() < args.new_ratio:
+            names.append(f'new-{uuid.uuid4().hex}')
+        else:
+            names.append(random.choice(existing))
+    return names, existing
+
+
+def run_threaded(sharder, names, concurrency):
+    def timed_shard(name):
+        start = time.perf_counter()
+        try:
+            sharder.shard(name)
+            return time.perf_counter() - start, None
+        except Exception as e:
+            return time.perf_counter() - start, e
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return list(executor.map(timed_shard, names))
+
+
+def run_async(sharder, names, concurrency):
+    async def run():
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def timed_shard(name):
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    await sharder.shard(name)
+                    return time.perf_counter() - start, None
+                except Exception as e:
+                    return time.perf_counter() - start, e
+
+        results = await asyncio.gather(*[timed_shard(name) for name in names])
+        await sharder.close_async_pools()
+        return results
+    return asyncio.get_event_loop().run_until_complete(run())
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    argparser.add_argument('--host', default=os.environ.get('SHARDER_DB_HOST', 'localhost'))
+    argparser.add_argument('--requests', type=int, default=10000, help='Total number of shard calls')
+    argparser.add_argument('--concurrency', type=int, default=4, help='Shard calls in flight at once')
+    argparser.add_argument('--new-ratio', type=float, default=0.1, help='Fraction of calls for users never seen before')
+    argparser.add_argument('--existing-users', type=int, default=10000, help='Returning users to create beforehand')
+    argparser.add_argument('--buckets', type=int, default=10, help='Number of buckets to shard across')
+    argparser.add_argument('--cache-size', type=int, default=0, help='Size of the in-process assignment cache')
+    argparser.add_argument('--pool-size', type=int, default=4, help='Database connections in the sharder\'s pool')
+    argparser.add_argument('--async', dest='use_async', action='store_true', help='Use AsyncSharder')
+    argparser.add_argument('--json', action='store_true', help='Print results as JSON')
+    args = argparser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    log = logging.getLogger('bench')
+
+    db_args = (
+        args.host,
+        os.environ['SHARDER_DB_USERNAME'],
+        os.environ['SHARDER_DB_PASSWORD'],
+        os.environ['SHARDER_DB_NAME'],
+    )
+    kind = f'bench-{uuid.uuid4().hex}'
+    buckets = [f'bucket-{i}' for i in range(args.buckets)]
+    stats = StatsObserver()
+    if args.use_async:
+        sharder = AsyncSharder(*db_args, kind, buckets, log, cache_size=args.cache_size, async_pool_size=args.pool_size)
+        pool_stats = sharder.async_pool_stats
+    else:
+        sharder = Sharder(*db_args, kind, buckets, log, cache_size=args.cache_size, pool_size=args.pool_size)
+        pool_stats = sharder.pool.stats
+
+    names, existing = make_workload(args)
+    if existing:
+        sharder.shard_many(existing)
+    # Only observe the storm itself, not the setup
+    sharder.observers.append(stats)
+    pool_before = pool_stats()
+
+    with LockWaitSampler(db_args) as sampler:
+        start = time.perf_counter()
+        if args.use_async:
+            results = run_async(sharder, names, args.concurrency)
+        else:
+            results = run_threaded(sharder, names, args.concurrency)
+        elapsed = time.perf_counter() - start
+    pool_after = pool_stats()
+
+    latencies = sorted(latency for latency, error in results if error is None)
+    errors = [error for latency, error in results if error is not None]
+    report = {
+        'kind': kind,
+        'requests': len(results),
+        'errors': len(errors),
+        'concurrency': args.concurrency,
+        'new_ratio': args.new_ratio,
+        'buckets': args.buckets,
+        'seconds': elapsed,
+        'throughput': len(latencies) / elapsed,
+        'p50_ms': percentile_ms(latencies, 0.50),
+        'p95_ms': percentile_ms(latencies, 0.95),
+        'p99_ms': percentile_ms(latencies, 0.99),
+        'max_ms': percentile_ms(latencies, 1),
+        'lock_waiters_mean': sum(sampler.samples) / max(1, len(sampler.samples)),
+        'lock_waiters_max': max(sampler.samples, default=0),
+        'lock_wait_sample_fraction': sum(1 for s in sampler.samples if s) / max(1, len(sampler.samples)),
+        'pool_size': args.pool_size,
+    }
+    # How long shard calls waited for a connection from the pool
+    waits = pool_after['wait_seconds']['count'] - pool_before['wait_seconds']['count']
+    report['pool_waits'] = waits
+    report['pool_wait_mean_ms'] = (
+        (pool_after['wait_seconds']['sum'] - pool_before['wait_seconds']['sum']) / max(1, waits) * 1000
+    )
+    report['pool_wait_over_10ms'] = waits - (
+        pool_after['wait_seconds']['buckets']['0.01'] - pool_before['wait_seconds']['buckets']['0.01']
+    )
+    report['pool_timeouts'] = pool_after['timeouts'] - pool_before['timeouts']
+    # Where the time went, phase by phase
+    for phase, histogram in sorted(stats.stats().get(kind, {}).get('phases', {}).items()):
+        report[f'{phase}_calls'] = histogram['count']
+        report[f'{phase}_mean_ms'] = histogram['sum'] / max(1, histogram['count']) * 1000
+
+    if args.json:
+        print(json.dumps(report))
+    else:
+        for key, value in report.items():
+            print(f'{key:28}{value:.3f}' if isinstance(value, float) else f'{key:28}{value}')
+        if errors:
+            print(f'First error: {errors[0]!r}')
+
+
+if __name__ == '__main__':
+    main()
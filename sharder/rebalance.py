@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+"""
+Rebalance existing home directories across fileservers.
+
+Sharder only balances new assignments, so when fileservers are added the
+existing users stay piled on the old ones. This plans a minimal set of moves
+to even out the (activity weighted) load on each fileserver, and then carries
+them out: copying each home directory, verifying the copy and atomically
+pointing the user's entries_v1 row at the new fileserver.
+
+Users being moved must not have a running server, since their home directory
+is not frozen while it is being copied - and must not start one for a minute
+after they have been moved, until every hub has refreshed its sharder cache
+(Sharder's cache_refresh_interval) and stopped sending them to the old copy.
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from sharder import Sharder
+
+Move = namedtuple('Move', ['name', 'source', 'destination', 'load'])
+
+
+def activity_weight(last_active, now, half_life_days):
+    """
+    Weight of a user who was last active at last_active.
+
+    Someone active right now weighs 1, and the weight halves for every
+    half_life_days since.
+    """
+    age_days = max(0, now - last_active) / (24 * 60 * 60)
+    return 0.5 ** (age_days / half_life_days)
+
+
+def plan_moves(assignments, loads, buckets, weights=None, tolerance=0.05):
+    """
+    Plan moves that even out load across buckets.
+
+    assignments is a dict of name -> bucket, and loads a dict of name -> load
+    (such as activity_weight). weights is an optional dict of bucket -> relative
+    capacity. Everyone in a bucket that is not in buckets (or has weight 0) is
+    moved out.
+
+    Each step moves one user from the most overloaded to the most underloaded
+    bucket, picking the user whose load is closest to the gap between them, so
+    that few moves are needed. Buckets within tolerance (a fraction of the mean
+    load per bucket) of their target are left alone.
+    """
+    weights = weights or {}
+    capacity = {b: weights.get(b, 1) for b in buckets if weights.get(b, 1) > 0}
+    total_capacity = sum(capacity.values())
+
+    members = {b: [] for b in capacity}
+    for name, bucket in assignments.items():
+        members.setdefault(bucket, []).append(name)
+    current = {b: sum(loads.get(n, 0) for n in names) for b, names in members.items()}
+    total_load = sum(current.values())
+    target = {b: total_load * capacity.get(b, 0) / total_capacity for b in members}
+    for names in members.values():
+        names.sort(key=lambda n: (loads.get(n, 0), n))
+
+    slack = tolerance * total_load / len(capacity)
+    moves = []
+    while True:
+        destination = min(capacity, key=lambda b: (current[b] - target[b], b))
+        retired = [b for b in members if b not in capacity and members[b]]
+        if retired:
+            # Empty out buckets we are no longer using, heaviest users first
+            source = retired[0]
+            name = members[source].pop()
+        else:
+            source = max(capacity, key=lambda b: (current[b] - target[b], b))
+            gap = min(current[source] - target[source], target[destination] - current[destination])
+            if current[source] - target[source] <= slack or gap <= 0:
+                break
+            # Only moves of less than twice the gap make things more even
+            candidates = [n for n in members[source] if 0 < loads.get(n, 0) < 2 * gap]
+            if not candidates:
+                break
+            name = min(candidates, key=lambda n: (abs(loads.get(n, 0) - gap), n))
+            members[source].remove(name)
+
+        load = loads.get(name, 0)
+        current[source] -= load
+        current[destination] += load
+        moves.append(Move(name, source, destination, load))
+    return moves
+
+
+def _owner_and_mode(path):
+    st = os.lstat(path)
+    return f'{st.st_uid}:{st.st_gid}:{st.st_mode:o}\0'.encode()
+
+
+def tree_digest(path):
+    """
+    Digest of every file, symlink and directory under path, their contents,
+    owners and modes.
+    """
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        rel_root = os.path.relpath(root, path)
+        digest.update(f'd:{rel_root}\0'.encode())
+        digest.update(_owner_and_mode(root))
+        for filename in sorted(files):
+            full_path = os.path.join(root, filename)
+            digest.update(f'f:{os.path.join(rel_root, filename)}\0'.encode())
+            digest.update(_owner_and_mode(full_path))
+            if os.path.islink(full_path):
+                digest.update(os.readlink(full_path).encode())
+                continue
+            with open(full_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _copy_owner_and_stat(source, destination):
+    st = os.lstat(source)
+    os.lchown(destination, st.st_uid, st.st_gid)
+    if not os.path.islink(destination):
+        # chown clears setuid and setgid bits, so the mode goes back after it
+        shutil.copystat(source, destination)
+
+
+def copy_tree(source, destination):
+    """
+    Copy the tree at source to destination, keeping owners, modes and times.
+
+    shutil.copytree keeps modes and times, but everything it creates belongs
+    to whoever runs it - root, when moving home directories.
+    """
+    shutil.copytree(source, destination, symlinks=True)
+    # Bottom up, so directory times are set after everything in them is
+    for root, dirs, files in os.walk(destination, topdown=False):
+        source_root = os.path.join(source, os.path.relpath(root, destination))
+        for name in files + dirs:
+            path = os.path.join(root, name)
+            # Directories are done as a root of their own, unless they are symlinks
+            if os.path.islink(path) or not os.path.isdir(path):
+                _copy_owner_and_stat(os.path.join(source_root, name), path)
+        _copy_owner_and_stat(source_root, root)
+
+
+class MigrationExecutor:
+    """
+    Carry out planned moves, with bounded parallelism.
+
+    Completed moves are appended to journal_path, and skipped when run again,
+    so an interrupted migration can be resumed by re-running it with the same plan.
+    Source directories are left in place, to be cleaned up once all is well.
+    """
+    def __init__(self, sharder, path_template, journal_path, parallelism=4, escape=lambda name: name, log=None):
+        self.sharder = sharder
+        self.path_template = path_template
+        self.journal_path = journal_path
+        self.parallelism = parallelism
+        self.escape = escape
+        self.log = log or logging.getLogger('rebalance')
+        self._journal_lock = threading.Lock()
+
+    def home_path(self, fileserver, name):
+        return self.path_template.format(fileserver=fileserver, username=self.escape(name))
+
+    def completed(self):
+        if not os.path.exists(self.journal_path):
+            return set()
+        with open(self.journal_path) as f:
+            return {json.loads(line)['name'] for line in f if line.strip()}
+
+    def record(self, move):
+        with self._journal_lock:
+            with open(self.journal_path, 'a') as f:
+                f.write(json.dumps(move._asdict()) + '\n')
+
+    def migrate(self, move):
+        source = self.home_path(move.source, move.name)
+        destination = self.home_path(move.destination, move.name)
+        staging = destination + '.rebalance-tmp'
+
+        if self.sharder.shard(move.name) == move.destination:
+            # Finished everything but recording the move in an earlier attempt
+            self.record(move)
+            return
+
+        if os.path.exists(source):
+            # Leftovers from an earlier, interrupted attempt
+            if os.path.exists(staging):
+                shutil.rmtree(staging)
+            if os.path.exists(destination):
+                if tree_digest(source) != tree_digest(destination):
+                    raise RuntimeError(f'{destination} already exists and differs from {source}')
+            else:
+                copy_tree(source, staging)
+                if tree_digest(source) != tree_digest(staging):
+                    shutil.rmtree(staging)
+                    raise RuntimeError(f'Copy of {source} to {staging} does not match')
+                os.rename(staging, destination)
+        else:
+            self.log.warning(f'{source} does not exist, only updating assignment for {move.name}')
+
+        self.sharder.reassign(move.name, move.destination)
+        self.record(move)
+        self.log.info(f'Moved {move.name} from {move.source} to {move.destination}')
+
+    def run(self, moves):
+        """
+        Carry out moves not already completed. Returns the moves that failed.
+        """
+        done = self.completed()
+        pending = [m for m in moves if m.name not in done]
+        self.log.info(f'{len(done)} moves already done, {len(pending)} to go')
+
+        failed = []
+        with ThreadPoolExecutor(max_workers=self.parallelism) as executor:
+            futures = {executor.submit(self.migrate, m): m for m in pending}
+            for future, move in futures.items():
+                try:
+                    future.result()
+                except Exception:
+                    self.log.exception(f'Moving {move.name} failed')
+                    failed.append(move)
+        return failed
+
+
+def home_activity(path_template, assignments, escape=lambda name: name):
+    """
+    Last activity time of each user, from the newest mtime at the top of their home directory.
+    """
+    activity = {}
+    for name, fileserver in assignments.items():
+        path = path_template.format(fileserver=fileserver, username=escape(name))
+        try:
+            mtimes = [os.stat(path).st_mtime] + [e.stat(follow_symlinks=False).st_mtime for e in os.scandir(path)]
+        except FileNotFoundError:
+            continue
+        activity[name] = max(mtimes)
+    return activity
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    argparser.add_argument('--host', default='localhost')
+    argparser.add_argument('--kind', default='homedir')
+    argparser.add_argument('--bucket', action='append', dest='buckets', required=True, help='Fileserver to balance across')
+    argparser.add_argument('--path-template', default='/mnt/fileservers/{fileserver}/{username}')
+    argparser.add_argument('--half-life-days', type=float, default=7)
+    argparser.add_argument('--tolerance', type=float, default=0.05)
+    argparser.add_argument('--plan', default='rebalance-plan.jsonl', help='File the plan is written to / read from')
+    argparser.add_argument('--journal', default='rebalance-journal.jsonl', help='File completed moves are recorded in')
+    argparser.add_argument('--parallelism', type=int, default=4)
+    argparser.add_argument('--execute', action='store_true', help='Carry out the plan, rather than just writing it')
+    args = argparser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    log = logging.getLogger('rebalance')
+
+    try:
+        import escapism
+        escape = escapism.escape
+    except ImportError:
+        log.warning('escapism is not installed, usernames will not be escaped in paths')
+        escape = lambda name: name
+
+    sharder = Sharder(
+        args.host,
+        os.environ['SHARDER_DB_USERNAME'],
+        os.environ['SHARDER_DB_PASSWORD'],
+        os.environ['SHARDER_DB_NAME'],
+        args.kind, args.buckets, log
+    )
+
+    if args.execute:
+        with open(args.plan) as f:
+            moves = [Move(**json.loads(line)) for line in f if line.strip()]
+        failed = MigrationExecutor(
+            sharder, args.path_template, args.journal, args.parallelism, escape, log
+        ).run(moves)
+        if failed:
+            log.error(f'{len(failed)} moves failed, re-run to retry them')
+        return
+
+    conn = sharder.pool.getconn()
+    try:
+        with conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                SELECT name, bucket FROM entries_v1
+                WHERE kind=%s AND name != 'dummy-' || bucket
+                """, (args.kind, ))
+                assignments = dict(cur.fetchall())
+    finally:
+        sharder.pool.putconn(conn)
+
+    now = time.time()
+    activity = home_activity(args.path_template, assignments, escape)
+    loads = {
+        name: activity_weight(activity[name], now, args.half_life_days) if name in activity else 0
+        for name in assignments
+    }
+    moves = plan_moves(assignments, loads, args.buckets, sharder.weights, args.tolerance)
+    with open(args.plan, 'w') as f:
+        for move in moves:
+            f.write(json.dumps(move._asdict()) + '\n')
+    log.info(f'Wrote {len(moves)} moves to {args.plan}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+import os
+
+import pytest
+
+from rebalance import Move, MigrationExecutor, plan_moves, tree_digest
+
+
+def test_plan_moves_to_new_bucket():
+    assignments = {str(i): 'nfs-a' for i in range(100)}
+    loads = {name: 1 for name in assignments}
+    moves = plan_moves(assignments, loads, ['nfs-a', 'nfs-b'], tolerance=0)
+
+    assert len(moves) == 50
+    assert all(m.source == 'nfs-a' and m.destination == 'nfs-b' for m in moves)
+
+
+def test_plan_moves_prefers_fewer_heavier_users():
+    assignments = {str(i): 'nfs-a' for i in range(20)}
+    # Only a few users have been active recently
+    loads = {name: 0.01 for name in assignments}
+    loads.update({'0': 1, '1': 1})
+    moves = plan_moves(assignments, loads, ['nfs-a', 'nfs-b'], tolerance=0.1)
+
+    assert [m.name for m in moves] == ['0']
+
+
+def test_plan_moves_retires_bucket():
+    assignments = {'a': 'nfs-old', 'b': 'nfs-a', 'c': 'nfs-b'}
+    loads = {'a': 1, 'b': 1, 'c': 1}
+    moves = plan_moves(assignments, loads, ['nfs-a', 'nfs-b'])
+
+    assert [(m.name, m.source) for m in moves] == [('a', 'nfs-old')]
+
+
+class FakeSharder:
+    def __init__(self, assignments):
+        self.assignments = assignments
+
+    def shard(self, name):
+        return self.assignments[name]
+
+    def reassign(self, name, bucket):
+        self.assignments[name] = bucket
+
+
+def test_migration_executor(tmpdir):
+    base = str(tmpdir)
+    home = os.path.join(base, 'nfs-a', 'yuvipanda')
+    os.makedirs(os.path.join(home, 'notebooks'))
+    with open(os.path.join(home, 'notebooks', 'lab01.ipynb'), 'w') as f:
+        f.write('{}')
+    os.makedirs(os.path.join(base, 'nfs-b'))
+
+    sharder = FakeSharder({'yuvipanda': 'nfs-a'})
+    journal = os.path.join(base, 'journal.jsonl')
+    executor = MigrationExecutor(sharder, os.path.join(base, '{fileserver}', '{username}'), journal)
+    moves = [Move('yuvipanda', 'nfs-a', 'nfs-b', 1)]
+
+    assert executor.run(moves) == []
+    assert sharder.assignments == {'yuvipanda': 'nfs-b'}
+    with open(os.path.join(base, 'nfs-b', 'yuvipanda', 'notebooks', 'lab01.ipynb')) as f:
+        assert f.read() == '{}'
+    assert executor.completed() == {'yuvipanda'}
+
+    # Resuming does nothing more
+    assert executor.run(moves) == []
+
+
+@pytest.mark.skipif(os.geteuid() != 0, reason='Needs root to give files away')
+def test_migration_keeps_owners_and_modes(tmpdir):
+    base = str(tmpdir)
+    home = os.path.join(base, 'nfs-a', 'yuvipanda')
+    os.makedirs(os.path.join(home, 'notebooks'))
+    notebook = os.path.join(home, 'notebooks', 'lab01.ipynb')
+    with open(notebook, 'w') as f:
+        f.write('{}')
+    os.symlink('notebooks/lab01.ipynb', os.path.join(home, 'latest'))
+    os.chmod(notebook, 0o640)
+    os.utime(notebook, (1000000000, 1000000000))
+    for path in (home, os.path.join(home, 'notebooks'), notebook, os.path.join(home, 'latest')):
+        os.lchown(path, 1000, 100)
+    os.makedirs(os.path.join(base, 'nfs-b'))
+
+    sharder = FakeSharder({'yuvipanda': 'nfs-a'})
+    executor = MigrationExecutor(
+        sharder, os.path.join(base, '{fileserver}', '{username}'), os.path.join(base, 'journal.jsonl')
+    )
+    assert executor.run([Move('yuvipanda', 'nfs-a', 'nfs-b', 1)]) == []
+
+    moved = os.path.join(base, 'nfs-b', 'yuvipanda')
+    for path in ('', 'notebooks', 'notebooks/lab01.ipynb', 'latest'):
+        st = os.lstat(os.path.join(moved, path))
+        assert (st.st_uid, st.st_gid) == (1000, 100), path
+    st = os.stat(os.path.join(moved, 'notebooks', 'lab01.ipynb'))
+    assert st.st_mode & 0o777 == 0o640
+    assert st.st_mtime == 1000000000
+
+
+def test_tree_digest_includes_owners_and_modes(tmpdir):
+    path = str(tmpdir)
+    with open(os.path.join(path, 'lab01.ipynb'), 'w') as f:
+        f.write('{}')
+    before = tree_digest(path)
+    os.chmod(os.path.join(path, 'lab01.ipynb'), 0o600)
+    assert tree_digest(path) != before
+    if os.geteuid() == 0:
+        before = tree_digest(path)
+        os.lchown(path, 1000, 100)
+        assert tree_digest(path) != before
@@ -1,22 +1,52 @@
+import asyncio
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from collections import Counter
+
+import psycopg2
 import pytest
-import sqlalchemy
 
-from sharder import Sharder
+from sharder import (
+    Sharder, AsyncSharder, AssignmentCache, AssignmentSnapshot, ConnectionPool, PoolTimeout, SingleFlight,
+    SharedLoadSignal, StaticLoadSignal, StatsObserver, load_preference, rendezvous_bucket
+)
+
+# Sharder needs a real postgres database. Tests that need one are skipped
+# if it can not be reached.
+DB_ARGS = (
+    os.environ.get('SHARDER_TEST_DB_HOST', 'localhost'),
+    os.environ.get('SHARDER_TEST_DB_USERNAME', 'postgres'),
+    os.environ.get('SHARDER_TEST_DB_PASSWORD', ''),
+    os.environ.get('SHARDER_TEST_DB_NAME', 'sharder_test'),
+)
 
 @pytest.fixture
-def engine():
-    engine = sqlalchemy.create_engine('sqlite:///:memory:')
-    return engine
+def make_sharder():
+    host, username, password, dbname = DB_ARGS
+    try:
+        psycopg2.connect(host=host, user=username, password=password, dbname=dbname).close()
+    except psycopg2.OperationalError as e:
+        pytest.skip(f'No postgres database available: {e}')
 
-def test_single_shard(engine):
-    s = Sharder(engine, 'homedir', ['nfs-a'])
+    def make(buckets, cls=Sharder, **kwargs):
+        # Every test gets its own kind, so they do not see each other's entries
+        kind = f'homedir-{uuid.uuid4().hex}'
+        return cls(*DB_ARGS, kind, buckets, logging.getLogger('test'), **kwargs)
+    return make
+
+def test_single_shard(make_sharder):
+    s = make_sharder(['nfs-a'])
     assert s.shard('yuvipanda') == 'nfs-a'
     assert s.shard('yuvipanda') == 'nfs-a'
 
-def test_multiple_equal_shard(engine):
+def test_multiple_equal_shard(make_sharder):
     buckets = [str(i) for i in range(10)]
     entries = [str(i) for i in range (100)]
-    s = Sharder(engine, 'homedir', buckets)
+    s = make_sharder(buckets)
     for e in entries:
         s.shard(e)
 
@@ -33,10 +63,10 @@ def test_multiple_equal_shard(engine):
     for shard, count in shards.items():
         assert count == 10
 
-def test_multiple_unequal_shard(engine):
+def test_multiple_unequal_shard(make_sharder):
     buckets = [str(i) for i in range(10)]
     entries = [str(i) for i in range (99)]
-    s = Sharder(engine, 'homedir', buckets)
+    s = make_sharder(buckets)
     for e in entries:
         s.shard(e)
 
@@ -51,3 +81,410 @@ def test_multiple_unequal_shard(engine):
     assert len(shards) == 10
     assert sum(shards.values()) == 99
     assert sorted(shards.values()) == [9, 10, 10, 10, 10, 10, 10, 10, 10, 10]
+
+def test_shard_many(make_sharder):
+    buckets = [str(i) for i in range(10)]
+    s = make_sharder(buckets)
+    existing = s.shard('yuvipanda')
+    assignments = s.shard_many(['yuvipanda'] + [str(i) for i in range(99)])
+
+    assert assignments['yuvipanda'] == existing
+    assert sorted(Counter(assignments.values()).values()) == [10] * 10
+    for name, bucket in assignments.items():
+        assert s.shard(name) == bucket
+
+def test_reassign_reaches_other_caches(make_sharder):
+    s = make_sharder(['nfs-a', 'nfs-b'])
+    other = Sharder(*DB_ARGS, s.kind, ['nfs-a', 'nfs-b'], logging.getLogger('test'))
+    bucket = s.shard('yuvipanda')
+    assert other.shard('yuvipanda') == bucket
+
+    moved_to = 'nfs-b' if bucket == 'nfs-a' else 'nfs-a'
+    s.reassign('yuvipanda', moved_to)
+    # Stale until the next refresh, which happens in the background
+    assert other.shard('yuvipanda') == bucket
+    other.cache_refresh_interval = 0
+    deadline = time.monotonic() + 5
+    while other.shard('yuvipanda') != moved_to and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert other.shard('yuvipanda') == moved_to
+
+class StalledReassign:
+    """
+    reassign name to bucket in a thread, stalled after writing its entries_v1
+    row (so its id and transaction are taken) until the block is left.
+    """
+    def __init__(self, sharder, name, bucket):
+        self.sharder = sharder
+        self.name = name
+        self.bucket = bucket
+
+    def __enter__(self):
+        host, username, password, dbname = DB_ARGS
+        self.conn = psycopg2.connect(host=host, user=username, password=password, dbname=dbname)
+        with self.conn.cursor() as cur:
+            # reassign bumps the population of bucket right after writing its row
+            cur.execute("""
+            SELECT 1 FROM bucket_populations_v1 WHERE kind=%s AND bucket=%s FOR UPDATE
+            """, (self.sharder.kind, self.bucket))
+            self.thread = threading.Thread(target=self.sharder.reassign, args=(self.name, self.bucket))
+            self.thread.start()
+            deadline = time.monotonic() + 5
+            while time.monotonic() < deadline:
+                cur.execute("""
+                SELECT count(*) FROM pg_locks WHERE NOT granted AND pid != pg_backend_pid()
+                """)
+                if cur.fetchone()[0]:
+                    break
+                time.sleep(0.01)
+        return self
+
+    def __exit__(self, *args):
+        self.conn.rollback()
+        self.conn.close()
+        self.thread.join()
+
+def test_refreshes_see_late_commits(make_sharder, tmpdir):
+    buckets = ['nfs-a', 'nfs-b', 'nfs-c']
+    s = make_sharder(buckets, bucket_settings={'nfs-b': {'draining': True}, 'nfs-c': {'draining': True}})
+    s.shard('first')
+    s.shard('second')
+    other = Sharder(*DB_ARGS, s.kind, buckets, logging.getLogger('test'))
+    rendezvous = Sharder(*DB_ARGS, s.kind, buckets, logging.getLogger('test'), placement='rendezvous')
+    snapshot_path = str(tmpdir.join('homedir.snapshot'))
+    for name in ('first', 'second'):
+        assert other.shard(name) == 'nfs-a'
+    rendezvous.refresh_overrides()
+    s.export_snapshot(snapshot_path)
+
+    # first is written before second, but committed after it
+    with StalledReassign(s, 'first', 'nfs-b'):
+        s.reassign('second', 'nfs-c')
+        other.refresh_cache()
+        rendezvous.refresh_overrides()
+        s.export_snapshot(snapshot_path)
+    other.refresh_cache()
+    rendezvous.refresh_overrides()
+    s.export_snapshot(snapshot_path)
+
+    assert [other.shard(name) for name in ('first', 'second')] == ['nfs-b', 'nfs-c']
+    assert [rendezvous.shard(name) for name in ('first', 'second')] == ['nfs-b', 'nfs-c']
+    snapshot = AssignmentSnapshot(snapshot_path)
+    assert [snapshot.get(name) for name in ('first', 'second')] == ['nfs-b', 'nfs-c']
+
+def test_draining_and_weighted_shard(make_sharder):
+    s = make_sharder(['nfs-a', 'nfs-b', 'nfs-c'], bucket_settings={
+        'nfs-a': {'weight': 3},
+        'nfs-c': {'draining': True},
+    })
+    counts = Counter(s.shard(str(i)) for i in range(100))
+    assert counts == {'nfs-a': 75, 'nfs-b': 25}
+
+def test_unhealthy_buckets_skipped(make_sharder):
+    s = make_sharder(['nfs-a', 'nfs-b'])
+    existing = s.shard('yuvipanda')
+    s.set_unhealthy([existing])
+    assert s.shard('yuvipanda') == existing
+    assert {s.shard(str(i)) for i in range(10)} == {'nfs-a', 'nfs-b'} - {existing}
+
+    # With nowhere healthy left, everything is used again
+    s.set_unhealthy(['nfs-a', 'nfs-b'])
+    assert {s.shard(str(i)) for i in range(10, 30)} == {'nfs-a', 'nfs-b'}
+
+def test_rendezvous_draining_keeps_existing(make_sharder):
+    buckets = ['hub-a', 'hub-b', 'hub-c']
+    s = make_sharder(buckets, placement='rendezvous')
+    before = {str(i): s.shard(str(i)) for i in range(300)}
+    s.record_placements()
+
+    s.set_bucket('hub-a', draining=True)
+    s.refresh_overrides()
+    # Nobody already placed moves, and nobody new goes to the draining bucket
+    assert {name: s.shard(name) for name in before} == before
+    after = {str(i): s.shard(str(i)) for i in range(300, 600)}
+    assert 'hub-a' not in after.values()
+    s.record_placements()
+
+    # Names placed while it was draining stay where they went
+    s.set_bucket('hub-a', draining=False)
+    s.refresh_overrides()
+    assert {name: s.shard(name) for name in after} == after
+
+def test_rendezvous_reweighting_keeps_existing(make_sharder):
+    buckets = ['hub-a', 'hub-b', 'hub-c']
+    s = make_sharder(buckets, placement='rendezvous', placement_flush_interval=3600)
+    # Another process, whose placements have not been recorded yet
+    other = Sharder(*DB_ARGS, s.kind, buckets, logging.getLogger('test'), placement='rendezvous', placement_flush_interval=3600)
+    before = {str(i): s.shard(str(i)) for i in range(300)}
+    s.record_placements()
+    unrecorded = {str(i): other.shard(str(i)) for i in range(300, 600)}
+
+    s.set_bucket('hub-a', weight=3)
+    s.set_bucket('hub-b', weight=0)
+    s.set_bucket('hub-c', draining=True)
+    s.refresh_overrides()
+    other.refresh_overrides()
+    # Nobody already placed moves
+    assert {name: s.shard(name) for name in before} == before
+    assert {name: other.shard(name) for name in unrecorded} == unrecorded
+    # but new names follow the new weights
+    after = Counter(s.shard(str(i)) for i in range(600, 900))
+    assert set(after) == {'hub-a'}
+
+    # Including once everything has been recorded
+    other.record_placements()
+    fresh = Sharder(*DB_ARGS, s.kind, buckets, logging.getLogger('test'), placement='rendezvous')
+    assert {name: fresh.shard(name) for name in unrecorded} == unrecorded
+
+def test_connection_pool_waits(make_sharder):
+    host, username, password, dbname = DB_ARGS
+    pool = ConnectionPool(1, timeout=0.1, user=username, host=host, password=password, dbname=dbname)
+    conn = pool.getconn()
+    with pytest.raises(PoolTimeout):
+        pool.getconn()
+
+    # Returning the connection wakes up whoever is waiting for it
+    threading.Timer(0.05, pool.putconn, [conn]).start()
+    pool.timeout = 5
+    assert pool.getconn() is conn
+
+    stats = pool.stats()
+    assert stats['in_use'] == 1
+    assert stats['timeouts'] == 1
+    assert stats['wait_seconds']['count'] == 3
+
+def test_connections_returned_after_transaction(make_sharder):
+    # Without a cache, every shard is a lookup that never commits on its own
+    s = make_sharder(['nfs-a', 'nfs-b'], cache_size=0)
+    statuses = []
+    putconn = s.pool.putconn
+
+    def checked_putconn(conn, close=False):
+        statuses.append(conn.get_transaction_status())
+        putconn(conn, close)
+    s.pool.putconn = checked_putconn
+
+    s.shard('yuvipanda')
+    s.shard('yuvipanda')
+    s.shard_many(['a', 'b'])
+    s.set_bucket('nfs-a', weight=2)
+    s.recount()
+    s.reassign('yuvipanda', 'nfs-b')
+    s.preload()
+    assert statuses == [psycopg2.extensions.TRANSACTION_STATUS_IDLE] * 7
+
+def test_async_sharder_pool(make_sharder):
+    pytest.importorskip('aiopg')
+    s = make_sharder(['nfs-a', 'nfs-b'], cls=AsyncSharder, async_pool_size=1, pool_timeout=0.2, cache_size=0)
+
+    async def run():
+        first = await s.shard('yuvipanda')
+        assert await s.shard('yuvipanda') == first
+        # With the only connection held, checkouts give up after pool_timeout
+        async with s.acquire():
+            with pytest.raises(PoolTimeout):
+                await s.shard('someone-else')
+        await s.close_async_pools()
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(run())
+    finally:
+        loop.close()
+    stats = s.async_pool_stats()
+    assert stats['timeouts'] == 1
+    assert stats['wait_seconds']['count'] == 4
+
+def test_async_sharder_unresponsive_replica(make_sharder):
+    pytest.importorskip('aiopg')
+    # Accepts connections, but never says anything
+    replica = socket.socket()
+    replica.bind(('127.0.0.1', 0))
+    replica.listen(10)
+    host, port = replica.getsockname()
+    s = make_sharder(
+        ['nfs-a'], cls=AsyncSharder, cache_size=0,
+        replica_dsn=f'host={host} port={port}', replica_timeout=0.5
+    )
+
+    async def run():
+        start = time.monotonic()
+        assert await s.shard('yuvipanda') == 'nfs-a'
+        assert time.monotonic() - start < 2
+        await s.close_async_pools()
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(run())
+    finally:
+        loop.close()
+        replica.close()
+
+def test_observers_see_phases_and_events(make_sharder):
+    stats = StatsObserver()
+    s = make_sharder(['nfs-a'], observers=[stats])
+    s.shard('yuvipanda')
+    s.shard('yuvipanda')
+
+    kind_stats = stats.stats()[s.kind]
+    assert kind_stats['events'] == {'assign': {'nfs-a': 1}, 'cache_hit': {'nfs-a': 1}}
+    for phase in ('checkout', 'lookup', 'assign', 'commit'):
+        assert kind_stats['phases'][phase]['count'] == 1
+
+def test_stats_observer():
+    stats = StatsObserver()
+    stats.phase('homedir', 'lookup', 0.002)
+    stats.phase('homedir', 'lookup', 0.2)
+    stats.event('homedir', 'lookup', 'nfs-a')
+    stats.event('homedir', 'lookup', 'nfs-a')
+    stats.event('hub', 'assign', 'hub-1')
+
+    result = stats.stats()
+    lookup = result['homedir']['phases']['lookup']
+    assert lookup['count'] == 2
+    assert lookup['buckets']['0.0025'] == 1
+    assert lookup['buckets']['0.25'] == 2
+    assert result['homedir']['events'] == {'lookup': {'nfs-a': 2}}
+    assert result['hub']['events'] == {'assign': {'hub-1': 1}}
+
+def test_assignment_cache_lru():
+    cache = AssignmentCache(2)
+    cache.put('a', 'nfs-a')
+    cache.put('b', 'nfs-b')
+    assert cache.get('a') == 'nfs-a'
+    # 'b' is now least recently used, and should be evicted
+    cache.put('c', 'nfs-c')
+    assert cache.get('b') is None
+    assert cache.get('a') == 'nfs-a'
+    assert cache.get('c') == 'nfs-c'
+    assert len(cache) == 2
+    assert cache.hits == 3
+    assert cache.misses == 1
+
+def test_single_flight_coalesces():
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def slow_shard(name):
+        calls.append(name)
+        started.set()
+        release.wait()
+        return 'nfs-a'
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(flight.do('yuvipanda', slow_shard, 'yuvipanda')))
+    leader.start()
+    started.wait()
+    followers = [
+        threading.Thread(target=lambda: results.append(flight.do('yuvipanda', slow_shard, 'yuvipanda')))
+        for i in range(5)
+    ]
+    for f in followers:
+        f.start()
+    # Give the followers time to join the in-flight call
+    time.sleep(0.1)
+    release.set()
+    for t in [leader] + followers:
+        t.join()
+
+    assert calls == ['yuvipanda']
+    assert results == ['nfs-a'] * 6
+
+def test_rendezvous_minimal_movement():
+    buckets = [f'hub-{i}' for i in range(10)]
+    names = [str(i) for i in range(10000)]
+    before = {n: rendezvous_bucket(n, buckets) for n in names}
+    after = {n: rendezvous_bucket(n, buckets + ['hub-10']) for n in names}
+
+    moved = [n for n in names if before[n] != after[n]]
+    # Only names picked up by the new bucket move, roughly 1/11 of them
+    assert all(after[n] == 'hub-10' for n in moved)
+    assert 700 < len(moved) < 1100
+    # Placement is spread roughly evenly
+    counts = Counter(before.values())
+    assert len(counts) == 10
+    assert min(counts.values()) > 850
+
+def test_rendezvous_weighted():
+    buckets = ['nfs-small', 'nfs-large']
+    weights = {'nfs-small': 1, 'nfs-large': 3}
+    counts = Counter(rendezvous_bucket(str(i), buckets, weights) for i in range(10000))
+    assert 2200 < counts['nfs-small'] < 2800
+    assert 7200 < counts['nfs-large'] < 7800
+
+def test_assignment_snapshot(tmpdir):
+    path = str(tmpdir.join('homedir.snapshot'))
+    assignments = {f'user-{i}': f'nfs-{i % 3}' for i in range(1000)}
+    assignments['ünïcode'] = 'nfs-0'
+    AssignmentSnapshot.write(path, 'homedir', 1234, assignments)
+
+    snapshot = AssignmentSnapshot(path)
+    assert snapshot.kind == 'homedir'
+    assert snapshot.watermark == 1234
+    for name, bucket in assignments.items():
+        assert snapshot.get(name) == bucket
+    assert snapshot.get('user-1000') is None
+    assert snapshot.get('') is None
+    assert dict(snapshot.items()) == assignments
+
+def test_snapshot_refreshed_once_per_interval(make_sharder, tmpdir):
+    path = str(tmpdir.join('homedir.snapshot'))
+    s = make_sharder(['nfs-a'], snapshot_path=path)
+    # Another process sharing the snapshot, such as a second worker
+    other = Sharder(*DB_ARGS, s.kind, ['nfs-a'], logging.getLogger('test'), snapshot_path=path)
+    s.shard('first')
+    assert s.refresh_snapshot(60)
+    assert not other.refresh_snapshot(60)
+    written_at = os.stat(path).st_mtime
+    os.utime(path, (written_at - 61, written_at - 61))
+    s.shard('second')
+    assert other.refresh_snapshot(60)
+    assert AssignmentSnapshot(path).get('second') == 'nfs-a'
+
+def test_load_preference():
+    buckets = ['hub-a', 'hub-b', 'hub-c']
+    signal = StaticLoadSignal({'hub-a': 30, 'hub-b': 10, 'hub-c': 20})
+    loads = signal.poll()
+    assert load_preference(buckets, loads, {}, {}) == ['hub-b', 'hub-c', 'hub-a']
+    # Entries assigned since the last poll count towards load
+    assert load_preference(buckets, loads, {}, {'hub-b': 15}) == ['hub-c', 'hub-b', 'hub-a']
+    # Weights are relative capacity
+    assert load_preference(buckets, loads, {'hub-a': 6}, {}) == ['hub-a', 'hub-b', 'hub-c']
+    # Buckets we know nothing about are left to population based balancing
+    assert load_preference(buckets + ['hub-d'], loads, {}, {}) == ['hub-b', 'hub-c', 'hub-a']
+    # New entries are counted in the signal's units
+    assert load_preference(buckets, loads, {}, {'hub-b': 1}, per_entry=15) == ['hub-c', 'hub-b', 'hub-a']
+
+def test_shared_load_signal(tmpdir):
+    class CountingSignal(StaticLoadSignal):
+        polls = 0
+
+        def poll(self):
+            self.polls += 1
+            return super().poll()
+
+    signal = CountingSignal({'hub-a': 5, 'hub-b': 10}, per_entry=2)
+    path = str(tmpdir.join('loads.json'))
+    # One per process polling the signal
+    shared = [SharedLoadSignal(signal, path, 15) for i in range(3)]
+    assert shared[0].per_entry == 2
+    assert [s.poll() for s in shared] == [{'hub-a': 5, 'hub-b': 10}] * 3
+    assert signal.polls == 1
+
+    # Whoever finds it out of date polls again
+    signal.loads['hub-a'] = 20
+    written_at = os.stat(path).st_mtime
+    os.utime(path, (written_at - 16, written_at - 16))
+    assert [s.poll() for s in reversed(shared)] == [{'hub-a': 20, 'hub-b': 10}] * 3
+    assert signal.polls == 2
+
+def test_shard_follows_load(make_sharder):
+    signal = StaticLoadSignal({'nfs-a': 5, 'nfs-b': 0, 'nfs-c': 10})
+    s = make_sharder(['nfs-a', 'nfs-b', 'nfs-c'], load_signal=signal, load_poll_interval=60)
+    while not s.load.polled_at:
+        time.sleep(0.01)
+    # Filled up from the least loaded bucket, ignoring populations (all 0)
+    counts = Counter(s.shard(str(i)) for i in range(15))
+    assert counts == {'nfs-b': 10, 'nfs-a': 5}